@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from browser_download import file_hash
+
+def path_size(path):
+    """Size of a file or of everything in a directory"""
+    size = 0
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, _, files in os.walk(path):
+            for name in files:
+                file_path = os.path.join(root, name)
+                if not os.path.islink(file_path):
+                    size += os.path.getsize(file_path)
+    elif os.path.isfile(path):
+        size = os.path.getsize(path)
+    return size
+
+
+def remove_path(path):
+    """Delete a file or a directory tree"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+    except Exception:
+        logging.exception('Error removing %s', path)
+
+
+class InstallerArchive(object):
+    """The last few installers of every channel, kept so a channel can be rolled back
+    without downloading anything.
+
+    Every channel keeps up to keep installers (newest first in the index, with their
+    validators and when they were installed) and the oldest installers across all of
+    the channels are removed once the archive grows past max_size."""
+    def __init__(self, directory, keep, max_size):
+        self.dir = directory
+        self.index_file = os.path.join(directory, 'index.json')
+        self.keep = keep
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index = self.load_index()
+
+    def load_index(self):
+        """Load the archive index from disk"""
+        index = None
+        try:
+            if os.path.isfile(self.index_file):
+                with open(self.index_file, 'r') as f_in:
+                    index = json.load(f_in)
+        except Exception:
+            logging.exception('Error loading the installer archive index')
+        if not isinstance(index, dict):
+            index = {}
+        return index
+
+    def save_index(self):
+        """Write the index atomically"""
+        tmp_file = self.index_file + '.{0:d}.tmp'.format(os.getpid())
+        with open(tmp_file, 'w') as f_out:
+            json.dump(self.index, f_out, indent=4)
+        os.replace(tmp_file, self.index_file)
+
+    def add(self, name, path, validators):
+        """Archive the installer that was just installed for a channel.
+
+        Files are linked (or copied) into the archive, directories are moved into it."""
+        if self.keep <= 0 or validators is None or validators.get('sha256') is None:
+            if os.path.isdir(path):
+                remove_path(path)
+            return
+        try:
+            with self.lock:
+                entries = self.index.setdefault(name, [])
+                if entries and entries[0]['sha256'] == validators['sha256'] and \
+                        os.path.lexists(os.path.join(self.dir, entries[0]['path'])):
+                    entries[0]['installed'] = int(time.time())
+                    if os.path.isdir(path):
+                        remove_path(path)
+                else:
+                    channel_dir = re.sub(r'\W+', '_', name)
+                    extension = '' if os.path.isdir(path) else os.path.splitext(path)[1]
+                    relative = os.path.join(channel_dir, '{0:d}-{1}{2}'.format(
+                        int(time.time()), validators['sha256'][:12], extension))
+                    dest = os.path.join(self.dir, relative)
+                    if not os.path.isdir(os.path.dirname(dest)):
+                        os.makedirs(os.path.dirname(dest))
+                    if os.path.isdir(path):
+                        shutil.move(path, dest)
+                    else:
+                        tmp_file = dest + '.{0:d}.tmp'.format(os.getpid())
+                        try:
+                            os.link(path, tmp_file)
+                        except Exception:
+                            shutil.copyfile(path, tmp_file)
+                        os.replace(tmp_file, dest)
+                    entries.insert(0, {'path': relative,
+                                       'sha256': validators['sha256'],
+                                       'size': path_size(dest),
+                                       'installed': int(time.time()),
+                                       'validators': dict(validators)})
+                    logging.debug('Archived %s for %s', relative, name)
+                self.evict()
+                self.save_index()
+        except Exception:
+            logging.exception('Error archiving the installer for %s', name)
+
+    def previous(self, name, number=1, current=None):
+        """Get the archived installer number installs back (skipping the one with the
+        current SHA-256), or None if the archive does not go back that far or the
+        installer no longer matches its SHA-256"""
+        entry = None
+        with self.lock:
+            entries = [dict(entry) for entry in self.index.get(name, [])
+                       if entry['sha256'] != current and
+                       os.path.lexists(os.path.join(self.dir, entry['path']))]
+        if 0 < number <= len(entries):
+            entry = entries[number - 1]
+            entry['path'] = os.path.join(self.dir, entry['path'])
+            if os.path.isfile(entry['path']) and file_hash(entry['path']) != entry['sha256']:
+                logging.warning('The archived installer %s for %s is corrupt', entry['path'], name)
+                self.take(name, entry)
+                remove_path(entry['path'])
+                entry = None
+        return entry
+
+    def take(self, name, entry):
+        """Remove an entry from the index, leaving its installer to the caller"""
+        with self.lock:
+            relative = os.path.relpath(entry['path'], self.dir)
+            self.index[name] = [archived for archived in self.index.get(name, [])
+                                if archived['path'] != relative]
+            self.save_index()
+
+    def evict(self):
+        """Trim every channel to keep installers and the whole archive to max_size"""
+        removed = []
+        for name in self.index:
+            removed.extend(self.index[name][self.keep:])
+            self.index[name] = self.index[name][:self.keep]
+        total = 0
+        for name in self.index:
+            for entry in self.index[name]:
+                total += entry.get('size', 0)
+        # Older versions go first, the newest installer of a channel only as a last resort
+        by_age = sorted([(number == 0, entry['installed'], name, entry)
+                         for name in self.index
+                         for number, entry in enumerate(self.index[name])],
+                        key=lambda item: item[:2])
+        while total > self.max_size and by_age:
+            _, _, name, entry = by_age.pop(0)
+            total -= entry.get('size', 0)
+            self.index[name].remove(entry)
+            removed.append(entry)
+        for entry in removed:
+            remove_path(os.path.join(self.dir, entry['path']))
+            logging.debug('Removed %s from the installer archive', entry['path'])
+        return len(removed)
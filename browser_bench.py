@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Offline benchmark of the download/install pipeline.
+
+Runs the installer for --all against a local stand-in for the vendor CDNs with the
+installers replaced by a fake runner, and reports the wall-clock time, bytes and
+requests of a cold run (nothing installed), a warm run (nothing changed) and an
+update run (a third of the channels changed).
+"""
+import copy
+import email.utils
+import io
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Vendor endpoints that answer with a redirect before reaching the CDN object
+REDIRECTING_HOSTS = ['download.mozilla.org', 'c2rsetup.officeapps.live.com',
+                     'laptop-updates.brave.com']
+# Copies of the vendor release feeds the stand-in serves for --feeds
+FEED_FIXTURES = {'firefox': 'firefox_versions.json',
+                 'chrome': 'chrome_releases.json',
+                 'edge': 'edge_products.json'}
+FEEDS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures', 'feeds')
+
+class FakeCdn(object):
+    """Local stand-in for the vendor CDNs with configurable server behaviour"""
+    def __init__(self, size, bandwidth=0, latency=0, redirects=0, last_modified=True,
+                 drop=False):
+        self.size = size
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.redirects = redirects
+        self.last_modified = last_modified
+        self.drop = drop
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.dropped = set()
+        self.requests = 0
+        self.bytes = 0
+        self.statuses = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCdnRequestHandler)
+        self.server.daemon_threads = True
+        self.server.cdn = self
+        self.base = 'http://127.0.0.1:{0:d}'.format(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, name, seed):
+        """Publish a new version of an installer"""
+        data = random.Random(seed).getrandbits(8 * self.size).to_bytes(self.size, 'little')
+        self.publish_data(name, data, seed)
+
+    def publish_data(self, name, data, seed=0, drop=True, content_type=None):
+        """Publish a new version of an object with the given content (only dropped with
+        drop, so release feeds can be served whole)"""
+        with self.lock:
+            modified = int(time.time())
+            if name in self.objects and modified <= self.objects[name]['modified']:
+                modified = self.objects[name]['modified'] + 1
+            self.objects[name] = {'data': data, 'modified': modified, 'seed': seed, 'drop': drop,
+                                  'type': content_type}
+            self.dropped.discard(name)
+
+    def url(self, upstream, name):
+        """URL on the stand-in for an upstream installer URL"""
+        if self.redirects > 0 and urlparse(upstream).hostname in REDIRECTING_HOSTS:
+            return '{0}/r/{1:d}/{2}'.format(self.base, self.redirects, name)
+        return '{0}/f/{1}'.format(self.base, name)
+
+    def count(self, status):
+        """Count a response (before it is sent, so clients never see uncounted responses)"""
+        with self.lock:
+            self.requests += 1
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def sent(self, size):
+        """Keep track of the body bytes served"""
+        with self.lock:
+            self.bytes += size
+
+    def reset(self):
+        """Reset the traffic counters"""
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+            self.statuses = {}
+
+    def stop(self):
+        """Shut down the server"""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeCdnRequestHandler(BaseHTTPRequestHandler):
+    """Serves the fake installers, redirects, 304s, ranges, throttling and dropped connections"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def do_HEAD(self):
+        """Respond to a HEAD request"""
+        self.respond(False)
+
+    def do_GET(self):
+        """Respond to a GET request"""
+        self.respond(True)
+
+    def send_empty(self, status, headers=None):
+        """Send a response without a body"""
+        self.send_response(status)
+        if headers is not None:
+            for name in headers:
+                self.send_header(name, headers[name])
+        self.send_header('Content-Length', '0')
+        self.server.cdn.count(status)
+        self.end_headers()
+
+    def respond(self, send_body):
+        """Serve a request"""
+        cdn = self.server.cdn
+        if cdn.latency:
+            time.sleep(cdn.latency)
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'r':
+            hops = int(parts[1]) - 1
+            if hops > 0:
+                location = '/r/{0:d}/{1}'.format(hops, parts[2])
+            else:
+                location = '/f/' + parts[2]
+            self.send_empty(302, {'Location': location})
+            return
+        with cdn.lock:
+            entry = cdn.objects.get(parts[-1]) if len(parts) == 2 and parts[0] == 'f' else None
+        if entry is None:
+            self.send_empty(404)
+            return
+        data = entry['data']
+        headers = {}
+        if cdn.last_modified:
+            headers['Last-Modified'] = email.utils.formatdate(entry['modified'], usegmt=True)
+            headers['ETag'] = '"{0:x}-{1:x}"'.format(entry['seed'], entry['modified'])
+            if self.headers.get('If-None-Match') == headers['ETag'] or \
+                    (self.headers.get('If-None-Match') is None and
+                     self.headers.get('If-Modified-Since') == headers['Last-Modified']):
+                self.send_empty(304, headers)
+                return
+        start = 0
+        end = len(data) - 1
+        status = 200
+        requested = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if cdn.last_modified and requested is not None and requested.startswith('bytes=') and \
+                (if_range is None or if_range in headers.values()):
+            first, last = requested[6:].split('-', 1)
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            if start > end:
+                self.send_empty(416, {'Content-Range': 'bytes */{0:d}'.format(len(data))})
+                return
+            status = 206
+        self.send_response(status)
+        for name in headers:
+            self.send_header(name, headers[name])
+        if entry['type'] is not None:
+            self.send_header('Content-Type', entry['type'])
+        if cdn.last_modified:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range',
+                             'bytes {0:d}-{1:d}/{2:d}'.format(start, end, len(data)))
+        self.send_header('Content-Length', str(end - start + 1))
+        cdn.count(status)
+        self.end_headers()
+        sent = 0
+        if send_body:
+            drop_at = None
+            with cdn.lock:
+                if cdn.drop and entry['drop'] and parts[-1] not in cdn.dropped and status == 200:
+                    cdn.dropped.add(parts[-1])
+                    drop_at = len(data) // 2
+            position = start
+            chunk_size = 65536
+            chunk_start = time.time()
+            while position <= end:
+                chunk = data[position:min(position + chunk_size, end + 1)]
+                if drop_at is not None and sent + len(chunk) > drop_at:
+                    self.close_connection = True
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except Exception:
+                    break
+                sent += len(chunk)
+                position += len(chunk)
+                if cdn.bandwidth:
+                    # Pace the response to the configured bandwidth
+                    delay = float(sent) / cdn.bandwidth - (time.time() - chunk_start)
+                    if delay > 0:
+                        time.sleep(delay)
+        cdn.sent(sent)
+
+
+def fake_install(module, cdn, work_dir, install_time):
+    """Build an Install class for the given installer module that keeps its state in
+    work_dir, talks to the fake CDN (if there is one) and replaces the real installers
+    with a fake runner"""
+    class FakeInstall(module.Install):
+        """Installer pointed at the fake CDN with a fake installer runner"""
+        def __init__(self, options):
+            # Keep the benchmark state away from the real status file (before anything is
+            # created in the tmp directory)
+            self.dir = work_dir
+            options = copy.copy(options)
+            options.staging_dir = os.path.join(work_dir, 'staging')
+            options.archive_dir = os.path.join(work_dir, 'archive')
+            module.Install.__init__(self, options)
+            self.installs = 0
+            for attr in ['chrome_path', 'brave_path', 'firefox_path', 'edge_path']:
+                paths = getattr(self, attr, None)
+                if paths is not None and cdn is not None:
+                    for channel in paths:
+                        name = re.sub(r'\W+', '_', attr[:-5] + '_' + channel)
+                        paths[channel] = cdn.url(paths[channel], name)
+
+        def detect_universal(self):
+            """Skip the macOS platform detection"""
+            return True
+
+        def fake_installer(self):
+            """Pretend to run an installer"""
+            time.sleep(install_time)
+            self.installs += 1
+            return 0
+
+        def run_elevated(self, command, args):
+            """Pretend to run a Windows installer"""
+            return self.fake_installer()
+
+        def install_dmg(self, dmg, mount_prefix):
+            """Pretend to install a dmg"""
+            return self.fake_installer()
+
+        def remove_app(self, app):
+            """Leave the installed apps alone"""
+            pass
+
+    return FakeInstall
+
+
+def channel_names(module):
+    """Names the fake CDN publishes the installers under"""
+    names = []
+    paths = module.browser_paths(True)
+    for browser in sorted(paths.keys()):
+        for channel in sorted(paths[browser].keys()):
+            names.append(re.sub(r'\W+', '_', browser + '_' + channel))
+    return names
+
+
+def run_scenario(name, install_class, options, cdn, verbose):
+    """Run the installer once and measure it"""
+    cdn.reset()
+    stdout = sys.stdout
+    if not verbose:
+        sys.stdout = io.StringIO()
+    try:
+        start = time.time()
+        install = install_class(options)
+        install.install_thread()
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+    return {'scenario': name, 'elapsed': elapsed, 'requests': cdn.requests, 'bytes': cdn.bytes,
+            'installs': install.installs, 'statuses': dict(cdn.statuses)}
+
+
+##########################################################################
+#   Main Entry Point
+##########################################################################
+def main():
+    """Main entry point"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Offline benchmark of the browser installer.'\
+                                     ' Unrecognized options are passed to the installer.',
+                                     prog='browser_bench')
+    parser.add_argument('--platform', choices=['windows', 'macos'], default='windows',
+                        help="Installer to benchmark (default windows).")
+    parser.add_argument('--size', type=float, default=8,
+                        help="Size of each fake installer in MB (default 8).")
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help="Per-connection bandwidth limit in Mbps (default unlimited).")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Delay before every response in ms (default 0).")
+    parser.add_argument('--redirects', type=int, default=1,
+                        help="Redirects in front of the Firefox, Edge and Brave downloads"\
+                        " (default 1).")
+    parser.add_argument('--no-last-modified', action='store_true', default=False,
+                        help="Only send a Date header (no Last-Modified, ETag or range support).")
+    parser.add_argument('--drop', action='store_true', default=False,
+                        help="Drop every download connection halfway through, once.")
+    parser.add_argument('--install-time', type=float, default=0.5,
+                        help="Seconds each fake installer takes to run (default 0.5).")
+    parser.add_argument('--runs', type=int, default=1,
+                        help="Number of times to repeat the scenarios (default 1).")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--bench-verbose', action='store_true', default=False,
+                        help="Show the installer output and debug logging.")
+    bench_options, installer_args = parser.parse_known_args()
+    logging.basicConfig(level=logging.DEBUG if bench_options.bench_verbose else logging.CRITICAL,
+                        format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
+
+    if bench_options.platform == 'macos':
+        import browser_install_macos as module
+    else:
+        import browser_install as module
+    options = module.parse_options(['--all'] + installer_args)
+    cdn = FakeCdn(int(bench_options.size * 1024 * 1024),
+                  bandwidth=bench_options.bandwidth * 1000000 / 8,
+                  latency=bench_options.latency / 1000.0,
+                  redirects=bench_options.redirects,
+                  last_modified=not bench_options.no_last_modified,
+                  drop=bench_options.drop)
+    # --feeds gets the fixture feeds from the stand-in rather than the vendors
+    for browser in FEED_FIXTURES:
+        with open(os.path.join(FEEDS_DIR, FEED_FIXTURES[browser]), 'rb') as f_in:
+            cdn.publish_data(FEED_FIXTURES[browser], f_in.read(), drop=False)
+        if getattr(options, browser + '_feed') is None:
+            setattr(options, browser + '_feed', '{0}/f/{1}'.format(cdn.base, FEED_FIXTURES[browser]))
+    names = channel_names(module)
+    results = []
+    try:
+        for run in range(bench_options.runs):
+            work_dir = tempfile.mkdtemp(prefix='browser_bench')
+            try:
+                install_class = fake_install(module, cdn, work_dir, bench_options.install_time)
+                for index, name in enumerate(names):
+                    cdn.publish(name, run * 1000 + index)
+                results.append(run_scenario('cold', install_class, options, cdn,
+                                            bench_options.bench_verbose))
+                results.append(run_scenario('warm', install_class, options, cdn,
+                                            bench_options.bench_verbose))
+                for index, name in enumerate(names):
+                    if index % 3 == 0:
+                        cdn.publish(name, run * 1000 + index + 500)
+                results.append(run_scenario('update', install_class, options, cdn,
+                                            bench_options.bench_verbose))
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    finally:
+        cdn.stop()
+
+    print("{0:<8} {1:>9} {2:>9} {3:>10} {4:>9}  {5}".format(
+        'Scenario', 'Time (s)', 'Requests', 'MB', 'Installs', 'Status codes'))
+    for result in results:
+        print("{0:<8} {1:>9.2f} {2:>9d} {3:>10.1f} {4:>9d}  {5}".format(
+            result['scenario'], result['elapsed'], result['requests'],
+            float(result['bytes']) / (1024 * 1024), result['installs'],
+            ' '.join('{0}:{1:d}'.format(status, count)
+                     for status, count in sorted(result['statuses'].items()))))
+    if bench_options.output:
+        with open(bench_options.output, 'w') as f_out:
+            json.dump(results, f_out, indent=4)
+
+if __name__ == '__main__':
+    main()
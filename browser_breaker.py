@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+class CircuitBreaker(object):
+    """Per-host circuit breaker, persisted in state_file so it carries over between runs.
+
+    A host is skipped for cooldown seconds once it has failed threshold times in a
+    row. After that a single request is let through as a trial: if it works the host
+    is back in service, if it fails the host is skipped for another cooldown."""
+    def __init__(self, state_file, threshold=3, cooldown=600):
+        self.state_file = state_file
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.hosts = {}
+        try:
+            if os.path.isfile(state_file):
+                with open(state_file, 'r') as f_in:
+                    self.hosts = json.load(f_in)
+        except Exception:
+            logging.exception('Error loading the circuit breaker state')
+        if not isinstance(self.hosts, dict):
+            self.hosts = {}
+
+    def allow(self, host):
+        """Check if a request to host should be made"""
+        allowed = True
+        if self.threshold > 0:
+            with self.lock:
+                state = self.hosts.get(host)
+                if state is not None and state.get('failures', 0) >= self.threshold:
+                    now = time.time()
+                    if now < state.get('opened', 0) + self.cooldown:
+                        allowed = False
+                    else:
+                        # Let this request through as the trial, holding back everything else
+                        logging.debug('Trying %s again after %d failures', host, state['failures'])
+                        state['opened'] = now
+        return allowed
+
+    def record(self, host, success):
+        """Record the outcome of a request to host"""
+        with self.lock:
+            if success:
+                if host in self.hosts:
+                    if self.hosts[host].get('failures', 0) >= self.threshold:
+                        logging.info('%s is working again', host)
+                    del self.hosts[host]
+            else:
+                state = self.hosts.setdefault(host, {'failures': 0})
+                state['failures'] = state.get('failures', 0) + 1
+                if state['failures'] == self.threshold:
+                    logging.warning('%s failed %d times in a row, skipping it for %ds', host,
+                                    state['failures'], self.cooldown)
+                    state['opened'] = time.time()
+                elif state['failures'] > self.threshold:
+                    state['opened'] = time.time()
+
+    def save(self):
+        """Write the state atomically"""
+        try:
+            tmp_file = self.state_file + '.{0:d}.tmp'.format(os.getpid())
+            with self.lock:
+                with open(tmp_file, 'w') as f_out:
+                    json.dump(self.hosts, f_out)
+            os.replace(tmp_file, self.state_file)
+        except Exception:
+            logging.exception('Error saving the circuit breaker state')
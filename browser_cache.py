@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from browser_download import discard_partial, file_hash
+
+class InstallerCache(object):
+    """Content-addressed store of downloaded installers that can be shared between hosts.
+
+    Installers are stored once per SHA-256 under objects/ and the index maps each
+    download URL to the validators and hash of the last version seen for it."""
+    def __init__(self, directory, max_size):
+        self.dir = directory
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.index_file = os.path.join(directory, 'index.json')
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        if not os.path.isdir(self.objects_dir):
+            os.makedirs(self.objects_dir)
+        self.index = self.load_index()
+        if self.evict():
+            self.save_index()
+
+    def load_index(self):
+        """Load the cache index from disk"""
+        index = None
+        try:
+            if os.path.isfile(self.index_file):
+                with open(self.index_file, 'r') as f_in:
+                    index = json.load(f_in)
+        except Exception:
+            logging.exception('Error loading the installer cache index')
+        if not isinstance(index, dict):
+            index = {}
+        if 'urls' not in index:
+            index['urls'] = {}
+        if 'objects' not in index:
+            index['objects'] = {}
+        return index
+
+    def save_index(self):
+        """Write the index, keeping entries other processes added in the meantime"""
+        on_disk = self.load_index()
+        for sha256 in on_disk['objects']:
+            if sha256 not in self.index['objects'] and os.path.isfile(self.object_path(sha256)):
+                self.index['objects'][sha256] = on_disk['objects'][sha256]
+        for url in on_disk['urls']:
+            if url not in self.index['urls'] and \
+                    on_disk['urls'][url].get('sha256') in self.index['objects']:
+                self.index['urls'][url] = on_disk['urls'][url]
+        tmp_file = self.index_file + '.{0:d}.tmp'.format(os.getpid())
+        with open(tmp_file, 'w') as f_out:
+            json.dump(self.index, f_out, indent=4)
+        os.replace(tmp_file, self.index_file)
+
+    def object_path(self, sha256):
+        """Path of the cached installer with the given hash"""
+        return os.path.join(self.objects_dir, sha256)
+
+    def lookup(self, url):
+        """Get the validators and hash of the cached installer for a URL (if any)"""
+        entry = None
+        with self.lock:
+            cached = self.index['urls'].get(url)
+            if cached is not None and cached.get('sha256') is not None and \
+                    os.path.isfile(self.object_path(cached['sha256'])):
+                entry = dict(cached)
+        return entry
+
+    def get(self, url, entry, dest):
+        """Copy the cached installer for a URL to dest, checking that it still matches its
+        SHA-256 (a damaged copy is removed from the cache)"""
+        path = None
+        validators = None
+        try:
+            # dest can be a hard link to another copy of an installer, replace it
+            discard_partial(dest)
+            shutil.copyfile(self.object_path(entry['sha256']), dest)
+            if file_hash(dest) != entry['sha256']:
+                logging.warning('The cached installer for %s is corrupt', url)
+                discard_partial(dest)
+                with self.lock:
+                    self.remove(entry['sha256'])
+                    self.save_index()
+            else:
+                path = dest
+                validators = dict(entry)
+                with self.lock:
+                    self.hits += 1
+                    self.bytes_served += entry.get('size', 0)
+                    if entry['sha256'] in self.index['objects']:
+                        self.index['objects'][entry['sha256']]['used'] = time.time()
+                    self.save_index()
+                logging.debug('Installer cache hit for %s', url)
+        except Exception:
+            logging.exception('Error reading %s from the installer cache', url)
+        return path, validators
+
+    def add(self, url, path, validators):
+        """Store a freshly downloaded installer"""
+        if validators is None or validators.get('sha256') is None:
+            return
+        sha256 = validators['sha256']
+        try:
+            with self.lock:
+                self.misses += 1
+                dest = self.object_path(sha256)
+                if not os.path.isfile(dest):
+                    tmp_file = dest + '.{0:d}.tmp'.format(os.getpid())
+                    try:
+                        os.link(path, tmp_file)
+                    except Exception:
+                        shutil.copyfile(path, tmp_file)
+                    os.replace(tmp_file, dest)
+                self.index['objects'][sha256] = {'size': os.path.getsize(dest), 'used': time.time()}
+                self.index['urls'][url] = dict(validators)
+                self.evict()
+                self.save_index()
+        except Exception:
+            logging.exception('Error adding %s to the installer cache', url)
+
+    def evict(self):
+        """Remove the least recently used installers until the cache fits in max_size"""
+        evicted = 0
+        total = 0
+        for sha256 in self.index['objects']:
+            total += self.index['objects'][sha256].get('size', 0)
+        by_age = sorted(self.index['objects'].keys(),
+                        key=lambda sha256: self.index['objects'][sha256].get('used', 0))
+        while total > self.max_size and by_age:
+            sha256 = by_age.pop(0)
+            total -= self.index['objects'][sha256].get('size', 0)
+            self.remove(sha256)
+            logging.debug('Evicted %s from the installer cache', sha256)
+            evicted += 1
+        return evicted
+
+    def remove(self, sha256):
+        """Delete a cached installer and the URLs that point to it"""
+        self.index['objects'].pop(sha256, None)
+        try:
+            os.remove(self.object_path(sha256))
+        except Exception:
+            pass
+        for url in list(self.index['urls'].keys()):
+            if self.index['urls'][url].get('sha256') == sha256:
+                del self.index['urls'][url]
+
+    def log_stats(self):
+        """Log the cache hit rate for this run"""
+        logging.info('Installer cache: %d hits, %d misses, %0.1f MB served from cache',
+                     self.hits, self.misses, float(self.bytes_served) / (1024 * 1024))
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Options and run state shared by the Windows, macOS and Linux installers.
+"""
+import logging
+import os
+import threading
+import time
+# Start of the run for --timing (which adds the interpreter startup where the OS says when
+# the process started). The installers import this module before the rest of the installer
+# so the startup time includes loading it. The helper modules are imported where they are
+# used, so the ones behind options that are off are never loaded.
+STARTED = time.time()
+
+def add_common_options(parser):
+    """Add the options every platform supports to an argparse parser"""
+    parser.add_argument('-w', '--wait', action='store_true', default=False,
+                        help="If another install is already running, wait for it to finish"\
+                        " (and reuse its results) instead of exiting.")
+    parser.add_argument('--to', type=int, default=1,
+                        help="How many installs back --rollback goes (default 1, the version"\
+                        " installed before the current one).")
+    parser.add_argument('--unpin', metavar='CHANNEL',
+                        help="Let a rolled back channel be updated again.")
+    parser.add_argument('--archive-keep', type=int, default=2,
+                        help="Number of installs to keep per channel for --rollback"\
+                        " (default 2, 0 to disable).")
+    parser.add_argument('--archive-size', type=int, default=2048,
+                        help="Maximum size of the archive in MB (default 2048).")
+    parser.add_argument('--feeds', action='store_true', default=False,
+                        help="Use the vendor release feeds to find the current version of every"\
+                        " Firefox, Chrome and Edge channel (one request per vendor) and skip"\
+                        " channels that are already on it.")
+    parser.add_argument('--firefox-feed',
+                        help="URL of the Firefox release feed (Mozilla product-details"\
+                        " firefox_versions.json).")
+    parser.add_argument('--chrome-feed',
+                        help="URL of the Chrome release feed (version history API releases).")
+    parser.add_argument('--edge-feed',
+                        help="URL of the Edge release feed (Edge updates products API).")
+    parser.add_argument('--fresh', type=int, default=0,
+                        help="Skip checking channels that were confirmed up to date less than"\
+                        " this many seconds ago (default 0, always check).")
+    parser.add_argument('--timing', action='store_true', default=False,
+                        help="Print how long each step of the run took.")
+    parser.add_argument('--metrics-file',
+                        help="Append per-channel probe/download/install timings to this"\
+                        " JSON-lines file.")
+    parser.add_argument('--prometheus-file',
+                        help="Write per-channel timings and throughput to this Prometheus"\
+                        " textfile-collector file (i.e. /var/lib/node_exporter/browser_install.prom).")
+    parser.add_argument('--pool-hosts', type=int, default=10,
+                        help="Number of per-host keep-alive connection pools to keep (default 10).")
+    parser.add_argument('--pool-size', type=int, default=10,
+                        help="Maximum keep-alive connections per host, and channels probed at"\
+                        " once (default 10).")
+    parser.add_argument('--redirect-ttl', type=int, default=3600,
+                        help="Seconds to send requests straight to the URL a download endpoint"\
+                        " redirected to before following the redirects again (default 3600,"\
+                        " 0 to always follow them).")
+    parser.add_argument('--budget', type=int, default=0,
+                        help="Seconds each channel may spend downloading before it is stopped"\
+                        " so the next channel gets a turn (default 0, no limit).")
+    parser.add_argument('--priority',
+                        help="Order to update the channels in, as a comma-separated list of"\
+                        " release levels, browsers or channel names (i.e. stable,beta,dev).")
+    parser.add_argument('--connect-timeout', type=float, default=10,
+                        help="Seconds to wait for a connection to a download server (default 10).")
+    parser.add_argument('--read-timeout', type=float, default=60,
+                        help="Seconds to wait for more data from a download server before"\
+                        " giving up on it (default 60).")
+    parser.add_argument('--retries', type=int, default=2,
+                        help="Number of times a failed request is retried, with a jittered"\
+                        " exponential backoff (default 2).")
+    parser.add_argument('--breaker-threshold', type=int, default=3,
+                        help="Skip a host after this many failures in a row (default 3, 0 to"\
+                        " never skip hosts).")
+    parser.add_argument('--breaker-cooldown', type=int, default=600,
+                        help="Seconds a failing host is skipped for, across runs, before it is"\
+                        " tried again (default 600).")
+    parser.add_argument('--max-rate', type=float, default=0,
+                        help="Limit the total download bandwidth to this many Mbps"\
+                        " (default 0, unlimited).")
+    parser.add_argument('--host-rate', type=float, default=0,
+                        help="Limit the download bandwidth from each host to this many Mbps"\
+                        " (default 0, unlimited).")
+    parser.add_argument('--pause-file',
+                        help="Pause downloads and installs (mid-transfer) while this file exists"\
+                        " and resume them when it is removed.")
+    parser.add_argument('--pause-lock',
+                        help="Pause downloads and installs while another process (i.e. the test"\
+                        " agent, during a test) holds a lock on this file.")
+
+
+def add_installer_options(parser):
+    """Add the options of the platforms that download whole installers (Windows and macOS)"""
+    parser.add_argument('--segments', type=int, default=1,
+                        help="Download large installers over this many parallel range requests"\
+                        " when the server supports it (default 1).")
+    parser.add_argument('--cache-dir',
+                        help="Directory for a shared installer cache (disabled by default).")
+    parser.add_argument('--cache-size', type=int, default=2048,
+                        help="Maximum size of the installer cache in MB (default 2048).")
+    parser.add_argument('--mirror',
+                        help="Download every installer from this fleet mirror"\
+                        " (i.e. http://mirror:8888) instead of the browser vendors.")
+    parser.add_argument('--delta', action='store_true', default=False,
+                        help="Only download the blocks that changed since the previous"\
+                        " installer (requires --mirror, keeps the last installer per channel).")
+
+
+def setup_logging(verbose):
+    """Log at the level picked with -v (-vvvv for full debug output)"""
+    log_level = logging.CRITICAL
+    if verbose == 1:
+        log_level = logging.ERROR
+    elif verbose == 2:
+        log_level = logging.WARNING
+    elif verbose == 3:
+        log_level = logging.INFO
+    elif verbose >= 4:
+        log_level = logging.DEBUG
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
+
+
+def run_parallel(func, items, workers):
+    """Start func for every item on a pool of up to workers threads, in order, and return
+    the futures for the results (in the same order)"""
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(max_workers=max(min(workers, len(items)), 1))
+    futures = [executor.submit(func, item) for item in items]
+    # The queued calls still run, the threads exit once they are done
+    executor.shutdown(wait=False)
+    return futures
+
+
+class InstallBase(object):
+    """Run state and helpers shared by the installers for every platform.
+
+    Each platform keeps its state files in the tmp directory, named with file_prefix
+    and file_suffix (i.e. browser_install_linux.json) so they don't collide."""
+    file_prefix = 'browser_'
+    file_suffix = ''
+    # The tmp directory next to the installer unless it is pointed somewhere else before
+    # __init__ runs (i.e. by the benchmark)
+    dir = None
+    # The browsers in the order they are installed and, for each of --stable, --beta and
+    # --dev, the channels it selects (the URL tables of each platform decide which of them
+    # exist there)
+    browsers = [
+        ('chrome', {'stable': ['Stable'], 'beta': ['Beta'], 'dev': ['Dev']}),
+        ('firefox', {'stable': ['Mozilla Firefox'],
+                     'beta': ['Mozilla Firefox Beta', 'Mozilla Firefox ESR', 'Mozilla Firefox Dev'],
+                     'dev': ['Nightly']}),
+        ('edge', {'stable': ['Stable'], 'beta': ['Beta'], 'dev': ['Dev', 'Canary']}),
+        ('brave', {'stable': ['Stable'], 'beta': ['Beta'], 'dev': ['Dev', 'Nightly']})
+    ]
+
+    def __init__(self, options, timing=None):
+        from browser_archive import InstallerArchive
+        from browser_breaker import CircuitBreaker
+        from browser_download import HttpSession
+        from browser_metrics import Metrics, Timing
+        from browser_scheduler import Scheduler
+        from browser_staging import StagingArea
+        from browser_status import FileLock, StatusStore
+        from browser_throttle import Throttle
+        self.options = options
+        self.timing = timing if timing is not None else Timing()
+        self.metrics = Metrics()
+        self.cache = None
+        if getattr(options, 'cache_dir', None):
+            from browser_cache import InstallerCache
+            self.cache = InstallerCache(options.cache_dir, options.cache_size * 1024 * 1024)
+        if self.dir is None:
+            self.dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'tmp')
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        self.scheduler = Scheduler(options.deadline, options.budget, options.priority)
+        self.throttle = Throttle(options.max_rate * 125000, options.host_rate * 125000,
+                                 options.pause_file, options.pause_lock)
+        self.breaker = CircuitBreaker(self.state_file('breaker'), options.breaker_threshold,
+                                      options.breaker_cooldown)
+        self.redirects = None
+        if options.redirect_ttl > 0:
+            from browser_redirects import RedirectCache
+            self.redirects = RedirectCache(self.state_file('redirects'), options.redirect_ttl)
+        self.session = HttpSession(options.pool_hosts, options.pool_size, self.throttle,
+                                   self.breaker, options.retries, options.connect_timeout,
+                                   options.read_timeout, self.scheduler, self.redirects)
+        self.status_file = self.state_file('install')
+        self.store = StatusStore(self.status_file)
+        self.status = self.store.load()
+        # Held while the status is changed or saved, the install thread updates it while the
+        # main thread saves it at the deadline
+        self.status_lock = threading.Lock()
+        # Channels confirmed up to date that still have to be written to the status file
+        self.touched = set()
+        # Prefetching never installs anything so it doesn't hold up the install runs
+        self.run_lock = FileLock(self.state_file('prefetch' if options.prefetch else 'install',
+                                                 '.lock'))
+        staging_dir = options.staging_dir
+        if not staging_dir:
+            staging_dir = self.default_dir('staging')
+        self.staging = StagingArea(staging_dir)
+        archive_dir = options.archive_dir
+        if not archive_dir:
+            archive_dir = self.default_dir('archive')
+        self.archive = InstallerArchive(archive_dir, options.archive_keep,
+                                        options.archive_size * 1024 * 1024)
+        self.feeds = None
+        if options.feeds:
+            from browser_feeds import ReleaseFeeds
+            self.feeds = ReleaseFeeds(self.session, self.state_file('feeds'),
+                                      {'firefox': options.firefox_feed,
+                                       'chrome': options.chrome_feed,
+                                       'edge': options.edge_feed})
+
+    def state_file(self, name, extension='.json'):
+        """Path of one of the state files of this platform in the tmp directory"""
+        return os.path.join(self.dir, self.file_prefix + name + self.file_suffix + extension)
+
+    def default_dir(self, name):
+        """Where the staging area and archive are kept when no directory is given"""
+        return os.path.join(self.dir, name)
+
+    def channel_name(self, browser, channel):
+        """Name of a channel in the status file and the output (i.e. "Chrome Beta")"""
+        if browser == 'chrome':
+            name = 'Chrome ' + channel
+        elif browser == 'brave':
+            name = 'Brave ' + channel
+        elif browser == 'edge':
+            name = 'Microsoft Edge ' + channel
+        else:
+            name = channel
+        return name
+
+    def task(self, browser, channel):
+        """Describe the download and install of a single browser channel (None if the
+        platform doesn't have it)"""
+        task = None
+        paths = getattr(self, browser + '_path', {})
+        if channel in paths:
+            task = {'browser': browser,
+                    'channel': channel,
+                    'name': self.channel_name(browser, channel),
+                    'url': paths[channel]}
+            self.describe(task)
+        return task
+
+    def describe(self, task):
+        """Add where the platform downloads and installs a channel to its task"""
+        pass
+
+    def get_tasks(self):
+        """List the selected browser channels in the order they should be installed"""
+        tasks = []
+        for browser, levels in self.browsers:
+            if getattr(self.options, browser):
+                for level in ['stable', 'beta', 'dev']:
+                    if getattr(self.options, level):
+                        tasks.extend(self.task(browser, channel) for channel in levels[level])
+        return [task for task in tasks if task is not None]
+
+    def get_validators(self, name):
+        """Get the cache validators recorded for the last install of a channel"""
+        validators = {}
+        entry = self.status.get(name)
+        if isinstance(entry, dict):
+            validators = entry
+        elif entry is not None:
+            # Older status files only recorded the Last-Modified string
+            validators = {'modified': entry}
+        return validators
+
+    def find_task(self, name):
+        """Find the channel with the given name (i.e. "Chrome Beta"), ignoring case"""
+        found = None
+        for browser, _ in self.browsers:
+            for channel in getattr(self, browser + '_path', {}):
+                task = self.task(browser, channel)
+                if task['name'].lower() == name.lower():
+                    found = task
+        if found is None:
+            print("Unknown channel: {0}".format(name))
+        return found
+
+    def save_status(self):
+        """Save the installed state of the various browsers"""
+        with self.status_lock:
+            # Another run (i.e. --prefetch) can update the status file at the same time, so
+            # only the channels this run touched are written, merged into what is on disk
+            entries = {}
+            for name in self.touched:
+                if name in self.status:
+                    entries[name] = self.status[name]
+            if entries:
+                self.store.merge(entries)
+            self.touched = set()
+
+    def set_status(self, name, entry):
+        """Record the installed state of a channel as soon as it changes"""
+        with self.status_lock:
+            entry['checked'] = int(time.time())
+            entry['probed'] = entry['checked']
+            self.status[name] = entry
+            self.store.update(name, entry)
+
+    def mark_checked(self, name, probed=True):
+        """Remember when a channel was last confirmed to be up to date (and if that was
+        with a request to the server rather than from a release feed)"""
+        with self.status_lock:
+            entry = self.status.get(name)
+            if isinstance(entry, dict):
+                entry['checked'] = int(time.time())
+                if probed:
+                    entry['probed'] = entry['checked']
+                self.touched.add(name)
+
+    def mark_unchanged(self, name):
+        """Remember that the server confirmed a channel is up to date from its validators
+        (i.e. with a 304), which also means they are tracking the content again"""
+        with self.status_lock:
+            entry = self.status.get(name)
+            if isinstance(entry, dict):
+                entry.pop('identical', None)
+        self.mark_checked(name)
+
+    def is_fresh(self, name):
+        """Check if a channel was confirmed to be up to date within the --fresh window"""
+        fresh = False
+        entry = self.status.get(name)
+        if self.options.fresh > 0 and isinstance(entry, dict) and 'checked' in entry:
+            age = time.time() - entry['checked']
+            if 0 <= age < self.options.fresh:
+                print("{0} is up to date (checked {1:d}s ago)".format(name, int(age)))
+                fresh = True
+        return fresh
+
+    def is_pinned(self, name):
+        """Check if a channel was rolled back and should not be updated"""
+        entry = self.status.get(name)
+        return isinstance(entry, dict) and entry.get('pinned', False)
+
+    def finish_run(self):
+        """Save the state and report on the run"""
+        from browser_download import report_unreliable_validators
+        self.save_status()
+        report_unreliable_validators(self.status)
+        self.session.log_stats()
+        self.throttle.log_stats()
+        self.breaker.save()
+        if self.redirects is not None:
+            self.redirects.save()
+        if self.cache is not None:
+            self.cache.log_stats()
+        self.metrics.write(self.options.metrics_file, self.options.prometheus_file)
+        self.session.report_failures()
+        self.scheduler.report()
+
+    def unpin(self, name):
+        """Let a rolled back channel be updated again"""
+        task = self.find_task(name)
+        entry = self.status.get(task['name']) if task is not None else None
+        if isinstance(entry, dict) and entry.pop('pinned', None):
+            self.set_status(task['name'], entry)
+            print("{0} will be updated again".format(task['name']))
+
+    def rollback(self, name, number):
+        """Reinstall an archived version of a channel without downloading anything.
+
+        The channel is pinned to that version until it is unpinned."""
+        task = self.find_task(name)
+        if task is None:
+            return
+        current = self.get_validators(task['name']).get('sha256')
+        entry = self.archive.previous(task['name'], number, current)
+        if entry is None:
+            print("No archived version {0:d} installs back for {1}".format(number, task['name']))
+            return
+        print("Rolling {0} back to the version from {1}...".format(
+            task['name'], time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['installed']))))
+        record = self.metrics.begin(task['name'], 'install')
+        ret = self.reinstall(task, entry)
+        self.metrics.end(record, exit_code=ret, outcome='rollback')
+        if ret == 0:
+            validators = dict(entry['validators'])
+            validators['pinned'] = True
+            self.set_status(task['name'], validators)
+        else:
+            print("Rollback of {0} failed: {1}".format(task['name'], ret))
+        self.metrics.write(self.options.metrics_file, self.options.prometheus_file)
+
+    def reinstall(self, task, entry):
+        """Run an archived installer for a channel again"""
+        return self.run_installer(task, entry['path'])
+
+    def lock(self):
+        """Make sure only one install runs at a time, waiting for a running one if --wait"""
+        if self.run_lock.acquire(blocking=False):
+            return True
+        if not self.options.wait:
+            print("Another browser install is already running")
+            return False
+        print("Waiting for the browser install that is already running...")
+        if not self.run_lock.acquire(blocking=True, timeout=3600):
+            return False
+        # Pick up what the other run installed so it isn't downloaded again
+        self.status = self.store.load()
+        return True
+
+    def install(self):
+        """Run the install (in a background thread) until the deadline"""
+        from browser_scheduler import INSTALL_GRACE
+        if not self.lock():
+            return
+        self.timing.mark('lock')
+        try:
+            if self.options.unpin:
+                self.unpin(self.options.unpin)
+            if self.options.rollback:
+                self.rollback(self.options.rollback, self.options.to)
+                return
+            self.scheduler.reset()
+            thread = threading.Thread(target=self.install_thread)
+            thread.daemon = True
+            thread.start()
+            remaining = self.scheduler.remaining()
+            # Leave time for an install that was already running to finish
+            thread.join(remaining + INSTALL_GRACE if remaining is not None else None)
+            if thread.is_alive():
+                logging.warning('Install still running after the deadline, saving the progress')
+                self.save_status()
+                self.session.report_failures()
+                self.scheduler.report()
+        finally:
+            self.run_lock.release()
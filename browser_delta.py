@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Block-level delta transport for installers.
+
+The publisher (the fleet mirror, or this script run against an installer) writes a
+<installer>.blocks index with the hash of every fixed-size block. Clients hash the
+blocks of the installer they kept from the last update, copy every block that is
+unchanged and only fetch the changed byte ranges.
+
+Blocks are only matched at aligned offsets, so an insertion or deletion makes every block
+after it count as changed. An rsync-style rolling checksum would find the shifted blocks
+but scans about 2 MB/s in Python, slower than a full download from a LAN mirror.
+"""
+import hashlib
+import json
+import logging
+import os
+from browser_download import conditional_headers, discard_partial, file_hash, range_validator, \
+    response_validators
+
+BLOCK_SIZE = 64 * 1024
+
+def block_index(path, block_size=BLOCK_SIZE):
+    """Build the block checksum index for a file"""
+    blocks = []
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f_in:
+        while True:
+            block = f_in.read(block_size)
+            if not block:
+                break
+            hasher.update(block)
+            blocks.append(hashlib.md5(block).hexdigest())
+            size += len(block)
+    return {'size': size, 'block_size': block_size, 'sha256': hasher.hexdigest(), 'blocks': blocks}
+
+
+def write_block_index(path, index_file=None):
+    """Publish the block index for a file (next to it by default)"""
+    if index_file is None:
+        index_file = path + '.blocks'
+    index = block_index(path)
+    tmp_file = index_file + '.tmp'
+    with open(tmp_file, 'w') as f_out:
+        json.dump(index, f_out)
+    os.replace(tmp_file, index_file)
+    return index
+
+
+def local_blocks(path, block_size):
+    """Map the hash of every block in a local file to its offset"""
+    blocks = {}
+    offset = 0
+    with open(path, 'rb') as f_in:
+        while True:
+            block = f_in.read(block_size)
+            if not block:
+                break
+            digest = hashlib.md5(block).hexdigest()
+            if digest not in blocks:
+                blocks[digest] = offset
+            offset += len(block)
+    return blocks
+
+
+def download_delta(session, url, dest, validators, base, timeout=300, stats=None):
+    """Rebuild the current version of url in dest from the blocks of a previous version.
+
+    Returns the path of the complete download, the validators of the new content and
+    the HTTP status. The status is None if there is no block index for the URL, none of
+    its blocks are in the previous version or the delta failed and a full download should
+    be used instead."""
+    status = None
+    path = None
+    current = None
+    if stats is None:
+        stats = {}
+    try:
+        response = session.head(url, headers=conditional_headers(validators),
+                                allow_redirects=True, timeout=timeout)
+        if response.status_code == 304:
+            return None, None, 304
+        validator = range_validator(response)
+        if response.status_code != 200 or response.headers.get('Accept-Ranges') != 'bytes' or \
+                validator is None:
+            return None, None, None
+        current = response_validators(response)
+        target = response.url
+        size = int(response.headers.get('Content-Length', -1))
+        index_response = session.get(target + '.blocks', timeout=timeout, stream=True)
+        if index_response.status_code != 200 or \
+                'json' not in index_response.headers.get('Content-Type', ''):
+            index_response.close()
+            logging.debug('No block index for %s', url)
+            return None, None, None
+        index = index_response.json()
+        if index['size'] != size:
+            logging.debug('The block index for %s is out of date', url)
+            return None, None, None
+        block_size = index['block_size']
+        available = local_blocks(base, block_size)
+        reused = len([digest for digest in index['blocks'] if digest in available])
+        if not reused:
+            # Nothing lines up with the previous version (bytes were inserted or removed near
+            # the start), a plain download is the same transfer without the range requests
+            logging.info('No blocks of %s are unchanged, downloading all of it', url)
+            return None, None, None
+        missing = []
+        # dest can be a hard link to a cached or archived installer, start a new file
+        discard_partial(dest)
+        with open(dest, 'wb') as f_out:
+            f_out.truncate(size)
+        with open(base, 'rb') as f_base:
+            with open(dest, 'r+b') as f_out:
+                for number, digest in enumerate(index['blocks']):
+                    start = number * block_size
+                    end = min(start + block_size, size) - 1
+                    if digest in available:
+                        f_base.seek(available[digest])
+                        f_out.seek(start)
+                        f_out.write(f_base.read(end - start + 1))
+                    elif missing and missing[-1][1] == start - 1:
+                        missing[-1] = (missing[-1][0], end)
+                    else:
+                        missing.append((start, end))
+                fetched = 0
+                for start, end in missing:
+                    headers = {'Range': 'bytes={0:d}-{1:d}'.format(start, end),
+                               'If-Range': validator}
+                    part = session.get(target, headers=headers, stream=True, timeout=timeout)
+                    if part.status_code != 206 or not part.headers.get('Content-Range', '')\
+                            .startswith('bytes {0:d}-{1:d}/'.format(start, end)):
+                        part.close()
+                        raise IOError('Server did not return the requested range')
+                    f_out.seek(start)
+                    for chunk in session.iter_content(part, 65536):
+                        f_out.write(chunk)
+                        fetched += len(chunk)
+        sha256 = file_hash(dest)
+        if sha256 != index['sha256']:
+            raise IOError('Rebuilt installer does not match the block index')
+        current['sha256'] = sha256
+        current['size'] = size
+        stats['bytes'] = fetched
+        stats['outcome'] = 'delta'
+        logging.info('Delta update of %s reused %d of %d blocks and fetched %d of %d bytes',
+                     url, reused, len(index['blocks']), fetched, size)
+        status = 200
+        path = dest
+    except Exception as err:
+        logging.warning('Delta download of %s failed: %s', url, err.__str__())
+    if status is None:
+        discard_partial(dest)
+    return path, current, status
+
+##########################################################################
+#   Main Entry Point
+##########################################################################
+def main():
+    """Main entry point"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Publish block indexes for delta updates.',
+                                     prog='browser_delta')
+    parser.add_argument('installers', nargs='+', help="Installers to index.")
+    options = parser.parse_args()
+    for installer in options.installers:
+        index = write_block_index(installer)
+        print("{0}: {1:d} blocks".format(installer, len(index['blocks'])))
+
+if __name__ == '__main__':
+    main()
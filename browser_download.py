@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+# Smallest byte range worth fetching over its own connection
+MIN_SEGMENT_SIZE = 1024 * 1024
+# Server errors worth trying again after a short wait
+RETRY_STATUS = [429, 500, 502, 503, 504]
+# Longest wait between retries in seconds
+MAX_BACKOFF = 30
+# Responses from a cached redirect target that mean it has to be resolved again
+STALE_TARGET_STATUS = [403, 404, 410]
+
+class HostUnavailable(IOError):
+    """Request skipped because the circuit breaker for its host is open"""
+    pass
+
+
+class Cancelled(Exception):
+    """Request or transfer stopped because the run (or its channel) ran out of time"""
+    pass
+
+
+class HttpSession(object):
+    """Keep-alive HTTP session with per-host connection pools, shared by every channel in a run.
+
+    Requests that fail to connect (or get a server error) are retried up to retries
+    times with a jittered exponential backoff. When connect_timeout is set, requests use
+    it to connect and the smaller of their own timeout and read_timeout between reads,
+    so a black-holed host fails in seconds instead of minutes. A CircuitBreaker skips
+    hosts that keep failing and a Scheduler cancels transfers that run out of time.
+    With a RedirectCache, URLs that redirect are requested straight from their last
+    known target (and resolved again when the target is gone or reports a change)."""
+    def __init__(self, pool_hosts=10, pool_size=10, throttle=None, breaker=None, retries=0,
+                 connect_timeout=None, read_timeout=None, scheduler=None, redirects=None):
+        self.pool_hosts = pool_hosts
+        self.pool_size = pool_size
+        self.throttle = throttle
+        self.breaker = breaker
+        self.scheduler = scheduler
+        self.redirects = redirects
+        self.resolved = set()
+        self.retries = retries
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.session = None
+        self.adapters = []
+        self.failures = {}
+
+    def connect(self):
+        """Set up the session the first time it is used (runs that make no requests skip
+        importing requests entirely)"""
+        with self.lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                for prefix in ['http://', 'https://']:
+                    adapter = HTTPAdapter(pool_connections=self.pool_hosts,
+                                          pool_maxsize=self.pool_size)
+                    session.mount(prefix, adapter)
+                    self.adapters.append(adapter)
+                self.session = session
+        return self.session
+
+    def get(self, url, **kwargs):
+        """Issue a GET over the pooled connections"""
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """Issue a HEAD over the pooled connections"""
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """Issue a request, going straight to the cached redirect target of url if there is one"""
+        target = self.redirects.lookup(url) if self.redirects is not None else None
+        if target is not None:
+            try:
+                response = self.send(method, target, **kwargs)
+                headers = kwargs.get('headers') or {}
+                # A change can mean the endpoint moved on to a new target, so it is only
+                # trusted once the URL was resolved in this session
+                changed = response.status_code == 200 and url not in self.resolved and \
+                    ('If-None-Match' in headers or 'If-Modified-Since' in headers)
+                if response.status_code not in STALE_TARGET_STATUS and not changed:
+                    if response.history:
+                        self.redirects.store(url, response.url)
+                    return response
+                response.close()
+                logging.debug('%s returned %d, resolving %s again', target,
+                              response.status_code, url)
+            except IOError as err:
+                logging.debug('%s failed (%s), resolving %s again', target, err.__str__(), url)
+            self.redirects.invalidate(url)
+        response = self.send(method, url, **kwargs)
+        if self.redirects is not None and response.history and \
+                response.status_code in [200, 206, 304]:
+            self.redirects.store(url, response.url)
+            with self.lock:
+                self.resolved.add(url)
+        return response
+
+    def send(self, method, url, **kwargs):
+        """Issue a request, retrying failures and skipping hosts that keep failing"""
+        host = urlparse(url).netloc
+        if self.scheduler is not None:
+            self.scheduler.check()
+        if self.breaker is not None and not self.breaker.allow(host):
+            self.count(host, 'skipped')
+            raise HostUnavailable('Skipping {0}, {1} keeps failing'.format(url, host))
+        if self.connect_timeout is not None:
+            timeout = kwargs.get('timeout')
+            if self.read_timeout is not None and (timeout is None or timeout > self.read_timeout):
+                timeout = self.read_timeout
+            kwargs['timeout'] = (self.connect_timeout, timeout)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = self.connect().request(method, url, **kwargs)
+            except IOError as err:
+                self.failed(host, err.__str__())
+                if attempt > self.retries:
+                    raise
+            else:
+                if response.status_code < 500:
+                    if self.breaker is not None:
+                        self.breaker.record(host, True)
+                    if response.status_code not in RETRY_STATUS or attempt > self.retries:
+                        return response
+                else:
+                    self.failed(host, 'HTTP {0:d}'.format(response.status_code))
+                    if attempt > self.retries:
+                        return response
+                response.close()
+            if self.breaker is not None and not self.breaker.allow(host):
+                self.count(host, 'skipped')
+                raise HostUnavailable('Skipping {0}, {1} keeps failing'.format(url, host))
+            self.count(host, 'retries')
+            # Jittered so agents (and threads) that failed together don't retry together
+            backoff = min(MAX_BACKOFF, 2 ** (attempt - 1))
+            delay = backoff / 2.0 + random.uniform(0, backoff / 2.0)
+            logging.debug('Retrying %s %s in %0.1fs', method, url, delay)
+            time.sleep(delay)
+            if self.scheduler is not None:
+                self.scheduler.check()
+
+    def count(self, host, stat):
+        """Count a failure statistic for a host"""
+        with self.lock:
+            stats = self.failures.setdefault(host, {'failures': 0, 'retries': 0, 'skipped': 0})
+            stats[stat] += 1
+
+    def failed(self, host, error):
+        """Record a failed request to a host"""
+        logging.debug('Request to %s failed: %s', host, error)
+        self.count(host, 'failures')
+        if self.breaker is not None:
+            self.breaker.record(host, False)
+
+    def consume(self, url, size):
+        """Account for bytes received from url against the bandwidth limits (if any), stopping
+        the transfer if it ran out of time"""
+        if self.throttle is not None:
+            self.throttle.consume(url, size)
+        if self.scheduler is not None:
+            self.scheduler.check()
+
+    def iter_content(self, response, chunk_size):
+        """Iterate over a streamed response body, throttled to the bandwidth limits"""
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                self.consume(response.url, len(chunk))
+                yield chunk
+        except IOError as err:
+            # Counted for the report but not against the circuit breaker: the host did answer,
+            # and dropped connections (several at once with parallel downloads) are resumed.
+            # The resume request counts if the host really stopped working.
+            host = urlparse(response.url).netloc
+            logging.debug('Transfer from %s failed: %s', host, err.__str__())
+            self.count(host, 'failures')
+            raise
+
+    def stats(self):
+        """Count the requests and new connections made by each host pool"""
+        stats = {}
+        for adapter in self.adapters:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    host = '{0}://{1}:{2}'.format(pool.scheme, pool.host, pool.port)
+                    stats[host] = {'requests': pool.num_requests,
+                                   'connections': pool.num_connections,
+                                   'reused': max(pool.num_requests - pool.num_connections, 0)}
+        return stats
+
+    def log_stats(self):
+        """Log how many requests were served over reused connections"""
+        total_requests = 0
+        total_reused = 0
+        for host, stats in sorted(self.stats().items()):
+            total_requests += stats['requests']
+            total_reused += stats['reused']
+            logging.info('%s: %d requests over %d connections (%d reused)', host,
+                         stats['requests'], stats['connections'], stats['reused'])
+        logging.info('HTTP connection reuse: %d of %d requests', total_reused, total_requests)
+
+    def report_failures(self):
+        """Print the failures, retries and skipped requests of every host that had any"""
+        for host, stats in sorted(self.failures.items()):
+            print("{0}: {1:d} failures, {2:d} retries, {3:d} requests skipped".format(
+                host, stats['failures'], stats['retries'], stats['skipped']))
+
+    def close(self):
+        """Close all of the pooled connections"""
+        if self.session is not None:
+            self.session.close()
+
+
+def conditional_headers(validators):
+    """Build the conditional request headers for the given validators"""
+    headers = {}
+    if validators.get('modified') is not None:
+        headers['If-Modified-Since'] = validators['modified']
+    if validators.get('etag') is not None:
+        headers['If-None-Match'] = validators['etag']
+    return headers
+
+
+def response_validators(response):
+    """Extract the cache validators from a response"""
+    validators = {'validator': None}
+    if 'Last-Modified' in response.headers:
+        validators['modified'] = response.headers['Last-Modified']
+        validators['validator'] = 'last-modified'
+    elif 'Date' in response.headers:
+        validators['modified'] = response.headers['Date']
+        validators['validator'] = 'date'
+    if 'ETag' in response.headers:
+        validators['etag'] = response.headers['ETag']
+        validators['validator'] = 'etag'
+    return validators
+
+
+def file_hash(path, hasher=None):
+    """Calculate the SHA-256 of a file (or add the file to an existing hasher)"""
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(path, 'rb') as f_in:
+        while True:
+            chunk = f_in.read(1024 * 1024)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def content_changed(previous, current):
+    """Check if a downloaded installer differs from the one that was last installed.
+
+    When the content is the same the count of identical downloads is carried over
+    (and incremented) in current so servers with unreliable validators can be reported.
+    A real change starts the count over."""
+    changed = True
+    if current.get('sha256') is not None and current['sha256'] == previous.get('sha256'):
+        changed = False
+        current['identical'] = previous.get('identical', 0) + 1
+    else:
+        current.pop('identical', None)
+    return changed
+
+
+def unreliable_validators(status):
+    """List the channels whose servers send validators that do not track content changes"""
+    channels = []
+    for name in status:
+        entry = status[name]
+        if isinstance(entry, dict) and not entry.get('scanned') and \
+                (('validator' in entry and entry['validator'] in ['date', None]) or
+                 entry.get('identical', 0) > 0):
+            channels.append(name)
+    return channels
+
+
+def report_unreliable_validators(status):
+    """Print the channels that were downloaded without actually changing"""
+    for name in unreliable_validators(status):
+        entry = status[name]
+        if entry.get('validator') == 'etag' or entry.get('validator') == 'last-modified':
+            reason = 'validator changed without the content changing'
+        else:
+            reason = 'no ETag or Last-Modified'
+        print("Unreliable validators for {0}: {1} ({2:d} identical downloads)".format(
+            name, reason, entry.get('identical', 0)))
+
+
+def range_validator(response):
+    """Get a validator that can be used with If-Range to resume the response body"""
+    validator = None
+    etag = response.headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        validator = etag
+    elif 'Last-Modified' in response.headers:
+        validator = response.headers['Last-Modified']
+    return validator
+
+
+def load_partial(dest, url):
+    """Load the progress recorded for an interrupted download of url into dest"""
+    partial = None
+    sidecar = dest + '.partial'
+    try:
+        if os.path.isfile(sidecar) and os.path.isfile(dest):
+            with open(sidecar, 'r') as f_in:
+                partial = json.load(f_in)
+            if partial.get('url') != url or partial.get('validator') is None:
+                partial = None
+            else:
+                partial['bytes'] = os.path.getsize(dest)
+    except Exception:
+        partial = None
+    return partial
+
+
+def save_partial(dest, url, validators, validator, received):
+    """Record the progress of a download so it can be resumed later"""
+    try:
+        with open(dest + '.partial', 'w') as f_out:
+            json.dump({'url': url, 'validators': validators, 'validator': validator,
+                       'bytes': received}, f_out)
+    except Exception:
+        pass
+
+
+def discard_partial(dest):
+    """Remove a download and any recorded progress for it"""
+    for path in [dest, dest + '.partial']:
+        if os.path.isfile(path):
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+
+
+def download_segmented(session, url, dest, validators, segments, timeout=300, probe=None):
+    """Download url to dest over several parallel byte-range requests.
+
+    The size and range support come from a HEAD request, or from probe if a HEAD with
+    the same validators was already made (i.e. when checking the channel for updates).
+
+    Returns the path of the complete download, the validators of the new content and
+    the HTTP status. The status is None if the server does not support ranges or a
+    segment failed and a single-stream download should be used instead."""
+    import base64
+    status = None
+    path = None
+    current = None
+    try:
+        response = probe
+        if response is None:
+            response = session.head(url, headers=conditional_headers(validators),
+                                    allow_redirects=True, timeout=timeout)
+        if response.status_code == 304:
+            return None, None, 304
+        size = int(response.headers.get('Content-Length', 0))
+        validator = range_validator(response)
+        if response.status_code != 200 or response.headers.get('Accept-Ranges') != 'bytes' or \
+                validator is None or size < segments * MIN_SEGMENT_SIZE:
+            return None, None, None
+        current = response_validators(response)
+        # Request the resolved URL so every segment comes from the same server
+        target = response.url
+        # Start a new file instead of writing over whatever dest was left behind, which can
+        # be a hard link to an installer in the cache or the archive
+        discard_partial(dest)
+        with open(dest, 'wb') as f_out:
+            f_out.truncate(size)
+        segment_size = (size + segments - 1) // segments
+        ranges = [(start, min(start + segment_size, size) - 1)
+                  for start in range(0, size, segment_size)]
+        failed = []
+        # Segments run in their own threads but on the time budget of the channel
+        owner = session.scheduler.current() if session.scheduler is not None else None
+
+        def fetch_segment(start, end):
+            """Fetch a single byte range into its place in the file"""
+            if owner is not None:
+                session.scheduler.attach(owner)
+            try:
+                headers = {'Range': 'bytes={0:d}-{1:d}'.format(start, end), 'If-Range': validator}
+                segment = session.get(target, headers=headers, stream=True, timeout=timeout)
+                if segment.status_code != 206 or not segment.headers.get('Content-Range', '')\
+                        .startswith('bytes {0:d}-{1:d}/'.format(start, end)):
+                    segment.close()
+                    raise IOError('Server did not return the requested range')
+                position = start
+                with open(dest, 'r+b') as f_out:
+                    f_out.seek(start)
+                    for chunk in session.iter_content(segment, 65536):
+                        f_out.write(chunk)
+                        position += len(chunk)
+                if position != end + 1:
+                    raise IOError('Incomplete segment {0:d}-{1:d}'.format(start, end))
+            except Exception as err:
+                logging.warning('Segment %d-%d of %s failed: %s', start, end, url, err.__str__())
+                failed.append((start, end))
+
+        logging.debug('Downloading %s to %s in %d segments', url, dest, len(ranges))
+        threads = []
+        for start, end in ranges:
+            thread = threading.Thread(target=fetch_segment, args=(start, end))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if not failed and os.path.getsize(dest) == size:
+            current['sha256'] = file_hash(dest)
+            current['size'] = size
+            # Google's CDN publishes an MD5 of the object that can be checked as well
+            expected_md5 = None
+            for value in response.headers.get('X-Goog-Hash', '').split(','):
+                value = value.strip()
+                if value.startswith('md5='):
+                    expected_md5 = value[4:]
+            if expected_md5 is not None:
+                hasher = hashlib.md5()
+                file_hash(dest, hasher)
+                if base64.b64encode(hasher.digest()).decode('ascii') != expected_md5:
+                    raise IOError('MD5 mismatch for the segmented download of ' + url)
+            status = 200
+            path = dest
+    except Exception as err:
+        logging.warning('Segmented download of %s failed: %s', url, err.__str__())
+    if status is None:
+        discard_partial(dest)
+    return path, current, status
+
+
+def download_file(session, url, dest, validators, timeout=300, attempts=3, segments=1,
+                  cache=None, stats=None, base=None, probe=None):
+    """Download url to dest if it changed since validators, resuming interrupted downloads.
+
+    Large downloads are split into parallel byte ranges when segments is more than one
+    and the server supports it. When an installer cache is provided the cached copy of
+    the installer is used whenever the server reports that it has not changed. When the
+    path of the previous version of the installer is provided as base and the server
+    publishes a block index, only the blocks that changed are downloaded. The response to
+    a HEAD request for url with the same validators can be passed as probe so a segmented
+    download doesn't send another one.
+
+    If a stats dictionary is provided it is filled in with the HTTP status, the bytes
+    transferred and the outcome (downloaded, resumed, segmented, delta, cache,
+    not-modified or error).
+
+    Returns the path of the complete download (or None if it did not change or failed)
+    and the validators of the new content, including the SHA-256 and size of the file."""
+    if stats is None:
+        stats = {}
+    entry = None
+    request_validators = validators
+    if cache is not None:
+        entry = cache.lookup(url)
+        if entry is not None and entry.get('sha256') != validators.get('sha256'):
+            # Ask if the cached copy is current instead of the installed one
+            request_validators = entry
+            probe = None
+    path, current, status = fetch_file(session, url, dest, request_validators, timeout,
+                                       attempts, segments, stats, base, probe)
+    if cache is not None:
+        if path is None and status == 304 and request_validators is entry:
+            path, current = cache.get(url, entry, dest)
+            if path is not None:
+                stats['outcome'] = 'cache'
+                return path, current
+            # The cached copy is damaged (or was removed in the meantime), download it again
+            path, current, status = fetch_file(session, url, dest, validators, timeout,
+                                               attempts, segments, stats, base)
+        if path is not None:
+            cache.add(url, path, current)
+    return path, current
+
+
+def fetch_file(session, url, dest, validators, timeout=300, attempts=3, segments=1, stats=None,
+               base=None, probe=None):
+    """Download url to dest if it changed since validators.
+
+    Returns the path of the complete download (or None), the validators of the
+    new content and the last HTTP status."""
+    path = None
+    current = None
+    status = None
+    attempt = 0
+    if stats is None:
+        stats = {}
+    stats['bytes'] = 0
+    stats['outcome'] = 'error'
+    if base is not None and os.path.isfile(base) and load_partial(dest, url) is None:
+        from browser_delta import download_delta
+        path, current, status = download_delta(session, url, dest, validators, base, timeout,
+                                               stats)
+        if status is not None:
+            stats['status'] = status
+            if status == 304:
+                stats['outcome'] = 'not-modified'
+            return path, current, status
+    if segments > 1 and load_partial(dest, url) is None:
+        path, current, status = download_segmented(session, url, dest, validators, segments,
+                                                   timeout, probe)
+        if status is not None:
+            stats['status'] = status
+            if status == 304:
+                stats['outcome'] = 'not-modified'
+            elif path is not None:
+                stats['outcome'] = 'segmented'
+                stats['bytes'] = current['size']
+            return path, current, status
+    while path is None and attempt < attempts:
+        attempt += 1
+        headers = conditional_headers(validators)
+        partial = load_partial(dest, url)
+        if partial is not None and partial['bytes'] > 0:
+            # If-Range makes the server send the whole file if it changed since the partial
+            headers['Range'] = 'bytes={0:d}-'.format(partial['bytes'])
+            headers['If-Range'] = partial['validator']
+        elif os.path.isfile(dest) or os.path.isfile(dest + '.partial'):
+            discard_partial(dest)
+            partial = None
+        received = 0
+        validator = None
+        try:
+            logging.debug('Downloading %s to %s', url, dest)
+            response = session.get(url, headers=headers, stream=True, timeout=timeout)
+            status = response.status_code
+            stats['status'] = status
+            if response.status_code in [206, 416] and partial is not None and \
+                    not response.headers.get('Content-Range', '').startswith(
+                        'bytes {0:d}-'.format(partial['bytes'])):
+                # The partial file does not line up with the current resource, start over
+                response.close()
+                discard_partial(dest)
+                attempt -= 1
+                continue
+            hasher = hashlib.sha256()
+            if response.status_code == 206 and partial is not None:
+                logging.debug('Resuming %s at %d bytes', url, partial['bytes'])
+                current = partial['validators']
+                received = partial['bytes']
+                file_hash(dest, hasher)
+                mode = 'ab'
+            elif response.status_code == 200:
+                current = response_validators(response)
+                mode = 'wb'
+                if partial is not None:
+                    discard_partial(dest)
+            else:
+                if response.status_code == 304:
+                    discard_partial(dest)
+                    stats['outcome'] = 'not-modified'
+                response.close()
+                break
+            if mode == 'wb':
+                validator = range_validator(response)
+            else:
+                validator = partial['validator']
+            if validator is not None:
+                save_partial(dest, url, current, validator, received)
+            offset = received
+            with open(dest, mode) as f_out:
+                for chunk in session.iter_content(response, 4096):
+                    f_out.write(chunk)
+                    hasher.update(chunk)
+                    received += len(chunk)
+                    stats['bytes'] += len(chunk)
+            expected = response.headers.get('Content-Length')
+            if expected is not None and received - offset != int(expected):
+                raise IOError('Incomplete download: {0:d} of {1} bytes'.format(received - offset,
+                                                                               expected))
+            if os.path.isfile(dest + '.partial'):
+                os.remove(dest + '.partial')
+            current = dict(current)
+            current['sha256'] = hasher.hexdigest()
+            current['size'] = received
+            stats['outcome'] = 'resumed' if mode == 'ab' else 'downloaded'
+            path = dest
+        except Exception as err:
+            msg = ''
+            if err is not None and err.__str__() is not None:
+                msg = err.__str__()
+            if isinstance(err, (HostUnavailable, Cancelled)):
+                logging.warning("Download failed: %s", msg)
+            else:
+                logging.exception("Download failed: %s", msg)
+            if received > 0 and validator is not None:
+                # Keep what was received so the next attempt (or run) can pick up from there
+                save_partial(dest, url, current, validator, received)
+            elif partial is None:
+                discard_partial(dest)
+            if received == 0 or isinstance(err, Cancelled):
+                # Only retry right away when the transfer was making progress
+                break
+    return path, current, status
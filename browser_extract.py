@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Streaming extraction of browser packages.
+
+Tarballs and .deb packages are unpacked straight from the HTTP response into a
+staging directory as they download, without writing the archive to disk first.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tarfile
+from browser_download import Cancelled, HostUnavailable, conditional_headers, response_validators
+
+class StreamReader(object):
+    """File-like wrapper that hashes and counts everything read from a response body.
+
+    consume (if provided) is called with the size of every read so the download can be
+    throttled or paused while it is being extracted."""
+    def __init__(self, raw, stats=None, consume=None):
+        self.raw = raw
+        self.consume = consume
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.stats = stats if stats is not None else {}
+
+    def read(self, size=-1):
+        """Read up to size bytes (everything that is left if size is negative)"""
+        data = self.raw.read(size if size is not None and size >= 0 else None)
+        if data:
+            self.hasher.update(data)
+            self.size += len(data)
+            self.stats['bytes'] = self.stats.get('bytes', 0) + len(data)
+            if self.consume is not None:
+                self.consume(len(data))
+        return data
+
+    def drain(self):
+        """Read (and hash) whatever the extraction did not need"""
+        while self.read(65536):
+            pass
+
+
+class LimitedReader(object):
+    """File-like view of the next size bytes of a stream (a single member of an ar archive)"""
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.remaining = size
+
+    def read(self, size=-1):
+        """Read up to size bytes without going past the end of the member"""
+        data = b''
+        if self.remaining > 0:
+            if size is None or size < 0 or size > self.remaining:
+                size = self.remaining
+            data = self.stream.read(size)
+            self.remaining -= len(data)
+        return data
+
+    def drain(self):
+        """Skip the rest of the member"""
+        while self.read(65536):
+            pass
+
+
+def read_exact(stream, size):
+    """Read exactly size bytes from a stream (fewer only at the end of the stream)"""
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def tar_filter(member, dest):
+    """Check a tar member before extracting it, returning None to skip it.
+
+    Anything that would end up outside of dest is skipped, including the absolute
+    symlinks packages install into /usr/bin (the browser itself does not need them)."""
+    if hasattr(tarfile, 'data_filter'):
+        try:
+            member = tarfile.data_filter(member, dest)
+        except tarfile.FilterError as err:
+            logging.debug('Skipping %s: %s', member.name, err.__str__())
+            member = None
+    else:
+        name = os.path.normpath(member.name)
+        if os.path.isabs(name) or name.startswith('..') or member.isdev():
+            member = None
+        elif (member.issym() or member.islnk()) and \
+                (os.path.isabs(member.linkname) or '..' in member.linkname.split('/')):
+            member = None
+    return member
+
+
+def extract_tar(fileobj, dest):
+    """Extract a (gzip, bzip2 or xz compressed) tar stream into dest"""
+    options = {}
+    if hasattr(tarfile, 'fully_trusted_filter'):
+        # Every member already went through tar_filter
+        options['filter'] = 'fully_trusted'
+    tar = tarfile.open(fileobj=fileobj, mode='r|*')
+    try:
+        for member in tar:
+            member = tar_filter(member, dest)
+            if member is not None:
+                tar.extract(member, dest, **options)
+    finally:
+        tar.close()
+
+
+def extract_deb(fileobj, dest):
+    """Extract the files of a .deb package stream (the data.tar member) into dest"""
+    if read_exact(fileobj, 8) != b'!<arch>\n':
+        raise IOError('Not a Debian package')
+    extracted = False
+    while True:
+        header = read_exact(fileobj, 60)
+        if len(header) < 60:
+            break
+        name = header[0:16].decode('ascii').strip().rstrip('/')
+        size = int(header[48:58].decode('ascii').strip())
+        member = LimitedReader(fileobj, size)
+        if name.startswith('data.tar'):
+            if name.endswith('.zst'):
+                try:
+                    import zstandard
+                except ImportError:
+                    raise IOError('zstandard is required to extract {0}'.format(name))
+                extract_tar(zstandard.ZstdDecompressor().stream_reader(member), dest)
+            else:
+                extract_tar(member, dest)
+            extracted = True
+        member.drain()
+        # Members are aligned on 2-byte boundaries
+        if size % 2:
+            read_exact(fileobj, 1)
+    if not extracted:
+        raise IOError('No data.tar in the Debian package')
+
+
+def stream_install(session, url, validators, dest, kind, timeout=300, stats=None):
+    """Download url if it changed since validators, extracting it into dest as it arrives.
+
+    kind is 'deb' for Debian packages or 'tar' for (compressed) tarballs. If a stats
+    dictionary is provided it is filled in with the HTTP status, the bytes transferred
+    and the outcome (streamed, not-modified or error).
+
+    Returns the path of the extracted files (or None if the package did not change or
+    failed), the validators of the new content (including the SHA-256 and size of the
+    package) and the HTTP status."""
+    path = None
+    current = None
+    status = None
+    if stats is None:
+        stats = {}
+    stats['bytes'] = 0
+    stats['outcome'] = 'error'
+    try:
+        logging.debug('Streaming %s into %s', url, dest)
+        response = session.get(url, headers=conditional_headers(validators), stream=True,
+                               timeout=timeout)
+        status = response.status_code
+        stats['status'] = status
+        try:
+            if status == 304:
+                stats['outcome'] = 'not-modified'
+            elif status == 200:
+                current = response_validators(response)
+                response.raw.decode_content = True
+                reader = StreamReader(response.raw, stats,
+                                      lambda size: session.consume(url, size))
+                if os.path.isdir(dest):
+                    shutil.rmtree(dest)
+                os.makedirs(dest)
+                if kind == 'deb':
+                    extract_deb(reader, dest)
+                else:
+                    extract_tar(reader, dest)
+                reader.drain()
+                expected = response.headers.get('Content-Length')
+                if expected is not None and 'Content-Encoding' not in response.headers and \
+                        reader.size != int(expected):
+                    raise IOError('Incomplete download: {0:d} of {1} bytes'.format(reader.size,
+                                                                                   expected))
+                current['sha256'] = reader.hasher.hexdigest()
+                current['size'] = reader.size
+                stats['outcome'] = 'streamed'
+                path = dest
+            else:
+                logging.warning('Streaming install of %s failed: HTTP %d', url, status)
+        finally:
+            response.close()
+    except Exception as err:
+        if isinstance(err, (HostUnavailable, Cancelled)):
+            logging.warning("Streaming install of %s failed: %s", url, err.__str__())
+        else:
+            logging.exception("Streaming install of %s failed: %s", url, err.__str__())
+    if path is None and os.path.isdir(dest):
+        shutil.rmtree(dest, ignore_errors=True)
+    return path, current, status
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Release feeds published by the browser vendors.
+
+Each feed covers every channel of a browser in a single small document, so the
+current version of every channel can be found with one request per vendor instead
+of one request per installer. Brave does not publish one and is always probed.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from browser_download import conditional_headers, response_validators
+
+FEED_URLS = {
+    'firefox': 'https://product-details.mozilla.org/1.0/firefox_versions.json',
+    'chrome': 'https://versionhistory.googleapis.com/v1/chrome/platforms/all/channels/all/'\
+              'versions/all/releases?filter=endtime=none',
+    'edge': 'https://edgeupdates.microsoft.com/api/products'
+}
+
+# product-details keys for every Firefox channel (named the same as the installers)
+FIREFOX_KEYS = {
+    'Mozilla Firefox': 'LATEST_FIREFOX_VERSION',
+    'Mozilla Firefox ESR': 'FIREFOX_ESR',
+    'Mozilla Firefox Beta': 'LATEST_FIREFOX_DEVEL_VERSION',
+    'Mozilla Firefox Dev': 'FIREFOX_DEVEDITION',
+    'Nightly': 'FIREFOX_NIGHTLY'
+}
+
+# Edge feed platform and architecture for each installer platform
+EDGE_PLATFORMS = {
+    'win64': ('Windows', 'x64'),
+    'win': ('Windows', 'x86'),
+    'mac': ('MacOS', 'universal'),
+    'linux': ('Linux', 'x64')
+}
+
+# How long the feeds alone are trusted before a channel is checked with a real request
+VERIFY_INTERVAL = 24 * 60 * 60
+
+def version_key(version):
+    """Sort key for a dotted version number (or a Debian package version, without its epoch),
+    comparing the runs of digits as numbers"""
+    return [int(part) for part in re.findall(r'\d+', version.split(':', 1)[-1])]
+
+
+def feed_confirms(version, validators):
+    """Check if the version from a release feed is the one that was installed.
+
+    The version recorded for an install is the feed version when it was downloaded,
+    which can be off if the feed and the download server disagree for a while, so a
+    channel still gets a real check at least every VERIFY_INTERVAL."""
+    return version is not None and validators.get('version') == version and \
+        time.time() - validators.get('probed', 0) < VERIFY_INTERVAL
+
+
+class ReleaseFeeds(object):
+    """Current version of every browser channel, from the vendor release feeds.
+
+    The feeds are cached (with their validators) in cache_file so they are only
+    downloaded again when they change."""
+    def __init__(self, session, cache_file, urls=None):
+        self.session = session
+        self.cache_file = cache_file
+        self.urls = dict(FEED_URLS)
+        if urls is not None:
+            for browser in urls:
+                if urls[browser]:
+                    self.urls[browser] = urls[browser]
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.feeds = {}
+        try:
+            if os.path.isfile(cache_file):
+                with open(cache_file, 'r') as f_in:
+                    self.cache = json.load(f_in)
+        except Exception:
+            logging.exception('Error loading the release feed cache')
+
+    def fetch(self, browser):
+        """Get the current release feed for a browser (None if it is not available)"""
+        url = self.urls[browser]
+        with self.lock:
+            cached = self.cache.get(url)
+        feed = None
+        try:
+            headers = conditional_headers(cached) if cached is not None else {}
+            response = self.session.get(url, headers=headers, timeout=30)
+            if response.status_code == 304 and cached is not None:
+                logging.debug('Release feed for %s has not changed', browser)
+                feed = cached['feed']
+            elif response.status_code == 200:
+                feed = response.json()
+                entry = response_validators(response)
+                entry['feed'] = feed
+                with self.lock:
+                    self.cache[url] = entry
+            else:
+                logging.warning('Error fetching the %s release feed: HTTP %d', browser,
+                                response.status_code)
+        except Exception as err:
+            logging.warning('Error fetching the %s release feed: %s', browser, err.__str__())
+        return feed
+
+    def refresh(self, browsers):
+        """Fetch the feeds for the given browsers (once per run, at the same time)"""
+        threads = []
+        for browser in browsers:
+            if browser in self.urls:
+                thread = threading.Thread(target=self.refresh_feed, args=(browser,))
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.save()
+
+    def refresh_feed(self, browser):
+        """Fetch a single feed"""
+        feed = self.fetch(browser)
+        with self.lock:
+            self.feeds[browser] = feed
+
+    def save(self):
+        """Write the feed cache atomically"""
+        try:
+            tmp_file = self.cache_file + '.{0:d}.tmp'.format(os.getpid())
+            with self.lock:
+                with open(tmp_file, 'w') as f_out:
+                    json.dump(self.cache, f_out)
+            os.replace(tmp_file, self.cache_file)
+        except Exception:
+            logging.exception('Error saving the release feed cache')
+
+    def firefox_versions(self):
+        """Current version of every Firefox channel"""
+        versions = {}
+        feed = self.feeds.get('firefox')
+        if isinstance(feed, dict):
+            for channel in FIREFOX_KEYS:
+                if feed.get(FIREFOX_KEYS[channel]):
+                    versions[channel] = feed[FIREFOX_KEYS[channel]]
+        return versions
+
+    def chrome_versions(self, platform):
+        """Current version of every Chrome channel on a platform (win64, win, mac or linux).
+
+        When more than one release of a channel is serving (a staged rollout) the one
+        serving the largest fraction of users is used."""
+        versions = {}
+        best = {}
+        feed = self.feeds.get('chrome')
+        if isinstance(feed, dict):
+            for release in feed.get('releases', []):
+                # chrome/platforms/<platform>/channels/<channel>/versions/<version>/releases/<id>
+                parts = release.get('name', '').split('/')
+                if len(parts) < 6 or parts[2] != platform or not release.get('version'):
+                    continue
+                channel = parts[4].capitalize()
+                rank = (release.get('fraction', 0), version_key(release['version']))
+                if channel not in best or rank > best[channel]:
+                    best[channel] = rank
+                    versions[channel] = release['version']
+        return versions
+
+    def edge_versions(self, platform):
+        """Current version of every Edge channel on a platform (win64, win, mac or linux)"""
+        versions = {}
+        feed = self.feeds.get('edge')
+        if isinstance(feed, list) and platform in EDGE_PLATFORMS:
+            feed_platform, architecture = EDGE_PLATFORMS[platform]
+            for product in feed:
+                channel = product.get('Product')
+                for release in product.get('Releases', []):
+                    if release.get('Platform') == feed_platform and \
+                            release.get('Architecture') == architecture and \
+                            release.get('ProductVersion'):
+                        version = release['ProductVersion']
+                        if channel not in versions or \
+                                version_key(version) > version_key(versions[channel]):
+                            versions[channel] = version
+        return versions
+
+    def versions(self, browser, platform):
+        """Current version of every channel of a browser on a platform"""
+        versions = {}
+        if browser == 'firefox':
+            versions = self.firefox_versions()
+        elif browser == 'chrome':
+            versions = self.chrome_versions(platform)
+        elif browser == 'edge':
+            versions = self.edge_versions(platform)
+        return versions
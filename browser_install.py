@@ -17,228 +17,430 @@ limitations under the License.
 import json
 import logging
 import os
-import platform
+import re
 import time
-import requests
+from browser_common import STARTED, InstallBase, add_common_options, add_installer_options, \
+    run_parallel, setup_logging
+from browser_download import Cancelled, HttpSession, conditional_headers, content_changed, \
+    download_file, response_validators
+from browser_feeds import feed_confirms
+from browser_metrics import Metrics, Timing
+from browser_scan import find_version, installed_version, scanned_entry
 
-class Install(object):
-    """Main installer logic"""
-    def __init__(self, options):
-        self.options = options
-        if platform.machine().endswith('64'):
-            firefox_os = 'win64'
-            self.chrome_path = {
-                'Stable': 'https://dl.google.com/tag/s/'\
-                          'appguid%3D%7B8A69D345-D564-463C-AFF1-A69D9E530F96%7D%26'\
-                          'iid%3D%7B3C078BAD-5ACB-D945-6C84-7F778A6383F1%7D%26lang%3Den%26'\
-                          'browser%3D4%26usagestats%3D0%26appname%3DGoogle%2520Chrome%26'\
-                          'needsadmin%3Dtrue%26ap%3Dx64-stable-statsdef_1%26'\
-                          'installdataindex%3Ddefaultbrowser'\
-                          '/chrome/install/ChromeStandaloneSetup64.exe',
-                'Beta': 'https://dl.google.com/tag/s/'\
-                        'appguid%3D%7B8237E44A-0054-442C-B6B6-EA0509993955%7D%26'\
-                        'iid%3D%7B8F94C426-F48E-944F-58B4-56AC548C0A6F%7D%26lang%3Den%26'\
-                        'browser%3D4%26usagestats%3D0%26appname%3DChrome%2520Beta%26'\
-                        'needsadmin%3Dtrue%26ap%3D-arch_x64-statsdef_1%26'\
-                        'installdataindex%3Dempty'\
-                        '/chrome/install/beta/ChromeBetaStandaloneSetup64.exe',
-                'Dev': 'https://dl.google.com/tag/s/'\
-                       'appguid%3D%7B401C381F-E0DE-4B85-8BD8-3F3F14FBDA57%7D%26'\
-                       'iid%3D%7B3C078BAD-5ACB-D945-6C84-7F778A6383F1%7D%26lang%3Den%26'\
-                       'browser%3D4%26usagestats%3D0%26appname%3DGoogle%2520Chrome%2520Dev%26'\
-                       'needsadmin%3Dtrue%26ap%3D-arch_x64-statsdef_1%26'\
-                       'installdataindex%3Dempty'\
-                       '/chrome/install/dev/ChromeDevStandaloneSetup64.exe'
-            }
-            self.brave_path = {
-                'Stable': 'https://laptop-updates.brave.com/latest/winx64',
-                'Beta': 'https://brave-browser-downloads.s3.brave.com/latest/BraveBrowserBetaSetup.exe',
-                'Dev': 'https://brave-browser-downloads.s3.brave.com/latest/BraveBrowserDevSetup.exe',
-                'Nightly': 'https://laptop-updates.brave.com/latest/winx64/nightly'
-            }
-        else:
-            firefox_os = 'win'
-            self.chrome_path = {
-                'Stable': 'https://dl.google.com/tag/s/'\
-                          'appguid%3D%7B8A69D345-D564-463C-AFF1-A69D9E530F96%7D%26'\
-                          'iid%3D%7B3C078BAD-5ACB-D945-6C84-7F778A6383F1%7D%26lang%3D'\
-                          'en%26browser%3D4%26usagestats%3D0%26appname%3DGoogle%2520Chrome%26'\
-                          'needsadmin%3Dtrue%26ap%3Dstable-arch_x86-statsdef_1%26'\
-                          'installdataindex%3Ddefaultbrowser'\
-                          '/chrome/install/ChromeStandaloneSetup.exe',
-                'Beta': 'https://dl.google.com/tag/s/'\
-                        'appguid%3D%7B8237E44A-0054-442C-B6B6-EA0509993955%7D%26'\
-                        'iid%3D%7B8F94C426-F48E-944F-58B4-56AC548C0A6F%7D%26lang%3Den%26'\
-                        'browser%3D4%26usagestats%3D0%26appname%3DChrome%2520Beta%26'\
-                        'needsadmin%3Dtrue%26ap%3D-arch_x86-statsdef_1%26'\
-                        'installdataindex%3Dempty'\
-                        '/chrome/install/beta/ChromeBetaStandaloneSetup.exe',
-                'Dev': 'https://dl.google.com/tag/s/'\
-                       'appguid%3D%7B401C381F-E0DE-4B85-8BD8-3F3F14FBDA57%7D%26'\
-                       'iid%3D%7B3C078BAD-5ACB-D945-6C84-7F778A6383F1%7D%26lang%3Den%26'\
-                       'browser%3D4%26usagestats%3D0%26appname%3DGoogle%2520Chrome%2520Dev%26'\
-                       'needsadmin%3Dtrue%26ap%3D-arch_x86-statsdef_1%26'\
-                       'installdataindex%3Dempty'\
-                       '/chrome/install/dev/ChromeDevStandaloneSetup.exe'
-            }
-            self.brave_path = {
-                'Stable': 'https://laptop-updates.brave.com/latest/winia32',
-                'Beta': 'https://brave-browser-downloads.s3.brave.com/latest/BraveBrowserBetaSetup32.exe',
-                'Dev': 'https://brave-browser-downloads.s3.brave.com/latest/BraveBrowserDevSetup32.exe',
-                'Nightly': 'https://laptop-updates.brave.com/latest/winia32/nightly'
-            }
-
-        firefox_url = 'http://download.mozilla.org/?product={0}&lang=en-US&os=' + firefox_os
-        self.firefox_path = {
-            'Mozilla Firefox': firefox_url.format('firefox-latest'),
-            'Mozilla Firefox ESR': firefox_url.format('firefox-esr-latest'),
-            'Mozilla Firefox Beta': firefox_url.format('firefox-beta-latest'),
-            'Mozilla Firefox Dev': firefox_url.format('firefox-devedition-latest'),
-            'Nightly': firefox_url.format('firefox-nightly-latest')
+# Installers of Chromium-based browsers refuse to install over a newer version, so a rollback
+# uninstalls the channel first with the setup.exe of the installed version and these switches
+UNINSTALL_SWITCHES = {
+    'chrome': {'Stable': '', 'Beta': '--chrome-beta', 'Dev': '--chrome-dev'},
+    'brave': {'Stable': '', 'Beta': '--chrome-beta', 'Dev': '--chrome-dev',
+              'Nightly': '--chrome-sxs'},
+    'edge': {'Stable': '--msedge', 'Dev': '--msedge-dev', 'Canary': '--msedge-sxs'}
+}
+
+def browser_paths(is_64bit):
+    """Installer download URLs for every browser channel on 32 or 64-bit Windows"""
+    if is_64bit:
+        firefox_os = 'win64'
+        chrome_path = {
+            'Stable': 'https://dl.google.com/tag/s/'\
+                      'appguid%3D%7B8A69D345-D564-463C-AFF1-A69D9E530F96%7D%26'\
+                      'iid%3D%7B3C078BAD-5ACB-D945-6C84-7F778A6383F1%7D%26lang%3Den%26'\
+                      'browser%3D4%26usagestats%3D0%26appname%3DGoogle%2520Chrome%26'\
+                      'needsadmin%3Dtrue%26ap%3Dx64-stable-statsdef_1%26'\
+                      'installdataindex%3Ddefaultbrowser'\
+                      '/chrome/install/ChromeStandaloneSetup64.exe',
+            'Beta': 'https://dl.google.com/tag/s/'\
+                    'appguid%3D%7B8237E44A-0054-442C-B6B6-EA0509993955%7D%26'\
+                    'iid%3D%7B8F94C426-F48E-944F-58B4-56AC548C0A6F%7D%26lang%3Den%26'\
+                    'browser%3D4%26usagestats%3D0%26appname%3DChrome%2520Beta%26'\
+                    'needsadmin%3Dtrue%26ap%3D-arch_x64-statsdef_1%26'\
+                    'installdataindex%3Dempty'\
+                    '/chrome/install/beta/ChromeBetaStandaloneSetup64.exe',
+            'Dev': 'https://dl.google.com/tag/s/'\
+                   'appguid%3D%7B401C381F-E0DE-4B85-8BD8-3F3F14FBDA57%7D%26'\
+                   'iid%3D%7B3C078BAD-5ACB-D945-6C84-7F778A6383F1%7D%26lang%3Den%26'\
+                   'browser%3D4%26usagestats%3D0%26appname%3DGoogle%2520Chrome%2520Dev%26'\
+                   'needsadmin%3Dtrue%26ap%3D-arch_x64-statsdef_1%26'\
+                   'installdataindex%3Dempty'\
+                   '/chrome/install/dev/ChromeDevStandaloneSetup64.exe'
+        }
+        brave_path = {
+            'Stable': 'https://laptop-updates.brave.com/latest/winx64',
+            'Beta': 'https://brave-browser-downloads.s3.brave.com/latest/BraveBrowserBetaSetup.exe',
+            'Dev': 'https://brave-browser-downloads.s3.brave.com/latest/BraveBrowserDevSetup.exe',
+            'Nightly': 'https://laptop-updates.brave.com/latest/winx64/nightly'
         }
-        self.edge_path = {
-            'Stable': 'https://c2rsetup.officeapps.live.com/c2r/downloadEdge.aspx?'\
-                      'ProductreleaseID=Edge&platform=Default&version=Edge'\
-                      '&Channel=Stable&language=en-us&Consent=1',
-            'Dev': 'https://c2rsetup.officeapps.live.com/c2r/downloadEdge.aspx?'\
-                   'ProductreleaseID=Edge&platform=Default&version=Edge&Channel=Dev'\
-                   '&language=en-us&Consent=1',
-            'Canary': 'https://c2rsetup.officeapps.live.com/c2r/downloadEdge.aspx?'\
-                      'ProductreleaseID=Edge&platform=Default&version=Edge&Channel=Canary'\
-                      '&language=en-us&Consent=1',
+    else:
+        firefox_os = 'win'
+        chrome_path = {
+            'Stable': 'https://dl.google.com/tag/s/'\
+                      'appguid%3D%7B8A69D345-D564-463C-AFF1-A69D9E530F96%7D%26'\
+                      'iid%3D%7B3C078BAD-5ACB-D945-6C84-7F778A6383F1%7D%26lang%3D'\
+                      'en%26browser%3D4%26usagestats%3D0%26appname%3DGoogle%2520Chrome%26'\
+                      'needsadmin%3Dtrue%26ap%3Dstable-arch_x86-statsdef_1%26'\
+                      'installdataindex%3Ddefaultbrowser'\
+                      '/chrome/install/ChromeStandaloneSetup.exe',
+            'Beta': 'https://dl.google.com/tag/s/'\
+                    'appguid%3D%7B8237E44A-0054-442C-B6B6-EA0509993955%7D%26'\
+                    'iid%3D%7B8F94C426-F48E-944F-58B4-56AC548C0A6F%7D%26lang%3Den%26'\
+                    'browser%3D4%26usagestats%3D0%26appname%3DChrome%2520Beta%26'\
+                    'needsadmin%3Dtrue%26ap%3D-arch_x86-statsdef_1%26'\
+                    'installdataindex%3Dempty'\
+                    '/chrome/install/beta/ChromeBetaStandaloneSetup.exe',
+            'Dev': 'https://dl.google.com/tag/s/'\
+                   'appguid%3D%7B401C381F-E0DE-4B85-8BD8-3F3F14FBDA57%7D%26'\
+                   'iid%3D%7B3C078BAD-5ACB-D945-6C84-7F778A6383F1%7D%26lang%3Den%26'\
+                   'browser%3D4%26usagestats%3D0%26appname%3DGoogle%2520Chrome%2520Dev%26'\
+                   'needsadmin%3Dtrue%26ap%3D-arch_x86-statsdef_1%26'\
+                   'installdataindex%3Dempty'\
+                   '/chrome/install/dev/ChromeDevStandaloneSetup.exe'
         }
-        self.dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'tmp')
-        if not os.path.isdir(self.dir):
-            os.makedirs(self.dir)
-        self.status_file = os.path.join(self.dir, 'browser_install.json')
-        self.status = None
-        if os.path.isfile(self.status_file):
-            with open(self.status_file, 'r') as f_in:
-                self.status = json.load(f_in)
-        if self.status is None:
-            self.status = {}
-
-    def save_status(self):
-        """Save the installed state of the various browsers"""
-        if self.status:
-            with open(self.status_file, 'w') as f_out:
-                json.dump(self.status, f_out, indent=4)
+        brave_path = {
+            'Stable': 'https://laptop-updates.brave.com/latest/winia32',
+            'Beta': 'https://brave-browser-downloads.s3.brave.com/latest/BraveBrowserBetaSetup32.exe',
+            'Dev': 'https://brave-browser-downloads.s3.brave.com/latest/BraveBrowserDevSetup32.exe',
+            'Nightly': 'https://laptop-updates.brave.com/latest/winia32/nightly'
+        }
+
+    firefox_url = 'http://download.mozilla.org/?product={0}&lang=en-US&os=' + firefox_os
+    firefox_path = {
+        'Mozilla Firefox': firefox_url.format('firefox-latest'),
+        'Mozilla Firefox ESR': firefox_url.format('firefox-esr-latest'),
+        'Mozilla Firefox Beta': firefox_url.format('firefox-beta-latest'),
+        'Mozilla Firefox Dev': firefox_url.format('firefox-devedition-latest'),
+        'Nightly': firefox_url.format('firefox-nightly-latest')
+    }
+    edge_path = {
+        'Stable': 'https://c2rsetup.officeapps.live.com/c2r/downloadEdge.aspx?'\
+                  'ProductreleaseID=Edge&platform=Default&version=Edge'\
+                  '&Channel=Stable&language=en-us&Consent=1',
+        'Dev': 'https://c2rsetup.officeapps.live.com/c2r/downloadEdge.aspx?'\
+               'ProductreleaseID=Edge&platform=Default&version=Edge&Channel=Dev'\
+               '&language=en-us&Consent=1',
+        'Canary': 'https://c2rsetup.officeapps.live.com/c2r/downloadEdge.aspx?'\
+                  'ProductreleaseID=Edge&platform=Default&version=Edge&Channel=Canary'\
+                  '&language=en-us&Consent=1',
+    }
+    return {'chrome': chrome_path, 'brave': brave_path, 'firefox': firefox_path, 'edge': edge_path}
+
+
+def install_dirs():
+    """Where every browser channel installs itself, relative to Program Files (or the local
+    application data directory for the per-user channels)"""
+    chrome_dir = {
+        'Stable': os.path.join('Google', 'Chrome', 'Application'),
+        'Beta': os.path.join('Google', 'Chrome Beta', 'Application'),
+        'Dev': os.path.join('Google', 'Chrome Dev', 'Application')
+    }
+    brave_dir = {
+        'Stable': os.path.join('BraveSoftware', 'Brave-Browser', 'Application'),
+        'Beta': os.path.join('BraveSoftware', 'Brave-Browser-Beta', 'Application'),
+        'Dev': os.path.join('BraveSoftware', 'Brave-Browser-Dev', 'Application'),
+        'Nightly': os.path.join('BraveSoftware', 'Brave-Browser-Nightly', 'Application')
+    }
+    edge_dir = {
+        'Stable': os.path.join('Microsoft', 'Edge', 'Application'),
+        'Dev': os.path.join('Microsoft', 'Edge Dev', 'Application'),
+        'Canary': os.path.join('Microsoft', 'Edge SxS', 'Application')
+    }
+    # Firefox is installed into a directory named after the channel (see run_installer)
+    firefox_dir = {}
+    for channel in ['Mozilla Firefox', 'Mozilla Firefox Beta', 'Mozilla Firefox ESR',
+                    'Mozilla Firefox Dev', 'Nightly']:
+        firefox_dir[channel] = channel
+    return {'chrome': chrome_dir, 'brave': brave_dir, 'firefox': firefox_dir, 'edge': edge_dir}
+
+
+class Install(InstallBase):
+    """Main installer logic"""
+    def __init__(self, options, timing=None):
+        InstallBase.__init__(self, options, timing)
+        paths = browser_paths(self.is_64bit())
+        self.chrome_path = paths['chrome']
+        self.brave_path = paths['brave']
+        self.firefox_path = paths['firefox']
+        self.edge_path = paths['edge']
+        if options.mirror:
+            from browser_mirror import rewrite_paths
+            for browser_path in [self.chrome_path, self.brave_path, self.firefox_path, self.edge_path]:
+                rewrite_paths(options.mirror, browser_path)
+        self.schedule_file = self.state_file('schedule')
+
+    def is_64bit(self):
+        """Check if this is 64-bit Windows (straight from the environment, which is much
+        faster than the platform module)"""
+        machine = os.environ.get('PROCESSOR_ARCHITEW6432', os.environ.get('PROCESSOR_ARCHITECTURE', ''))
+        return machine.endswith('64')
+
+    def describe(self, task):
+        """Every channel gets its own installer file so downloads can overlap"""
+        installer = 'browser_install_' + re.sub(r'\W+', '_', task['name']) + '.exe'
+        task['installer'] = os.path.join(self.dir, installer)
 
     def chrome(self, channel):
         """Install the given Chrome channel"""
-        if channel in self.chrome_path:
-            url = self.chrome_path[channel]
-            name = 'Chrome ' + channel
-            print("Checking {0}...".format(name))
-            last_modified = None
-            if name in self.status:
-                last_modified = self.status[name]
-            exe, modified = self.download_installer(url, last_modified)
-            if exe is not None and os.path.isfile(exe):
-                ret = self.run_elevated(exe, '/silent /install')
-                if ret == 0 and modified is not None:
-                    self.status[name] = modified
-                try:
-                    os.remove(exe)
-                except Exception:
-                    pass
+        self.process(self.task('chrome', channel))
 
     def brave(self, channel):
         """Install the given Brave channel"""
-        if channel in self.brave_path:
-            url = self.brave_path[channel]
-            name = 'Brave ' + channel
-            print("Checking {0}...".format(name))
-            last_modified = None
-            if name in self.status:
-                last_modified = self.status[name]
-            exe, modified = self.download_installer(url, last_modified)
-            if exe is not None and os.path.isfile(exe):
-                ret = self.run_elevated(exe, '/silent /install')
-                if ret == 0 and modified is not None:
-                    self.status[name] = modified
-                try:
-                    os.remove(exe)
-                except Exception:
-                    pass
+        self.process(self.task('brave', channel))
 
     def edge(self, channel):
-        """Install the given Chrome channel"""
-        if channel in self.edge_path:
-            url = self.edge_path[channel]
-            name = 'Microsoft Edge ' + channel
-            print("Checking {0}...".format(name))
-            last_modified = None
-            if name in self.status:
-                last_modified = self.status[name]
-            exe, modified = self.download_installer(url, last_modified)
-            if exe is not None and os.path.isfile(exe):
-                ret = self.run_elevated(exe, '/silent /install')
-                if ret == 0 and modified is not None:
-                    self.status[name] = modified
-                try:
-                    os.remove(exe)
-                except Exception:
-                    pass
+        """Install the given Edge channel"""
+        self.process(self.task('edge', channel))
 
     def firefox(self, channel):
         """Install the given Firefox channel"""
-        if channel in self.firefox_path:
-            url = self.firefox_path[channel]
-            name = channel
-            print("Checking {0}...".format(name))
-            last_modified = None
-            if name in self.status:
-                last_modified = self.status[name]
-            exe, modified = self.download_installer(url, last_modified)
-            if exe is not None and os.path.isfile(exe):
-                # Create an ini file for the installer to use
-                ini_file = os.path.join(self.dir, 'firefox.ini')
-                with open(ini_file, 'w') as ini:
-                    ini.write('[Install]\n')
-                    ini.write('InstallDirectoryName={0}\n'.format(channel))
-                    ini.write('MaintenanceService=false\n')
-                ret = self.run_elevated(exe, '/INI="{0}"'.format(ini_file))
-                if ret == 0 and modified is not None:
-                    self.status[name] = modified
+        self.process(self.task('firefox', channel))
+
+    def process(self, task):
+        """Download and install a single browser channel, False if either of them failed"""
+        ok = True
+        if task is not None:
+            exe, validators, ok = self.download_task(task)
+            ok = self.install_task(task, exe, validators) and ok
+        return ok
+
+    def probe(self, task):
+        """Check if a channel changed using a lightweight conditional request"""
+        result = {'state': 'error', 'status': None, 'length': None}
+        record = self.metrics.begin(task['name'], 'probe')
+        validators = self.get_validators(task['name'])
+        headers = conditional_headers(validators)
+        if task.get('version') is not None:
+            result['version'] = task['version']
+        if feed_confirms(task.get('version'), validators):
+            # The release feed says the installed version is still current
+            logging.debug('%s %s is current according to the release feed', task['name'],
+                          task['version'])
+            result['state'] = 'unchanged'
+            self.mark_checked(task['name'], False)
+            self.metrics.end(record, status=None, outcome='feed')
+            return result
+        try:
+            logging.debug('Probing %s', task['url'])
+            response = self.session.head(task['url'], headers=headers, allow_redirects=True, timeout=60)
+            if response.status_code in [405, 501]:
+                # HEAD is not supported, only fetch the headers of a GET
+                response = self.session.get(task['url'], headers=headers, stream=True, timeout=60)
+                response.close()
+            result['status'] = response.status_code
+            if response.status_code == 304:
+                result['state'] = 'unchanged'
+            elif response.status_code == 200:
+                current = response_validators(response)
+                if 'Content-Length' in response.headers:
+                    result['length'] = int(response.headers['Content-Length'])
+                result['state'] = 'changed'
+                # The size and range support are all a segmented download needs to start
+                task['probe'] = response
+                # Servers that ignore conditional HEAD requests still return the same validators
+                if validators.get('etag') is not None and current.get('etag') == validators['etag']:
+                    result['state'] = 'unchanged'
+                elif 'Last-Modified' in response.headers and \
+                        current.get('modified') == validators.get('modified'):
+                    result['state'] = 'unchanged'
+        except Exception as err:
+            result['error'] = err.__str__()
+            logging.warning("Probe failed for %s: %s", task['name'], result['error'])
+        if result['state'] == 'unchanged':
+            self.mark_unchanged(task['name'])
+        self.metrics.end(record, status=result['status'], outcome=result['state'])
+        return result
+
+    def discover(self, tasks):
+        """Look up the current version of the given channels in the vendor release feeds"""
+        if self.feeds is not None and tasks:
+            self.feeds.refresh(set(task['browser'] for task in tasks))
+            platform = 'win64' if self.is_64bit() else 'win'
+            for task in tasks:
+                version = self.feeds.versions(task['browser'], platform).get(task['channel'])
+                if version is not None:
+                    task['version'] = version
+                    if self.redirects is not None and \
+                            version != self.get_validators(task['name']).get('version'):
+                        # New releases are usually published under a new redirect target
+                        self.redirects.invalidate(task['url'])
+
+    def scan(self, tasks):
+        """Rebuild the status of channels that are installed but missing from the status file
+        (i.e. after it was lost) from the versions of the installs on disk"""
+        roots = self.install_roots()
+        dirs = install_dirs()
+        for task in tasks:
+            relative = dirs[task['browser']].get(task['channel'])
+            if task['name'] not in self.status and relative is not None:
+                version = find_version(roots, relative)
+                if version is not None:
+                    logging.info('Found %s %s already installed', task['name'], version)
+                    entry = scanned_entry(version)
+                    with self.status_lock:
+                        self.status[task['name']] = entry
+                        if not self.options.check:
+                            # --check only reports, the entry is just used for this run
+                            self.store.update(task['name'], entry)
+
+    def install_roots(self):
+        """Directories the browsers are installed under (--scan-root replaces them)"""
+        roots = self.options.scan_root
+        if not roots:
+            roots = [os.environ.get('ProgramFiles'), os.environ.get('ProgramFiles(x86)'),
+                     os.environ.get('LOCALAPPDATA')]
+        return roots
+
+    def probe_all(self, tasks):
+        """Probe all of the given channels at the same time and return the plan"""
+        self.scan(tasks)
+        self.discover(tasks)
+        # The probes share the keep-alive pools, so there are no more of them at a time than
+        # a pool holds connections
+        futures = run_parallel(self.probe, tasks, self.options.pool_size)
+        plan = {}
+        for task, future in zip(tasks, futures):
+            try:
+                plan[task['name']] = future.result()
+            except Exception:
+                logging.exception('Error probing %s', task['name'])
+                plan[task['name']] = None
+        return plan
+
+    def check(self):
+        """Probe the selected channels without downloading anything"""
+        return self.probe_all(self.get_tasks())
+
+    def download_task(self, task):
+        """Download the installer for the given channel if it changed (and if the download
+        worked, an unchanged installer counts as working)"""
+        print("Checking {0}...".format(task['name']))
+        validators = self.get_validators(task['name'])
+        record = self.metrics.begin(task['name'], 'download')
+        stats = {}
+        exe, validators = self.download_installer(task['url'], validators, task['installer'], stats,
+                                                  task.get('probe'))
+        self.metrics.end(record, **stats)
+        return exe, validators, stats.get('outcome') != 'error'
+
+    def install_task(self, task, exe, validators):
+        """Run a downloaded (or staged) installer and record the installed state, False if
+        the installer failed"""
+        ok = True
+        if exe is not None and os.path.isfile(exe):
+            base = self.delta_base(task['installer'])
+            if task.get('version') is not None:
+                validators['version'] = task['version']
+            if not content_changed(self.get_validators(task['name']), validators):
+                print("{0} installer has not changed".format(task['name']))
+                self.set_status(task['name'], validators)
+                self.staging.remove(task['name'])
+                try:
+                    if base is not None:
+                        os.replace(exe, base)
+                    else:
+                        os.remove(exe)
+                except Exception:
+                    pass
+                return ok
+            if not self.scheduler.can_install(task['name']):
                 try:
                     os.remove(exe)
-                    os.remove(ini_file)
                 except Exception:
                     pass
+                return ok
+            record = self.metrics.begin(task['name'], 'install')
+            ret = self.run_installer(task, exe)
+            self.metrics.end(record, exit_code=ret)
+            if ret != 0:
+                print("Installing {0} failed: {1}".format(task['name'], ret))
+                ok = False
+            if ret == 0 and validators:
+                self.set_status(task['name'], validators)
+                self.archive.add(task['name'], exe, validators)
+                # Anything staged for the channel is older than what was just installed
+                self.staging.remove(task['name'])
+            try:
+                if ret == 0 and base is not None:
+                    # Keep the installer as the base for the next delta update
+                    os.replace(exe, base)
+                else:
+                    os.remove(exe)
+            except Exception:
+                pass
+        return ok
 
-
-    def download_installer(self, url, last_modified):
-        """Download the given installer if it is newer"""
-        exe = None
-        modified = None
-        headers = None
-        if last_modified is not None:
-            headers = {'If-Modified-Since': last_modified}
-        dest = os.path.join(self.dir, 'browser_install.exe')
-        if os.path.isfile(dest):
+    def run_installer(self, task, exe):
+        """Silently run the installer for a channel (never while a test is running)"""
+        self.throttle.wait()
+        if task['browser'] == 'firefox':
+            # Create an ini file for the installer to use
+            ini_file = os.path.join(self.dir, 'firefox.ini')
+            with open(ini_file, 'w') as ini:
+                ini.write('[Install]\n')
+                ini.write('InstallDirectoryName={0}\n'.format(task['channel']))
+                ini.write('MaintenanceService=false\n')
+            ret = self.run_elevated(exe, '/INI="{0}"'.format(ini_file))
             try:
-                os.remove(dest)
+                os.remove(ini_file)
             except Exception:
                 pass
-        try:
-            logging.debug('Downloading %s to %s', url, dest)
-            response = requests.get(url, headers=headers, stream=True, timeout=300)
-            if response.status_code == 200:
-                if 'Last-Modified' in response.headers:
-                    modified = response.headers['Last-Modified']
-                elif 'Date' in response.headers:
-                    modified = response.headers['Date']
-                with open(dest, 'wb') as f_out:
-                    for chunk in response.iter_content(chunk_size=4096):
-                        f_out.write(chunk)
-                exe = dest
-        except Exception as err:
-            msg = ''
-            if err is not None and err.__str__() is not None:
-                msg = err.__str__()
-            logging.exception("Download failed: %s", msg)
-        return exe, modified
+        else:
+            ret = self.run_elevated(exe, '/silent /install')
+        return ret
+
+    def reinstall(self, task, entry):
+        """Run an archived installer for a channel again, uninstalling the newer version of
+        Chromium-based browsers first (the user data is kept)"""
+        if task['browser'] in UNINSTALL_SWITCHES:
+            path = self.install_path(task)
+            if path is not None:
+                ret = self.uninstall(task, path)
+                if ret != 0:
+                    return ret
+        return self.run_installer(task, entry['path'])
+
+    def install_path(self, task):
+        """Application directory of an installed channel (None if it isn't installed)"""
+        found = None
+        relative = install_dirs()[task['browser']].get(task['channel'])
+        if relative is not None:
+            for root in self.install_roots():
+                if root and installed_version(os.path.join(root, relative)) is not None:
+                    found = os.path.join(root, relative)
+                    break
+        return found
+
+    def uninstall(self, task, path):
+        """Uninstall a Chromium-based channel with the setup.exe of the installed version"""
+        version = installed_version(path)
+        setup = os.path.join(path, version, 'Installer', 'setup.exe')
+        if not os.path.isfile(setup):
+            print("Can't roll {0} back, {1} has no uninstaller and the installer does not"
+                  " downgrade".format(task['name'], os.path.join(path, version)))
+            return 1
+        args = ['--uninstall', '--force-uninstall',
+                UNINSTALL_SWITCHES[task['browser']][task['channel']]]
+        local = os.environ.get('LOCALAPPDATA')
+        if not local or not path.startswith(local):
+            args.append('--system-level')
+        print("Uninstalling {0} {1}...".format(task['name'], version))
+        self.throttle.wait()
+        ret = self.run_elevated(setup, ' '.join([arg for arg in args if arg]))
+        if ret != 0:
+            print("Uninstalling {0} failed: {1}".format(task['name'], ret))
+        return ret
+
+    def delta_base(self, installer):
+        """Where the previous version of an installer is kept for delta updates (if enabled)"""
+        base = None
+        if self.options.delta and self.options.mirror:
+            base = installer + '.base'
+        return base
+
+    def download_installer(self, url, validators, dest=None, stats=None, probe=None):
+        """Download the given installer if it is newer"""
+        if dest is None:
+            dest = os.path.join(self.dir, 'browser_install.exe')
+        return download_file(self.session, url, dest, validators, segments=self.options.segments,
+                             cache=self.cache, stats=stats, base=self.delta_base(dest),
+                             probe=probe)
 
     def run_elevated(self, command, args):
         """Run the given command as an elevated user and wait for it to return"""
@@ -265,56 +467,281 @@ class Install(object):
         return ret
 
     def install_thread(self):
-        """Do the actual install"""
-        if self.options.chrome:
-            if self.options.stable:
-                self.chrome('Stable')
-            if self.options.beta:
-                self.chrome('Beta')
-            if self.options.dev:
-                self.chrome('Dev')
-        if self.options.firefox:
-            if self.options.stable:
-                self.firefox('Mozilla Firefox')
-            if self.options.beta:
-                self.firefox('Mozilla Firefox Beta')
-                self.firefox('Mozilla Firefox ESR')
-                self.firefox('Mozilla Firefox Dev')
-            if self.options.dev:
-                self.firefox('Nightly')
-        if self.options.edge:
-            if self.options.stable:
-                self.edge('Stable')
-            if self.options.dev:
-                self.edge('Dev')
-                self.edge('Canary')
-        if self.options.brave:
-            if self.options.stable:
-                self.brave('Stable')
-            if self.options.beta:
-                self.brave('Beta')
-            if self.options.dev:
-                self.brave('Dev')
-                self.brave('Nightly')
-        self.save_status()
-
-    def install(self):
-        """Run the install (in a background thread) for up to an hour"""
-        import threading
-        thread = threading.Thread(target=self.install_thread)
-        thread.daemon = True
-        thread.start()
-        thread.join(3600)
+        """Do the actual install (or just the download or install half of it for --prefetch
+        and --apply)"""
+        if self.options.prefetch:
+            self.prefetch_thread()
+        elif self.options.apply:
+            self.apply_thread()
+        else:
+            self.update_thread()
+
+    def update_thread(self):
+        """Check the channels and install the ones that changed"""
+        tasks = []
+        for task in self.get_tasks():
+            if self.is_pinned(task['name']):
+                print("{0} is pinned to a rolled back version (use --unpin to update it)".format(
+                    task['name']))
+            elif not self.is_fresh(task['name']):
+                tasks.append(task)
+        self.timing.mark('freshness')
+        if tasks:
+            self.update(tasks)
+            self.timing.mark('update')
+            self.finish_run()
+            self.timing.mark('report')
+
+    def lower_priority(self):
+        """Run the rest of a prefetch at a low CPU priority so it can overlap test jobs"""
+        try:
+            import win32api
+            import win32process
+            win32process.SetPriorityClass(win32api.GetCurrentProcess(),
+                                          win32process.BELOW_NORMAL_PRIORITY_CLASS)
+        except Exception as err:
+            logging.debug('Error lowering the priority: %s', err.__str__())
+
+    def prefetch_thread(self):
+        """Download the installers that changed into the staging area without installing them"""
+        tasks = []
+        for task in self.get_tasks():
+            if not self.is_pinned(task['name']) and not self.is_fresh(task['name']):
+                tasks.append(task)
+        if tasks:
+            self.lower_priority()
+            self.scan(tasks)
+            self.discover(tasks)
+            for task in self.scheduler.sort(tasks):
+                if self.scheduler.begin(task['name']):
+                    ok = False
+                    try:
+                        ok = self.prefetch_task(task)
+                    except Cancelled:
+                        logging.warning('%s ran out of time', task['name'])
+                    self.scheduler.finish(task['name'], not ok)
+            self.finish_run()
+
+    def prefetch_task(self, task):
+        """Download the installer for a channel into the staging area if it changed.
+
+        The request is conditional on the installer that is already staged (if there is one)
+        so a staged installer isn't downloaded again. Returns False if the download failed."""
+        name = task['name']
+        installed = self.get_validators(name)
+        if feed_confirms(task.get('version'), installed):
+            print("{0} is up to date".format(name))
+            self.mark_checked(name, False)
+            return True
+        staged = self.staging.get(name)
+        print("Checking {0}...".format(name))
+        dest = os.path.join(self.staging.dir, os.path.basename(task['installer']))
+        record = self.metrics.begin(name, 'download')
+        stats = {}
+        exe, validators = download_file(self.session, task['url'], dest,
+                                        staged['validators'] if staged is not None else installed,
+                                        segments=self.options.segments, cache=self.cache,
+                                        stats=stats, base=self.delta_base(task['installer']))
+        self.metrics.end(record, **stats)
+        if exe is None:
+            if stats.get('status') == 304:
+                if staged is not None:
+                    print("{0} is already staged".format(name))
+                else:
+                    print("{0} is up to date".format(name))
+                    self.mark_unchanged(name)
+            return stats.get('outcome') != 'error'
+        if task.get('version') is not None:
+            validators['version'] = task['version']
+        if not content_changed(installed, validators):
+            print("{0} installer has not changed".format(name))
+            self.set_status(name, validators)
+            self.staging.remove(name)
+            try:
+                os.remove(exe)
+            except Exception:
+                pass
+        else:
+            self.staging.add(name, exe, validators)
+            print("Staged {0} (install it with --apply)".format(name))
+        return True
+
+    def apply_thread(self):
+        """Install the installers that were staged by --prefetch without any network requests"""
+        applied = False
+        for task in self.scheduler.sort(self.get_tasks()):
+            if self.is_pinned(task['name']) or self.staging.get(task['name']) is None:
+                continue
+            if self.scheduler.begin(task['name']):
+                ok = False
+                entry = self.staging.take(task['name'])
+                if entry is not None:
+                    print("Installing the staged {0}...".format(task['name']))
+                    ok = self.install_task(task, entry['path'], dict(entry['validators']))
+                    applied = True
+                self.scheduler.finish(task['name'], not ok)
+        if applied:
+            self.save_status()
+            self.metrics.write(self.options.metrics_file, self.options.prometheus_file)
+            self.scheduler.report()
+        else:
+            print("Nothing is staged")
+
+    def update(self, tasks):
+        """Probe the given channels and download/install the ones that changed"""
+        # Only the channels that changed (or could not be probed) need to be downloaded
+        plan = self.probe_all(tasks)
+        changed = []
+        for task in tasks:
+            if plan[task['name']]['state'] == 'unchanged':
+                print("{0} is up to date".format(task['name']))
+                self.scheduler.record(task['name'], 'completed')
+            else:
+                changed.append(task)
+        changed = self.scheduler.sort(changed)
+        if self.options.jobs > 1 and len(changed) > 1:
+            self.install_pipelined(changed)
+        else:
+            for task in changed:
+                if self.scheduler.begin(task['name']):
+                    ok = False
+                    try:
+                        ok = self.process(task)
+                    except Cancelled:
+                        logging.warning('%s ran out of time', task['name'])
+                    self.scheduler.finish(task['name'], not ok)
+        return plan
+
+    def load_schedule(self):
+        """Load the per-channel polling schedule used in daemon mode"""
+        schedule = {}
+        try:
+            if os.path.isfile(self.schedule_file):
+                with open(self.schedule_file, 'r') as f_in:
+                    schedule = json.load(f_in)
+        except Exception:
+            logging.exception('Error loading the polling schedule')
+        return schedule
+
+    def save_schedule(self, schedule):
+        """Replace the polling schedule without ever leaving a partially written one behind"""
+        try:
+            tmp_file = '{0}.{1:d}.tmp'.format(self.schedule_file, os.getpid())
+            with open(tmp_file, 'w') as f_out:
+                json.dump(schedule, f_out, indent=4)
+            os.replace(tmp_file, self.schedule_file)
+        except Exception:
+            logging.exception('Error saving the polling schedule')
+
+    def reschedule(self, entry, changed, now):
+        """Adapt a channel's polling interval to how often it changes, with jitter"""
+        import random
+        interval = entry.get('interval', self.options.min_interval)
+        if changed:
+            interval = interval / 2
+            entry['last_change'] = now
+        else:
+            interval = interval * self.options.backoff
+        interval = min(max(interval, self.options.min_interval), self.options.max_interval)
+        entry['interval'] = interval
+        # Spread the fleet out so agents don't all poll the vendors at the same time
+        jitter = random.uniform(1.0 - self.options.jitter, 1.0 + self.options.jitter)
+        entry['next'] = now + interval * jitter
+        entry['checks'] = entry.get('checks', 0) + 1
+
+    def daemon_cycle(self, due, schedule, now):
+        """Update the channels that are due and schedule their next check"""
+        self.metrics = Metrics()
+        self.scheduler.reset()
+        self.run_lock.acquire()
+        try:
+            self.status = self.store.load()
+            before = {}
+            for task in due:
+                before[task['name']] = self.get_validators(task['name']).get('sha256')
+            plan = self.update(due)
+            self.finish_run()
+        finally:
+            self.run_lock.release()
+        for task in due:
+            entry = schedule.setdefault(task['name'], {})
+            if plan[task['name']]['state'] == 'error' or \
+                    self.scheduler.outcomes.get(task['name']) in ['failed', 'timed-out']:
+                # Try again at the shortest interval without learning anything
+                entry['next'] = now + self.options.min_interval
+            else:
+                after = self.get_validators(task['name']).get('sha256')
+                self.reschedule(entry, after != before[task['name']], now)
+
+    def daemon(self, clock=time.time, sleep=time.sleep):
+        """Stay resident, probing each channel on its own schedule and installing changes
+        (clock and sleep keep the time, tests pass in their own)"""
+        schedule = self.load_schedule()
+        while True:
+            now = clock()
+            due = [task for task in self.get_tasks()
+                   if schedule.get(task['name'], {}).get('next', 0) <= now and
+                   not self.is_pinned(task['name'])]
+            if due:
+                logging.info('Checking %s', ', '.join(task['name'] for task in due))
+                try:
+                    self.daemon_cycle(due, schedule, now)
+                except Exception:
+                    # Keep the daemon running, the channels are tried again at the shortest interval
+                    logging.exception('Error checking %s', ', '.join(task['name'] for task in due))
+                    for task in due:
+                        schedule.setdefault(task['name'], {})['next'] = now + self.options.min_interval
+                self.save_schedule(schedule)
+            pending = [schedule.get(task['name'], {}).get('next', 0) for task in self.get_tasks()
+                       if not self.is_pinned(task['name'])]
+            if not pending:
+                break
+            sleep(min(max(min(pending) - clock(), 1), 3600))
+
+    def timed_download(self, task):
+        """Download the installer for a channel, keeping track of how long it took"""
+        start = time.time()
+        exe, validators, ok = self.download_task(task)
+        return exe, validators, ok, time.time() - start
+
+    def pipelined_download(self, task):
+        """Download the installer for a channel in the background for install_pipelined"""
+        result = (None, None, False, 0)
+        if self.scheduler.begin(task['name']):
+            try:
+                result = self.timed_download(task)
+            except Cancelled:
+                logging.warning('%s ran out of time', task['name'])
+            except Exception:
+                logging.exception('Error downloading %s', task['name'])
+        return result
+
+    def install_pipelined(self, tasks):
+        """Download several installers at once while the installs run one at a time, in order"""
+        start = time.time()
+        # The downloads are started in install order
+        futures = run_parallel(self.pipelined_download, tasks, self.options.jobs)
+        # Installers can not run concurrently so they are consumed in order as they become ready
+        sequential = 0
+        for task, future in zip(tasks, futures):
+            exe, validators, ok, download_time = future.result()
+            install_start = time.time()
+            ok = self.install_task(task, exe, validators) and ok
+            self.scheduler.finish(task['name'], not ok)
+            sequential += download_time + time.time() - install_start
+        elapsed = time.time() - start
+        print("Pipelined {0} channels in {1:0.1f}s ({2:0.1f}s saved over sequential)".format(
+            len(tasks), elapsed, max(sequential - elapsed, 0)))
 
 ##########################################################################
 #   Main Entry Point
 ##########################################################################
-def main():
-    """Main entry point"""
+def parse_options(args=None):
+    """Parse the command-line options (sys.argv when args is None)"""
     import argparse
     parser = argparse.ArgumentParser(description='Automated browser installer/updater.',
                                      prog='browser_install')
-    parser.add_argument('-v', '--verbose', action='count',
+    parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Increase verbosity (specify multiple times for more)."\
                         " -vvvv for full debug output.")
     parser.add_argument('-a', '--all', action='store_true', default=False,
@@ -329,22 +756,58 @@ def main():
                         help="Beta releases (includes ESR and dev edition for Firefox).")
     parser.add_argument('-d', '--dev', action='store_true', default=False,
                         help="Dev releases (Nightly for Firefox, Dev channel for Chrome).")
-    options, _ = parser.parse_known_args()
-
-    # Set up logging
-    log_level = logging.CRITICAL
-    if options.verbose == 1:
-        log_level = logging.ERROR
-    elif options.verbose == 2:
-        log_level = logging.WARNING
-    elif options.verbose == 3:
-        log_level = logging.INFO
-    elif options.verbose >= 4:
-        log_level = logging.DEBUG
-    logging.basicConfig(
-        level=log_level, format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
-
-    start = time.time()
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of installers to download in parallel while installing"\
+                        " (default 1, download and install one channel at a time).")
+    parser.add_argument('--check', action='store_true', default=False,
+                        help="Check the selected channels for updates and print the plan as JSON"\
+                        " without downloading or installing anything.")
+    parser.add_argument('--prefetch', action='store_true', default=False,
+                        help="Download the installers that changed into the staging area at a low"\
+                        " priority without installing them (can run alongside tests).")
+    parser.add_argument('--apply', action='store_true', default=False,
+                        help="Install the installers staged by --prefetch without downloading"\
+                        " anything.")
+    parser.add_argument('--staging-dir',
+                        help="Directory --prefetch stages the installers in (default tmp/staging).")
+    parser.add_argument('--daemon', action='store_true', default=False,
+                        help="Stay resident and poll each channel on a schedule adapted to"\
+                        " how often it changes, installing updates as they are found.")
+    parser.add_argument('--min-interval', type=int, default=900,
+                        help="Shortest daemon polling interval for a channel in seconds"\
+                        " (default 900).")
+    parser.add_argument('--max-interval', type=int, default=86400,
+                        help="Longest daemon polling interval for a channel in seconds"\
+                        " (default 86400).")
+    parser.add_argument('--backoff', type=float, default=1.5,
+                        help="Factor the polling interval grows by each time a channel has"\
+                        " not changed (default 1.5, halved when it changes).")
+    parser.add_argument('--jitter', type=float, default=0.1,
+                        help="Random spread applied to every polling interval (default 0.1,"\
+                        " +/-10%%).")
+    parser.add_argument('--serve', type=int,
+                        help="Run as a fleet mirror on the given port, prefetching every"\
+                        " installer for every platform and serving them over HTTP.")
+    parser.add_argument('--serve-dir',
+                        help="Directory the mirror keeps the installers in (default tmp/mirror).")
+    parser.add_argument('--serve-interval', type=int, default=3600,
+                        help="Seconds between mirror refreshes from upstream (default 3600).")
+    parser.add_argument('--rollback', metavar='CHANNEL',
+                        help="Reinstall an archived installer for a channel (i.e. \"Chrome Beta\")"\
+                        " without downloading anything and pin the channel to it.")
+    parser.add_argument('--archive-dir',
+                        help="Directory the installers are archived in (default tmp/archive).")
+    parser.add_argument('--scan-root', action='append',
+                        help="Directory to look for existing installs in when a channel is"\
+                        " missing from the status file (default Program Files, Program Files"\
+                        " (x86) and the local application data directory, can be repeated).")
+    parser.add_argument('--deadline', type=int, default=3600,
+                        help="Seconds the whole run may take (default 3600, 0 for no limit)."\
+                        " Downloads still running at the deadline are stopped (and resumed by"\
+                        " the next run) and no more installers are started.")
+    add_installer_options(parser)
+    add_common_options(parser)
+    options, _ = parser.parse_known_args(args)
     if options.all:
         options.chrome = True
         options.firefox = True
@@ -353,13 +816,41 @@ def main():
         options.stable = True
         options.beta = True
         options.dev = True
+    return options
+
+def main():
+    """Main entry point"""
+    timing = Timing(STARTED)
+    options = parse_options()
+
+    setup_logging(options.verbose)
+
+    start = time.time()
+
+    if options.serve:
+        from browser_mirror import Mirror, upstream_urls
+        serve_dir = options.serve_dir
+        if not serve_dir:
+            serve_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'tmp', 'mirror')
+        mirror = Mirror(upstream_urls(), serve_dir, HttpSession(options.pool_hosts, options.pool_size))
+        mirror.serve('', options.serve, options.serve_interval)
+        return
 
-    install = Install(options)
-    install.install()
+    timing.mark('startup')
+    install = Install(options, timing)
+    timing.mark('setup')
+    if options.check:
+        print(json.dumps(install.check(), indent=4))
+    elif options.daemon:
+        install.daemon()
+    else:
+        install.install()
 
     end = time.time()
     elapsed = end - start
     logging.debug("Browser install done, Elapsed Time: %0.4f", elapsed)
+    if options.timing:
+        timing.report()
 
 if __name__ == '__main__':
     main()
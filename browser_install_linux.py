@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from browser_common import STARTED, InstallBase, add_common_options, setup_logging
+from browser_download import Cancelled, conditional_headers, content_changed, response_validators
+from browser_extract import stream_install
+from browser_feeds import feed_confirms, version_key
+from browser_metrics import Timing
+from browser_scan import find_version, scanned_entry
+
+def browser_paths():
+    """Package download URLs for every browser channel on 64-bit Linux"""
+    chrome_path = {
+        'Stable': 'https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb',
+        'Beta': 'https://dl.google.com/linux/direct/google-chrome-beta_current_amd64.deb',
+        'Dev': 'https://dl.google.com/linux/direct/google-chrome-unstable_current_amd64.deb'
+    }
+    firefox_url = 'https://download.mozilla.org/?product={0}&lang=en-US&os=linux64'
+    firefox_path = {
+        'Mozilla Firefox': firefox_url.format('firefox-latest-ssl'),
+        'Mozilla Firefox ESR': firefox_url.format('firefox-esr-latest-ssl'),
+        'Mozilla Firefox Beta': firefox_url.format('firefox-beta-latest-ssl'),
+        'Mozilla Firefox Dev': firefox_url.format('firefox-devedition-latest-ssl'),
+        'Nightly': firefox_url.format('firefox-nightly-latest-ssl')
+    }
+    return {'chrome': chrome_path, 'firefox': firefox_path}
+
+
+def package_indexes():
+    """apt repositories (and package names) for the channels without a stable download URL"""
+    edge_repo = 'https://packages.microsoft.com/repos/edge/'
+    edge_path = {
+        'Stable': {'repo': edge_repo, 'package': 'microsoft-edge-stable'},
+        'Beta': {'repo': edge_repo, 'package': 'microsoft-edge-beta'},
+        'Dev': {'repo': edge_repo, 'package': 'microsoft-edge-dev'}
+    }
+    brave_path = {
+        'Stable': {'repo': 'https://brave-browser-apt-release.s3.brave.com/',
+                   'package': 'brave-browser'},
+        'Beta': {'repo': 'https://brave-browser-apt-beta.s3.brave.com/',
+                 'package': 'brave-browser-beta'},
+        'Nightly': {'repo': 'https://brave-browser-apt-nightly.s3.brave.com/',
+                    'package': 'brave-browser-nightly'}
+    }
+    return {'edge': edge_path, 'brave': brave_path}
+
+
+def parse_index(text):
+    """Find the newest amd64 build of every package in an apt Packages index"""
+    packages = {}
+    for stanza in re.split(r'\n\s*\n', text):
+        fields = {}
+        for line in stanza.splitlines():
+            if ':' in line and not line.startswith(' '):
+                name, value = line.split(':', 1)
+                fields[name.strip()] = value.strip()
+        if fields.get('Architecture') in ['amd64', 'all'] and 'Package' in fields and \
+                'Filename' in fields and 'Version' in fields:
+            newest = packages.get(fields['Package'])
+            if newest is None or version_key(fields['Version']) > version_key(newest['Version']):
+                packages[fields['Package']] = fields
+    return packages
+
+
+def parse_packages(text, package):
+    """Find the newest amd64 build of a package in an apt Packages index"""
+    return parse_index(text).get(package)
+
+
+class Install(InstallBase):
+    """Main installer logic"""
+    file_suffix = '_linux'
+
+    def __init__(self, options, timing=None):
+        self.install_dir = options.install_dir
+        InstallBase.__init__(self, options, timing)
+        paths = browser_paths()
+        self.chrome_path = paths['chrome']
+        self.firefox_path = paths['firefox']
+        indexes = package_indexes()
+        self.edge_path = indexes['edge']
+        self.brave_path = indexes['brave']
+        # Parsed apt Packages indexes, fetched once per run and cached with their validators
+        self.indexes = {}
+        self.index_lock = threading.Lock()
+        self.index_file = self.state_file('packages')
+        self.index_cache = {}
+        try:
+            if os.path.isfile(self.index_file):
+                with open(self.index_file, 'r') as f_in:
+                    self.index_cache = json.load(f_in)
+        except Exception:
+            logging.exception('Error loading the package index cache')
+
+    def default_dir(self, name):
+        """Keep the staging area and archive on the same filesystem as the installs so
+        staging and archiving are just renames"""
+        return os.path.join(self.install_dir, '.' + name)
+
+    def describe(self, task):
+        """Each channel is extracted into its own directory, from a .deb package or a
+        Firefox tarball (found in an apt index for the channels without a stable URL)"""
+        task['kind'] = 'tar' if task['browser'] == 'firefox' else 'deb'
+        task['path'] = self.install_path(task['name'])
+        if isinstance(task['url'], dict):
+            task['index'] = task.pop('url')
+
+    def install_path(self, name):
+        """Directory a channel is extracted into"""
+        return os.path.join(self.install_dir, re.sub(r'\W+', '-', name).lower())
+
+    def get_validators(self, name):
+        """Get the validators recorded for the last install of a channel (if it is still there)"""
+        validators = {}
+        if os.path.isdir(self.install_path(name)):
+            validators = InstallBase.get_validators(self, name)
+        return validators
+
+    def package_index(self, url):
+        """Get the newest build of every package in an apt Packages index.
+
+        Channels in the same repository (i.e. every Edge channel) share one request per run,
+        and the request is conditional on the copy cached by the last run."""
+        with self.index_lock:
+            if url not in self.indexes:
+                cached = self.index_cache.get(url)
+                headers = conditional_headers(cached) if cached is not None else {}
+                logging.debug('Fetching %s', url)
+                response = self.session.get(url, headers=headers, timeout=60)
+                packages = {}
+                if response.status_code == 304 and cached is not None:
+                    logging.debug('%s has not changed', url)
+                    packages = cached['packages']
+                elif response.status_code == 200:
+                    packages = parse_index(response.text)
+                    entry = response_validators(response)
+                    entry['packages'] = packages
+                    self.index_cache[url] = entry
+                    self.save_indexes()
+                else:
+                    logging.warning('Error fetching %s: HTTP %d', url, response.status_code)
+                self.indexes[url] = packages
+        return self.indexes[url]
+
+    def save_indexes(self):
+        """Write the package index cache atomically"""
+        try:
+            tmp_file = self.index_file + '.{0:d}.tmp'.format(os.getpid())
+            with open(tmp_file, 'w') as f_out:
+                json.dump(self.index_cache, f_out)
+            os.replace(tmp_file, self.index_file)
+        except Exception:
+            logging.exception('Error saving the package index cache')
+
+    def resolve(self, task):
+        """Find the current package for a channel that is published in an apt repository"""
+        index = task['index']
+        url = index['repo'] + 'dists/stable/main/binary-amd64/Packages'
+        package = self.package_index(url).get(index['package'])
+        if package is None:
+            logging.warning('%s is not in %s', index['package'], url)
+        else:
+            package = dict(package)
+            package['url'] = index['repo'] + package['Filename']
+        return package
+
+    def process(self, task):
+        """Stream the package for a channel into a staging directory and swap it into place,
+        False if the download or the swap failed"""
+        name = task['name']
+        print("Checking {0}...".format(name))
+        previous = self.get_validators(task['name'])
+        if feed_confirms(task.get('version'), previous):
+            print("{0} is up to date ({1})".format(name, task['version']))
+            self.mark_checked(name, False)
+            return True
+        url = task.get('url')
+        if 'index' in task:
+            try:
+                package = self.resolve(task)
+            except Exception as err:
+                logging.warning('Error resolving %s: %s', name, err.__str__())
+                package = None
+            if package is None:
+                return False
+            if package.get('SHA256') is not None and package['SHA256'] == previous.get('sha256'):
+                # The index already says the installed package is current
+                print("{0} is up to date".format(name))
+                self.mark_checked(name)
+                return True
+            url = package['url']
+        record = self.metrics.begin(name, 'download')
+        stats = {}
+        staging = task['path'] + '.staging'
+        path, validators, _ = stream_install(self.session, url, previous, staging, task['kind'],
+                                             stats=stats)
+        self.metrics.end(record, **stats)
+        ok = stats.get('outcome') != 'error'
+        if stats.get('status') == 304:
+            print("{0} is up to date".format(name))
+            self.mark_unchanged(name)
+        if path is not None:
+            if task.get('version') is not None:
+                validators['version'] = task['version']
+            if not content_changed(previous, validators):
+                print("{0} package has not changed".format(name))
+                shutil.rmtree(path, ignore_errors=True)
+                self.set_status(name, validators)
+            elif not self.scheduler.can_install(name):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                record = self.metrics.begin(name, 'install')
+                ret = self.swap(name, path, task['path'], validators['sha256'], previous)
+                self.metrics.end(record, exit_code=ret)
+                if ret == 0:
+                    print("Installed {0} in {1}".format(name, task['path']))
+                    self.set_status(name, validators)
+                    # Anything staged for the channel is older than what was just installed
+                    self.staging.remove(name)
+                else:
+                    ok = False
+        return ok
+
+    def prefetch(self, task):
+        """Stream the package for a channel into a directory next to the install if it
+        changed and stage it without swapping it into place.
+
+        The request is conditional on the package that is already staged (if there is one)
+        so a staged package isn't downloaded again. Returns False if the download failed."""
+        name = task['name']
+        print("Checking {0}...".format(name))
+        previous = self.get_validators(task['name'])
+        if feed_confirms(task.get('version'), previous):
+            print("{0} is up to date ({1})".format(name, task['version']))
+            self.mark_checked(name, False)
+            return True
+        staged = self.staging.get(name)
+        request = staged['validators'] if staged is not None else previous
+        url = task.get('url')
+        if 'index' in task:
+            try:
+                package = self.resolve(task)
+            except Exception as err:
+                logging.warning('Error resolving %s: %s', name, err.__str__())
+                package = None
+            if package is None:
+                return False
+            if package.get('SHA256') is not None and package['SHA256'] == previous.get('sha256'):
+                print("{0} is up to date".format(name))
+                self.mark_checked(name)
+                return True
+            if package.get('SHA256') is not None and package['SHA256'] == request.get('sha256'):
+                print("{0} is already staged".format(name))
+                return True
+            url = package['url']
+        record = self.metrics.begin(name, 'download')
+        stats = {}
+        path, validators, _ = stream_install(self.session, url, request, task['path'] + '.prefetch',
+                                             task['kind'], stats=stats)
+        self.metrics.end(record, **stats)
+        if stats.get('status') == 304:
+            if staged is not None:
+                print("{0} is already staged".format(name))
+            else:
+                print("{0} is up to date".format(name))
+                self.mark_unchanged(name)
+        if path is not None:
+            if task.get('version') is not None:
+                validators['version'] = task['version']
+            if not content_changed(previous, validators):
+                print("{0} package has not changed".format(name))
+                shutil.rmtree(path, ignore_errors=True)
+                self.set_status(name, validators)
+                self.staging.remove(name)
+            else:
+                # Staged next to the install so applying it is still just a rename
+                staged_dir = task['path'] + '.staged'
+                if os.path.isdir(staged_dir):
+                    shutil.rmtree(staged_dir)
+                os.rename(path, staged_dir)
+                self.staging.add(name, staged_dir, validators)
+                print("Staged {0} (install it with --apply)".format(name))
+        return stats.get('outcome') != 'error'
+
+    def apply(self, task):
+        """Swap the package that was staged for a channel by --prefetch into place, False if
+        it was missing or the swap failed"""
+        ok = True
+        name = task['name']
+        entry = self.staging.take(name)
+        if entry is None:
+            return False
+        previous = self.get_validators(task['name'])
+        validators = dict(entry['validators'])
+        if not content_changed(previous, validators):
+            print("{0} package has not changed".format(name))
+            shutil.rmtree(entry['path'], ignore_errors=True)
+            self.set_status(name, validators)
+        elif not self.scheduler.can_install(name):
+            shutil.rmtree(entry['path'], ignore_errors=True)
+        else:
+            record = self.metrics.begin(name, 'install')
+            ret = self.swap(name, entry['path'], task['path'], validators['sha256'], previous)
+            self.metrics.end(record, exit_code=ret)
+            if ret == 0:
+                print("Installed the staged {0} in {1}".format(name, task['path']))
+                self.set_status(name, validators)
+            else:
+                ok = False
+        return ok
+
+    def swap(self, name, staging, path, sha256, previous):
+        """Atomically point path at the freshly extracted staging directory.
+
+        path is a symlink to a directory named after the package hash so the swap is
+        a single rename and nothing ever sees a partially installed browser. The version
+        that was replaced is archived with its validators (previous) for --rollback."""
+        ret = 1
+        self.throttle.wait()
+        try:
+            target = '{0}.{1}'.format(path, sha256[:12])
+            if os.path.islink(path) and os.path.realpath(path) == os.path.realpath(target) and \
+                    os.path.isdir(target):
+                # The same package is already live, leave it alone rather than replacing
+                # the directory the browser is running from
+                logging.debug('%s is already installed in %s', name, target)
+                shutil.rmtree(staging, ignore_errors=True)
+            else:
+                if os.path.isdir(target):
+                    # Left over from an interrupted install, rename it aside before removing it
+                    stale = '{0}.{1:d}.stale'.format(target, os.getpid())
+                    os.rename(target, stale)
+                    shutil.rmtree(stale, ignore_errors=True)
+                os.rename(staging, target)
+                old = None
+                if os.path.islink(path):
+                    old = os.path.realpath(path)
+                elif os.path.isdir(path):
+                    # Installed before the symlink layout, move it out of the way first
+                    old = path + '.old'
+                    os.rename(path, old)
+                link = path + '.link'
+                if os.path.lexists(link):
+                    os.remove(link)
+                os.symlink(os.path.basename(target), link)
+                os.replace(link, path)
+                if old is not None and os.path.realpath(old) != os.path.realpath(target):
+                    self.archive.add(name, old, previous)
+            ret = 0
+        except Exception:
+            logging.exception('Error installing %s', path)
+        return ret
+
+    def reinstall(self, task, entry):
+        """Swap an archived version of a channel back into place"""
+        self.archive.take(task['name'], entry)
+        staging = task['path'] + '.staging'
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        shutil.move(entry['path'], staging)
+        return self.swap(task['name'], staging, task['path'], entry['sha256'],
+                         self.get_validators(task['name']))
+
+    def scan(self, tasks):
+        """Rebuild the status of channels that are installed but missing from the status file
+        (i.e. after it was lost) from the versions of the installs on disk.
+
+        Only the Firefox tarballs carry their version (in application.ini), the .deb
+        packages do not install anything it could be read from."""
+        for task in tasks:
+            if task['browser'] == 'firefox' and task['name'] not in self.status:
+                version = find_version([task['path']], 'firefox')
+                if version is not None:
+                    logging.info('Found %s %s already installed', task['name'], version)
+                    entry = scanned_entry(version)
+                    with self.status_lock:
+                        self.status[task['name']] = entry
+                        self.store.update(task['name'], entry)
+
+    def discover(self, tasks):
+        """Look up the current version of the given channels in the vendor release feeds"""
+        if self.feeds is not None and tasks:
+            self.feeds.refresh(set(task['browser'] for task in tasks))
+            for task in tasks:
+                version = self.feeds.versions(task['browser'], 'linux').get(task['channel'])
+                if version is not None:
+                    task['version'] = version
+                    if self.redirects is not None and 'url' in task and \
+                            version != self.get_validators(task['name']).get('version'):
+                        # New releases are usually published under a new redirect target
+                        self.redirects.invalidate(task['url'])
+
+    def install_thread(self):
+        """Do the actual install (or just the download or install half of it for --prefetch
+        and --apply)"""
+        if not os.path.isdir(self.install_dir):
+            os.makedirs(self.install_dir)
+        if self.options.apply:
+            # Only the staged channels, without any network requests
+            tasks = [task for task in self.get_tasks()
+                     if self.staging.get(task['name']) is not None and
+                     not self.is_pinned(task['name'])]
+        else:
+            tasks = []
+            for task in self.get_tasks():
+                if self.is_pinned(task['name']):
+                    print("{0} is pinned to a rolled back version (use --unpin to update it)".format(
+                        task['name']))
+                elif not self.is_fresh(task['name']):
+                    tasks.append(task)
+            if self.options.prefetch:
+                # Stay out of the way of the tests that run alongside the prefetch
+                os.nice(10)
+            self.scan(tasks)
+            self.discover(tasks)
+        for task in self.scheduler.sort(tasks):
+            if self.scheduler.begin(task['name']):
+                ok = False
+                try:
+                    if self.options.prefetch:
+                        ok = self.prefetch(task)
+                    elif self.options.apply:
+                        ok = self.apply(task)
+                    else:
+                        ok = self.process(task)
+                except Cancelled:
+                    logging.warning('%s ran out of time', task['name'])
+                self.scheduler.finish(task['name'], not ok)
+        self.timing.mark('update')
+        if self.metrics.records:
+            self.finish_run()
+            self.timing.mark('report')
+        elif self.options.apply:
+            print("Nothing is staged")
+
+##########################################################################
+#   Main Entry Point
+##########################################################################
+def parse_options(args=None):
+    """Parse the command-line options (sys.argv when args is None)"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Automated browser installer/updater.',
+                                     prog='browser_install_linux')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity (specify multiple times for more)."\
+                        " -vvvv for full debug output.")
+    parser.add_argument('-a', '--all', action='store_true', default=False,
+                        help="All supported browsers.")
+    parser.add_argument('-c', '--chrome', action='store_true', default=False, help="Chrome.")
+    parser.add_argument('-f', '--firefox', action='store_true', default=False, help="Firefox.")
+    parser.add_argument('-e', '--edge', action='store_true', default=False, help="Microsoft Edge.")
+    parser.add_argument('-r', '--brave', action='store_true', default=False, help="Brave.")
+    parser.add_argument('-s', '--stable', action='store_true', default=False,
+                        help="Stable releases.")
+    parser.add_argument('-b', '--beta', action='store_true', default=False,
+                        help="Beta releases (includes ESR and dev edition for Firefox).")
+    parser.add_argument('-d', '--dev', action='store_true', default=False,
+                        help="Dev releases (Nightly for Firefox and Brave, Dev channel for Chrome"\
+                        " and Edge).")
+    parser.add_argument('--prefetch', action='store_true', default=False,
+                        help="Download and extract the packages that changed into a staging"\
+                        " directory next to each install at a low priority without installing"\
+                        " them (can run alongside tests).")
+    parser.add_argument('--apply', action='store_true', default=False,
+                        help="Swap the packages staged by --prefetch into place without"\
+                        " downloading anything.")
+    parser.add_argument('--staging-dir',
+                        help="Directory the index of staged packages is kept in (default .staging"\
+                        " in the install directory).")
+    parser.add_argument('--install-dir', default='/opt/browser-install',
+                        help="Directory the browsers are installed in, one directory per channel"\
+                        " (default /opt/browser-install).")
+    parser.add_argument('--rollback', metavar='CHANNEL',
+                        help="Swap an archived version of a channel (i.e. \"Chrome Beta\") back"\
+                        " into place without downloading anything and pin the channel to it.")
+    parser.add_argument('--archive-dir',
+                        help="Directory replaced versions are archived in"\
+                        " (default .archive in the install directory).")
+    parser.add_argument('--deadline', type=int, default=3600,
+                        help="Seconds the whole run may take (default 3600, 0 for no limit)."\
+                        " Downloads still running at the deadline are stopped and no more"\
+                        " channels are swapped into place.")
+    add_common_options(parser)
+    options, _ = parser.parse_known_args(args)
+    if options.all:
+        options.chrome = True
+        options.firefox = True
+        options.edge = True
+        options.brave = True
+        options.stable = True
+        options.beta = True
+        options.dev = True
+    return options
+
+def main():
+    """Main entry point"""
+    timing = Timing(STARTED)
+    options = parse_options()
+
+    setup_logging(options.verbose)
+
+    start = time.time()
+    timing.mark('startup')
+    install = Install(options, timing)
+    timing.mark('setup')
+    install.install()
+
+    end = time.time()
+    elapsed = end - start
+    logging.debug("Browser install done, Elapsed Time: %0.4f", elapsed)
+    if options.timing:
+        timing.report()
+
+if __name__ == '__main__':
+    main()
@@ -14,138 +14,260 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-import json
 import logging
 import os
+import re
 import subprocess
 import time
-import requests
+from browser_common import STARTED, InstallBase, add_common_options, add_installer_options
+from browser_download import Cancelled, content_changed, download_file
+from browser_feeds import feed_confirms
+from browser_metrics import Timing
+from browser_scan import find_version, scanned_entry
 
-class Install(object):
+def browser_paths(universal):
+    """Installer download URLs for every browser channel (universal or Intel-only builds)"""
+    if universal:
+        chrome_path = {
+            'Stable': 'https://dl.google.com/chrome/mac/universal/stable/GGRO/googlechrome.dmg',
+            'Beta': 'https://dl.google.com/chrome/mac/universal/beta/googlechromebeta.dmg',
+            'Dev': 'https://dl.google.com/chrome/mac/universal/dev/googlechromedev.dmg',
+            'Canary': 'https://dl.google.com/chrome/mac/universal/canary/googlechromecanary.dmg'
+        }
+    else:
+        chrome_path = {
+            'Stable': 'https://dl.google.com/chrome/mac/stable/GGRO/googlechrome.dmg',
+            'Beta': 'https://dl.google.com/chrome/mac/beta/googlechromebeta.dmg',
+            'Dev': 'https://dl.google.com/chrome/mac/dev/googlechromedev.dmg',
+            'Canary': 'https://dl.google.com/chrome/mac/canary/googlechromecanary.dmg'
+        }
+    firefox_path = {
+        'Mozilla Firefox': 'https://download.mozilla.org/?product=firefox-latest-ssl&os=osx&lang=en-US',
+    }
+    return {'chrome': chrome_path, 'firefox': firefox_path}
+
+
+class Install(InstallBase):
     """Main installer logic"""
-    def __init__(self):
-        cpu = subprocess.check_output(['uname', '-m'], universal_newlines=True)
-        rosetta = subprocess.check_output(['sysctl', '-in', 'sysctl.proc_translated'], universal_newlines=True)
-        logging.debug("CPU Platform: %s, Translated: %s", cpu.strip(), rosetta.strip())
-        if cpu.startswith('arm') or int(rosetta) == 1:
-            self.chrome_path = {
-                'Stable': 'https://dl.google.com/chrome/mac/universal/stable/GGRO/googlechrome.dmg',
-                'Beta': 'https://dl.google.com/chrome/mac/universal/beta/googlechromebeta.dmg',
-                'Dev': 'https://dl.google.com/chrome/mac/universal/dev/googlechromedev.dmg',
-                'Canary': 'https://dl.google.com/chrome/mac/universal/canary/googlechromecanary.dmg'
-            }
-        else:
-            self.chrome_path = {
-                'Stable': 'https://dl.google.com/chrome/mac/stable/GGRO/googlechrome.dmg',
-                'Beta': 'https://dl.google.com/chrome/mac/beta/googlechromebeta.dmg',
-                'Dev': 'https://dl.google.com/chrome/mac/dev/googlechromedev.dmg',
-                'Canary': 'https://dl.google.com/chrome/mac/canary/googlechromecanary.dmg'
-            }
+    file_prefix = 'wpt_browser_'
+
+    def __init__(self, options, timing=None):
+        InstallBase.__init__(self, options, timing)
+        paths = browser_paths(self.detect_universal())
+        self.chrome_path = paths['chrome']
+        self.firefox_path = paths['firefox']
+        if options.mirror:
+            from browser_mirror import rewrite_paths
+            rewrite_paths(options.mirror, self.chrome_path)
+            rewrite_paths(options.mirror, self.firefox_path)
         self.chrome_apps = {
             'Stable': 'Google Chrome.app',
             'Beta': 'Google Chrome Beta.app',
             'Dev': 'Google Chrome Dev.app',
             'Canary': 'Google Chrome Canary.app'
         }
-        self.firefox_path = {
-            'Mozilla Firefox': 'https://download.mozilla.org/?product=firefox-latest-ssl&os=osx&lang=en-US',
+        self.firefox_apps = {
+            'Mozilla Firefox': 'Firefox.app'
         }
-        self.dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'tmp')
-        if not os.path.isdir(self.dir):
-            os.makedirs(self.dir)
-        self.status_file = os.path.join(self.dir, 'wpt_browser_install.json')
-        self.status = None
-        if os.path.isfile(self.status_file):
-            with open(self.status_file, 'r') as f_in:
-                self.status = json.load(f_in)
-        if self.status is None:
-            self.status = {}
-
-    def save_status(self):
-        """Save the installed state of the various browsers"""
-        if self.status:
-            with open(self.status_file, 'w') as f_out:
-                json.dump(self.status, f_out, indent=4)
-
-    def chrome(self, channel):
-        """Install the given Chrome channel"""
-        if channel in self.chrome_path:
-            url = self.chrome_path[channel]
-            name = 'Chrome ' + channel
-            print("Checking {0}...".format(name))
-            last_modified = None
-            if name in self.status:
-                last_modified = self.status[name]
-            dmg, modified = self.download_installer(url, last_modified, 'dmg')
-            if dmg is not None and os.path.isfile(dmg):
-                # Delete the current install
-                if channel in self.chrome_apps:
-                    app_path = os.path.join('/Applications', self.chrome_apps[channel])
-                    subprocess.call(['sudo', 'rm', '-rf', app_path])
-                # Install the new build
-                ret = self.install_dmg(dmg, 'Google Chrome')
-                if ret == 0 and modified is not None:
-                    self.status[name] = modified
-                try:
-                    os.remove(dmg)
-                except Exception:
-                    pass
-
-    def firefox(self, channel):
-        """Install the given Firefox channel"""
-        if channel in self.firefox_path:
-            url = self.firefox_path[channel]
-            name = 'Firefox ' + channel
-            print("Checking {0}...".format(name))
-            last_modified = None
-            if name in self.status:
-                last_modified = self.status[name]
-            dmg, modified = self.download_installer(url, last_modified, 'dmg')
-            if dmg is not None and os.path.isfile(dmg):
-                ret = self.install_dmg(dmg, 'Firefox')
-                if ret == 0 and modified is not None:
-                    self.status[name] = modified
-                try:
+
+    def detect_universal(self):
+        """Check if universal builds are needed (Apple Silicon, natively or under Rosetta).
+
+        The result is cached in the status file for the machine so the subprocesses only
+        run the first time."""
+        uname = os.uname()
+        cached = self.status.get('platform')
+        if isinstance(cached, dict) and cached.get('host') == uname[1] and \
+                cached.get('machine') == uname[4] and 'universal' in cached:
+            return cached['universal']
+        cpu = subprocess.check_output(['uname', '-m'], universal_newlines=True)
+        rosetta = subprocess.check_output(['sysctl', '-in', 'sysctl.proc_translated'], universal_newlines=True)
+        logging.debug("CPU Platform: %s, Translated: %s", cpu.strip(), rosetta.strip())
+        universal = cpu.startswith('arm') or int(rosetta) == 1
+        self.status['platform'] = {'host': uname[1], 'machine': uname[4], 'universal': universal}
+        self.store.update('platform', self.status['platform'])
+        return universal
+
+    def channel_name(self, browser, channel):
+        """Name of a channel in the status file and the output (i.e. "Chrome Beta")"""
+        return '{0} {1}'.format(browser.capitalize(), channel)
+
+    def get_tasks(self):
+        """List every channel in the order they should be installed"""
+        tasks = []
+        for browser, _ in self.browsers:
+            for channel in getattr(self, browser + '_path', {}):
+                tasks.append(self.task(browser, channel))
+        return tasks
+
+    def process(self, task):
+        """Install a single browser channel, False if the download or install failed"""
+        ok = True
+        name = task['name']
+        print("Checking {0}...".format(name))
+        previous = self.get_validators(name)
+        version = task.get('version')
+        if feed_confirms(version, previous):
+            print("{0} is up to date ({1})".format(name, version))
+            self.mark_checked(name, False)
+            return ok
+        record = self.metrics.begin(name, 'download')
+        stats = {}
+        base = self.delta_base(name)
+        dmg, validators = self.download_installer(name, task['url'], previous, 'dmg', stats, base)
+        self.metrics.end(record, **stats)
+        ok = stats.get('outcome') != 'error'
+        if stats.get('status') == 304:
+            self.mark_unchanged(name)
+        if validators is not None and version is not None:
+            validators['version'] = version
+        if dmg is not None and os.path.isfile(dmg) and not content_changed(previous, validators):
+            print("{0} installer has not changed".format(name))
+            self.set_status(name, validators)
+        elif dmg is not None and os.path.isfile(dmg) and self.scheduler.can_install(name):
+            record = self.metrics.begin(name, 'install')
+            ret = self.run_installer(task, dmg)
+            self.metrics.end(record, exit_code=ret)
+            if ret != 0:
+                print("Installing {0} failed: {1}".format(name, ret))
+                ok = False
+            if ret == 0 and validators:
+                self.set_status(name, validators)
+                self.archive.add(name, dmg, validators)
+                # Anything staged for the channel is older than what was just installed
+                self.staging.remove(name)
+        if dmg is not None and os.path.isfile(dmg):
+            try:
+                if base is not None and self.status.get(name) is validators:
+                    # Keep the installed version as the base for the next delta update
+                    os.replace(dmg, base)
+                else:
                     os.remove(dmg)
-                except Exception:
-                    pass
-
-    def download_installer(self, url, last_modified, extension):
-        """Download the given installer if it is newer"""
-        exe = None
-        modified = None
-        headers = None
-        if last_modified is not None:
-            headers = {'If-Modified-Since': last_modified}
-        dest = os.path.join(self.dir, 'browser.{}'.format(extension))
-        if os.path.isfile(dest):
+            except Exception:
+                pass
+        return ok
+
+    def prefetch(self, task):
+        """Download the dmg for a channel into the staging area if it changed, without
+        installing it (the request is conditional on the dmg that is already staged).
+        Returns False if the download failed."""
+        ok = True
+        name = task['name']
+        previous = self.get_validators(name)
+        version = task.get('version')
+        if feed_confirms(version, previous):
+            print("{0} is up to date ({1})".format(name, version))
+            self.mark_checked(name, False)
+            return ok
+        staged = self.staging.get(name)
+        print("Checking {0}...".format(name))
+        record = self.metrics.begin(name, 'download')
+        stats = {}
+        dest = os.path.join(self.staging.dir, 'browser_{0}.dmg'.format(re.sub(r'\W+', '_', name)))
+        dmg, validators = download_file(self.session, task['url'], dest,
+                                        staged['validators'] if staged is not None else previous,
+                                        segments=self.options.segments, cache=self.cache,
+                                        stats=stats, base=self.delta_base(name))
+        self.metrics.end(record, **stats)
+        if dmg is None or not os.path.isfile(dmg):
+            if stats.get('status') == 304:
+                if staged is not None:
+                    print("{0} is already staged".format(name))
+                else:
+                    self.mark_unchanged(name)
+            return stats.get('outcome') != 'error'
+        if version is not None:
+            validators['version'] = version
+        if not content_changed(previous, validators):
+            print("{0} installer has not changed".format(name))
+            self.set_status(name, validators)
+            self.staging.remove(name)
             try:
-                os.remove(dest)
+                os.remove(dmg)
             except Exception:
                 pass
+        else:
+            self.staging.add(name, dmg, validators)
+            print("Staged {0} (install it with --apply)".format(name))
+        return ok
+
+    def apply(self, task):
+        """Install the dmg that was staged for a channel by --prefetch, False if it was
+        corrupt or the install failed"""
+        name = task['name']
+        entry = self.staging.take(name)
+        if entry is None:
+            return False
+        dmg = entry['path']
+        validators = dict(entry['validators'])
+        base = self.delta_base(name)
+        ok = True
+        installed = False
+        if not content_changed(self.get_validators(name), validators):
+            print("{0} installer has not changed".format(name))
+            self.set_status(name, validators)
+            installed = True
+        elif self.scheduler.can_install(name):
+            print("Installing the staged {0}...".format(name))
+            record = self.metrics.begin(name, 'install')
+            ret = self.run_installer(task, dmg)
+            self.metrics.end(record, exit_code=ret)
+            if ret == 0:
+                self.set_status(name, validators)
+                self.archive.add(name, dmg, validators)
+                installed = True
+            else:
+                print("Installing {0} failed: {1}".format(name, ret))
+                ok = False
         try:
-            logging.debug('Downloading %s to %s', url, dest)
-            response = requests.get(url, headers=headers, stream=True, timeout=300)
-            if response.status_code == 200:
-                if 'Last-Modified' in response.headers:
-                    modified = response.headers['Last-Modified']
-                elif 'Date' in response.headers:
-                    modified = response.headers['Date']
-                with open(dest, 'wb') as f_out:
-                    for chunk in response.iter_content(chunk_size=4096):
-                        f_out.write(chunk)
-                exe = dest
-        except Exception as err:
-            msg = ''
-            if err is not None and err.__str__() is not None:
-                msg = err.__str__()
-            logging.exception("Download failed: %s", msg)
-        return exe, modified
+            if base is not None and installed:
+                # Keep the installed version as the base for the next delta update
+                os.replace(dmg, base)
+            else:
+                os.remove(dmg)
+        except Exception:
+            pass
+        return ok
+
+    def run_installer(self, task, dmg):
+        """Replace the installed app for a channel with the one in the given dmg (never while
+        a test is running)"""
+        self.throttle.wait()
+        if task['browser'] == 'chrome':
+            # Delete the current install
+            if task['channel'] in self.chrome_apps:
+                self.remove_app(self.chrome_apps[task['channel']])
+            ret = self.install_dmg(dmg, 'Google Chrome')
+        else:
+            ret = self.install_dmg(dmg, 'Firefox')
+        return ret
+
+    def delta_base(self, name):
+        """Where the previous version of an installer is kept for delta updates (if enabled)"""
+        base = None
+        if self.options.delta and self.options.mirror:
+            base = os.path.join(self.dir, re.sub(r'\W+', '_', name) + '.base.dmg')
+        return base
+
+    def download_installer(self, name, url, validators, extension, stats=None, base=None):
+        """Download the given installer for a channel if it is newer"""
+        # Every channel gets its own file so an interrupted download isn't discarded by the
+        # next channel in the run (and can be resumed by the next run)
+        dest = os.path.join(self.dir, 'browser_{0}.{1}'.format(re.sub(r'\W+', '_', name), extension))
+        return download_file(self.session, url, dest, validators, segments=self.options.segments,
+                             cache=self.cache, stats=stats, base=base)
 
     def install_dmg(self, dmg, mount_prefix):
-        """Install a browser from a dmg file"""
+        """Install a browser from a dmg file.
+
+        Returns 0 if the app was copied to /Applications, otherwise the exit code of the step
+        that failed (1 if the dmg has no app in it). run_installer passes it on, so a failed
+        install is not recorded as the installed version."""
+        ret = 1
         self.unmount(mount_prefix)
-        subprocess.call(['sudo', 'hdiutil', 'attach', dmg])
+        attached = subprocess.call(['sudo', 'hdiutil', 'attach', dmg])
+        if attached != 0:
+            return attached
         # Figure out the volume name where it mounted
         for volume in os.listdir('/Volumes'):
             if volume.startswith(mount_prefix):
@@ -153,36 +275,129 @@ class Install(object):
                 for app in os.listdir(volume_path):
                     if app.endswith('app'):
                         app_path = os.path.join(volume_path, app)
-                        subprocess.call(['sudo', 'cp', '-R', app_path, '/Applications/'])
+                        ret = subprocess.call(['sudo', 'cp', '-R', app_path, '/Applications/'])
         self.unmount(mount_prefix)
+        return ret
     
+    def remove_app(self, app):
+        """Delete an installed app bundle"""
+        subprocess.call(['sudo', 'rm', '-rf', os.path.join('/Applications', app)])
+
     def unmount(self, mount_prefix):
         """Unmount all volumes with the given prefix"""
         for volume in os.listdir('/Volumes'):
             if volume.startswith(mount_prefix):
                 subprocess.call(['sudo', 'hdiutil', 'detach', os.path.join('/Volumes', volume)])
 
+    def scan(self, tasks):
+        """Rebuild the status of channels that are installed but missing from the status file
+        (i.e. after it was lost) from the Info.plist of the installed apps"""
+        roots = self.options.scan_root if self.options.scan_root else ['/Applications']
+        apps = {'chrome': self.chrome_apps, 'firefox': self.firefox_apps}
+        for task in tasks:
+            app = apps[task['browser']].get(task['channel'])
+            if task['name'] not in self.status and app is not None:
+                version = find_version(roots, app)
+                if version is not None:
+                    logging.info('Found %s %s already installed', task['name'], version)
+                    entry = scanned_entry(version)
+                    with self.status_lock:
+                        self.status[task['name']] = entry
+                        self.store.update(task['name'], entry)
+
+    def discover(self, tasks):
+        """Look up the current version of the given channels in the vendor release feeds"""
+        if self.feeds is not None and tasks:
+            self.feeds.refresh(set(task['browser'] for task in tasks))
+            for task in tasks:
+                version = self.feeds.versions(task['browser'], 'mac').get(task['channel'])
+                if version is not None:
+                    task['version'] = version
+                    if self.redirects is not None and \
+                            version != self.get_validators(task['name']).get('version'):
+                        # New releases are usually published under a new redirect target
+                        self.redirects.invalidate(task['url'])
+
     def install_thread(self):
-        """Do the actual install"""
-        for channel in self.chrome_path:
-            self.chrome(channel)
-        for channel in self.firefox_path:
-            self.firefox(channel)
-        self.save_status()
-
-    def install(self):
-        """Run the install (in a background thread) for up to an hour"""
-        import threading
-        thread = threading.Thread(target=self.install_thread)
-        thread.daemon = True
-        thread.start()
-        thread.join(3600)
+        """Do the actual install (or just the download or install half of it for --prefetch
+        and --apply)"""
+        if self.options.apply:
+            # Only the staged channels, without any network requests
+            tasks = [task for task in self.get_tasks()
+                     if self.staging.get(task['name']) is not None and
+                     not self.is_pinned(task['name'])]
+        else:
+            tasks = []
+            for task in self.get_tasks():
+                if self.is_pinned(task['name']):
+                    print("{0} is pinned to a rolled back version (use --unpin to update it)".format(
+                        task['name']))
+                elif not self.is_fresh(task['name']):
+                    tasks.append(task)
+            if self.options.prefetch:
+                # Stay out of the way of the tests that run alongside the prefetch
+                os.nice(10)
+            self.scan(tasks)
+            self.discover(tasks)
+        for task in self.scheduler.sort(tasks):
+            if self.scheduler.begin(task['name']):
+                ok = False
+                try:
+                    if self.options.prefetch:
+                        ok = self.prefetch(task)
+                    elif self.options.apply:
+                        ok = self.apply(task)
+                    else:
+                        ok = self.process(task)
+                except Cancelled:
+                    logging.warning('%s ran out of time', task['name'])
+                self.scheduler.finish(task['name'], not ok)
+        self.timing.mark('update')
+        if self.metrics.records:
+            self.finish_run()
+            self.timing.mark('report')
+        elif self.options.apply:
+            print("Nothing is staged")
 
 ##########################################################################
 #   Main Entry Point
 ##########################################################################
+def parse_options(args=None):
+    """Parse the command-line options (sys.argv when args is None)"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Automated browser installer/updater.',
+                                     prog='browser_install_macos')
+    parser.add_argument('--prefetch', action='store_true', default=False,
+                        help="Download the installers that changed into the staging area at a low"\
+                        " priority without installing them (can run alongside tests).")
+    parser.add_argument('--apply', action='store_true', default=False,
+                        help="Install the installers staged by --prefetch without downloading"\
+                        " anything.")
+    parser.add_argument('--staging-dir',
+                        help="Directory --prefetch stages the installers in (default tmp/staging).")
+    parser.add_argument('--rollback', metavar='CHANNEL',
+                        help="Reinstall an archived installer for a channel (i.e. \"Chrome Beta\")"\
+                        " without downloading anything and pin the channel to it.")
+    parser.add_argument('--archive-dir',
+                        help="Directory the installers are archived in (default tmp/archive).")
+    parser.add_argument('--scan-root', action='append',
+                        help="Directory to look for existing installs in when a channel is"\
+                        " missing from the status file (default /Applications, can be"\
+                        " repeated).")
+    parser.add_argument('--deadline', type=int, default=3600,
+                        help="Seconds the whole run may take (default 3600, 0 for no limit)."\
+                        " Downloads still running at the deadline are stopped (and resumed by"\
+                        " the next run) and no more installers are started.")
+    add_installer_options(parser)
+    add_common_options(parser)
+    options, _ = parser.parse_known_args(args)
+    return options
+
 def main():
     """Main entry point"""
+    timing = Timing(STARTED)
+    options = parse_options()
+
     # Set up logging
     logging.basicConfig(level=logging.DEBUG, format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
 
@@ -199,12 +414,16 @@ def main():
                 pass
 
     start = time.time()
-    install = Install()
+    timing.mark('startup')
+    install = Install(options, timing)
+    timing.mark('setup')
     install.install()
 
     end = time.time()
     elapsed = end - start
     logging.debug("Browser install done, Elapsed Time: %0.4f", elapsed)
+    if options.timing:
+        timing.report()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+class Metrics(object):
+    """Timing and throughput of the probe, download and install phases of every channel"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.start = time.time()
+        self.host = None
+
+    def begin(self, channel, phase):
+        """Start timing a phase, returning the record to fill in and pass to end()"""
+        return {'channel': channel, 'phase': phase, 'start': time.time()}
+
+    def end(self, record, **fields):
+        """Finish timing a phase and keep the record"""
+        record.update(fields)
+        record['duration'] = time.time() - record['start']
+        if record.get('bytes') and record['duration'] > 0:
+            record['throughput'] = record['bytes'] / record['duration']
+        with self.lock:
+            self.records.append(record)
+        logging.debug('%s %s: %0.3fs', record['channel'], record['phase'], record['duration'])
+        return record
+
+    def write_jsonl(self, path):
+        """Append one JSON object per channel phase to a JSON-lines file"""
+        with self.lock:
+            records = list(self.records)
+        if self.host is None:
+            import platform
+            self.host = platform.node()
+        try:
+            with open(path, 'a') as f_out:
+                for record in records:
+                    line = dict(record)
+                    line['host'] = self.host
+                    line['run'] = self.start
+                    f_out.write(json.dumps(line, sort_keys=True) + '\n')
+        except Exception:
+            logging.exception('Error writing metrics to %s', path)
+
+    def write_prometheus(self, path):
+        """Write the metrics in the Prometheus node-exporter textfile collector format"""
+        with self.lock:
+            records = list(self.records)
+        lines = [
+            '# HELP browser_install_phase_seconds Duration of each probe, download and install.',
+            '# TYPE browser_install_phase_seconds gauge',
+        ]
+        for record in records:
+            lines.append('browser_install_phase_seconds{{{0}}} {1:f}'.format(
+                self.labels(record), record['duration']))
+        lines.extend([
+            '# HELP browser_install_http_status HTTP status of the last probe or download.',
+            '# TYPE browser_install_http_status gauge'])
+        for record in records:
+            if record.get('status') is not None:
+                lines.append('browser_install_http_status{{{0}}} {1:d}'.format(
+                    self.labels(record), record['status']))
+        lines.extend([
+            '# HELP browser_install_download_bytes Bytes transferred downloading the installer.',
+            '# TYPE browser_install_download_bytes gauge'])
+        for record in records:
+            if record['phase'] == 'download':
+                lines.append('browser_install_download_bytes{{{0}}} {1:d}'.format(
+                    self.labels(record), record.get('bytes', 0)))
+        lines.extend([
+            '# HELP browser_install_download_bytes_per_second Installer download throughput.',
+            '# TYPE browser_install_download_bytes_per_second gauge'])
+        for record in records:
+            if record['phase'] == 'download' and record.get('throughput') is not None:
+                lines.append('browser_install_download_bytes_per_second{{{0}}} {1:f}'.format(
+                    self.labels(record), record['throughput']))
+        lines.extend([
+            '# HELP browser_install_last_run_timestamp_seconds When the installer last ran.',
+            '# TYPE browser_install_last_run_timestamp_seconds gauge',
+            'browser_install_last_run_timestamp_seconds {0:f}'.format(self.start)])
+        # The collector may read the file at any time so it has to be replaced atomically
+        try:
+            tmp_file = path + '.tmp'
+            with open(tmp_file, 'w') as f_out:
+                f_out.write('\n'.join(lines) + '\n')
+            os.replace(tmp_file, path)
+        except Exception:
+            logging.exception('Error writing metrics to %s', path)
+
+    def labels(self, record):
+        """Prometheus labels for a record"""
+        labels = 'channel="{0}",phase="{1}"'.format(record['channel'].replace('"', ''),
+                                                   record['phase'])
+        if record.get('outcome') is not None:
+            labels += ',outcome="{0}"'.format(record['outcome'])
+        return labels
+
+    def write(self, jsonl_file, prometheus_file):
+        """Write the metrics to whichever outputs are configured"""
+        if jsonl_file:
+            self.write_jsonl(jsonl_file)
+        if prometheus_file:
+            self.write_prometheus(prometheus_file)
+
+
+def process_start():
+    """When this process started according to the OS, None where it can't say cheaply"""
+    started = None
+    try:
+        if os.path.isfile('/proc/self/stat'):
+            with open('/proc/self/stat', 'r') as f_in:
+                stat = f_in.read()
+            with open('/proc/uptime', 'r') as f_in:
+                uptime = float(f_in.read().split()[0])
+            # Field 22 is the start time in clock ticks since boot (the command name before
+            # it is in parentheses and can contain spaces)
+            ticks = int(stat.rsplit(')', 1)[1].split()[19])
+            started = time.time() - (uptime - float(ticks) / os.sysconf('SC_CLK_TCK'))
+        elif os.name == 'nt':
+            import ctypes
+            from ctypes import wintypes
+            times = [wintypes.FILETIME() for _ in range(4)]
+            kernel32 = ctypes.windll.kernel32
+            if kernel32.GetProcessTimes(kernel32.GetCurrentProcess(),
+                                        *[ctypes.byref(filetime) for filetime in times]):
+                # 100ns intervals since 1601
+                created = (times[0].dwHighDateTime << 32) + times[0].dwLowDateTime
+                started = created / 10000000.0 - 11644473600
+    except Exception:
+        logging.debug('Error finding the process start time', exc_info=True)
+    return started
+
+
+class Timing(object):
+    """Wall-clock time spent in each step of a run, to keep the overhead of no-op runs low"""
+    def __init__(self, start=None):
+        self.start = start if start is not None else time.time()
+        self.last = self.start
+        self.steps = []
+
+    def mark(self, step):
+        """Record the time since the previous mark as the given step"""
+        now = time.time()
+        self.steps.append((step, now - self.last))
+        self.last = now
+
+    def report(self):
+        """Print the time taken by each step, starting with the interpreter startup when the
+        OS says when the process started"""
+        start = self.start
+        started = process_start()
+        if started is not None and started < self.start:
+            print("{0:<12} {1:8.1f} ms".format('interpreter', (self.start - started) * 1000.0))
+            start = started
+        for step, elapsed in self.steps:
+            print("{0:<12} {1:8.1f} ms".format(step, elapsed * 1000.0))
+        if start == started:
+            print("{0:<12} {1:8.1f} ms".format('total', (self.last - start) * 1000.0))
+        else:
+            print("{0:<12} {1:8.1f} ms (since import)".format('total', (self.last - start) * 1000.0))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from browser_delta import write_block_index
+from browser_download import download_file
+
+def mirror_key(url):
+    """Path on the mirror that serves the given upstream URL"""
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def mirror_url(mirror, url):
+    """Rewrite an upstream installer URL to the copy on the given mirror"""
+    return mirror.rstrip('/') + '/' + mirror_key(url)
+
+
+def rewrite_paths(mirror, paths):
+    """Point every channel in a browser path dictionary at the mirror"""
+    for channel in paths:
+        paths[channel] = mirror_url(mirror, paths[channel])
+
+
+def upstream_urls():
+    """Every installer URL for every platform variant of the Windows and macOS installers"""
+    import browser_install
+    import browser_install_macos
+    urls = []
+    for paths in [browser_install.browser_paths(True), browser_install.browser_paths(False),
+                  browser_install_macos.browser_paths(True),
+                  browser_install_macos.browser_paths(False)]:
+        for browser in sorted(paths.keys()):
+            for channel in sorted(paths[browser].keys()):
+                if paths[browser][channel] not in urls:
+                    urls.append(paths[browser][channel])
+    return urls
+
+
+class Mirror(object):
+    """Local copy of the upstream installers, kept fresh and served to the rest of the fleet"""
+    def __init__(self, urls, directory, session):
+        self.urls = urls
+        self.dir = directory
+        self.session = session
+        self.lock = threading.Lock()
+        self.index_file = os.path.join(directory, 'mirror.json')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index = self.load_index()
+
+    def load_index(self):
+        """Load the mirror index from disk (a missing or corrupt one means starting over)"""
+        index = None
+        try:
+            if os.path.isfile(self.index_file):
+                with open(self.index_file, 'r') as f_in:
+                    index = json.load(f_in)
+        except Exception:
+            logging.exception('Error loading the mirror index')
+        if not isinstance(index, dict):
+            index = {}
+        return index
+
+    def refresh(self):
+        """Fetch any upstream installers that changed since the last refresh"""
+        for url in self.urls:
+            key = mirror_key(url)
+            with self.lock:
+                entry = dict(self.index.get(key, {}))
+            if not os.path.isfile(os.path.join(self.dir, key)):
+                entry = {}
+            dest = os.path.join(self.dir, key + '.download')
+            path, validators = download_file(self.session, url, dest, entry)
+            if path is not None and validators is not None:
+                if validators.get('sha256') == entry.get('sha256') and 'changed' in entry:
+                    validators['changed'] = entry['changed']
+                else:
+                    validators['changed'] = int(time.time())
+                    logging.info('Mirror updated %s', url)
+                validators['url'] = url
+                os.replace(path, os.path.join(self.dir, key))
+                with self.lock:
+                    self.index[key] = validators
+                    self.save_index()
+            # Publish the block index for clients doing delta updates
+            object_path = os.path.join(self.dir, key)
+            if os.path.isfile(object_path) and \
+                    (path is not None or not os.path.isfile(object_path + '.blocks')):
+                write_block_index(object_path)
+
+    def save_index(self):
+        """Write the mirror index atomically"""
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f_out:
+            json.dump(self.index, f_out, indent=4)
+        os.replace(tmp_file, self.index_file)
+
+    def lookup(self, key):
+        """Get the index entry for a mirrored installer"""
+        entry = None
+        with self.lock:
+            if key in self.index and os.path.isfile(os.path.join(self.dir, key)):
+                entry = dict(self.index[key])
+        return entry
+
+    def refresh_thread(self, interval):
+        """Keep refreshing the mirror in the background"""
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logging.exception('Error refreshing the mirror')
+            time.sleep(interval)
+
+    def serve(self, host, port, interval):
+        """Serve the mirrored installers over HTTP, refreshing them every interval seconds"""
+        thread = threading.Thread(target=self.refresh_thread, args=(interval,))
+        thread.daemon = True
+        thread.start()
+        server = ThreadingHTTPServer((host, port), MirrorRequestHandler)
+        server.mirror = self
+        logging.info('Serving the installer mirror on port %d', server.server_address[1])
+        server.serve_forever()
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    """Serves mirrored installers with Last-Modified/ETag validation and byte ranges"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def do_HEAD(self):
+        """Respond to a HEAD request"""
+        self.respond(False)
+
+    def do_GET(self):
+        """Respond to a GET request"""
+        self.respond(True)
+
+    def send_empty(self, status, headers=None):
+        """Send a response without a body"""
+        self.send_response(status)
+        if headers is not None:
+            for name in headers:
+                self.send_header(name, headers[name])
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_block_index(self, key, send_body):
+        """Serve the block index of a mirrored installer for delta updates"""
+        mirror = self.server.mirror
+        index_file = os.path.join(mirror.dir, key + '.blocks')
+        if mirror.lookup(key) is None or not os.path.isfile(index_file):
+            self.send_empty(404)
+            return
+        with open(index_file, 'rb') as f_in:
+            body = f_in.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def respond(self, send_body):
+        """Serve an installer (or the index of mirrored installers)"""
+        mirror = self.server.mirror
+        key = urlparse(self.path).path.strip('/')
+        if key == 'index.json':
+            with mirror.lock:
+                body = json.dumps(mirror.index, indent=4).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            return
+        if key.endswith('.blocks'):
+            self.send_block_index(key[:-7], send_body)
+            return
+        entry = mirror.lookup(key)
+        if entry is None:
+            self.send_empty(404)
+            return
+        path = os.path.join(mirror.dir, key)
+        size = os.path.getsize(path)
+        last_modified = email.utils.formatdate(entry['changed'], usegmt=True)
+        etag = '"{0}"'.format(entry['sha256'])
+        validators = {'ETag': etag, 'Last-Modified': last_modified}
+        if_none_match = self.headers.get('If-None-Match')
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_none_match is not None:
+            if etag in [value.strip() for value in if_none_match.split(',')] or \
+                    if_none_match.strip() == '*':
+                self.send_empty(304, validators)
+                return
+        elif if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None and entry['changed'] <= email.utils.mktime_tz(since):
+                self.send_empty(304, validators)
+                return
+        start = 0
+        end = size - 1
+        status = 200
+        requested = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if requested is not None and requested.startswith('bytes=') and ',' not in requested and \
+                (if_range is None or if_range in [etag, last_modified]):
+            first, last = requested[6:].split('-', 1)
+            if first:
+                start = int(first)
+                if last:
+                    end = min(int(last), size - 1)
+            elif last:
+                start = max(size - int(last), 0)
+            if start > end:
+                self.send_empty(416, {'Content-Range': 'bytes */{0:d}'.format(size)})
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {0:d}-{1:d}/{2:d}'.format(start, end, size))
+        self.end_headers()
+        if send_body:
+            with open(path, 'rb') as f_in:
+                f_in.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f_in.read(min(65536, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
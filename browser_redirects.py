@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+class RedirectCache(object):
+    """Where the vendor download endpoints redirect to, so requests can go straight to the
+    CDN object instead of following the redirect chain every time.
+
+    Targets are kept (in cache_file) for ttl seconds. A new release is usually published
+    under a new target, so ttl bounds how long it can take to notice one."""
+    def __init__(self, cache_file, ttl=3600):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.targets = {}
+        self.dirty = False
+        try:
+            if os.path.isfile(cache_file):
+                with open(cache_file, 'r') as f_in:
+                    self.targets = json.load(f_in)
+        except Exception:
+            logging.exception('Error loading the redirect cache')
+        if not isinstance(self.targets, dict):
+            self.targets = {}
+
+    def lookup(self, url):
+        """Get the cached target of url (None if there isn't one or it expired)"""
+        target = None
+        with self.lock:
+            entry = self.targets.get(url)
+            if entry is not None:
+                age = time.time() - entry.get('resolved', 0)
+                if 0 <= age < self.ttl:
+                    target = entry['target']
+        return target
+
+    def store(self, url, target):
+        """Remember where url redirected to (restarting the ttl)"""
+        with self.lock:
+            entry = self.targets.get(url)
+            if entry is None or entry['target'] != target:
+                logging.debug('%s redirects to %s', url, target)
+            self.targets[url] = {'target': target, 'resolved': time.time()}
+            self.dirty = True
+
+    def invalidate(self, url):
+        """Forget the target of url so it is resolved again"""
+        with self.lock:
+            if self.targets.pop(url, None) is not None:
+                self.dirty = True
+
+    def save(self):
+        """Write the cache atomically (if it changed)"""
+        if self.dirty:
+            try:
+                tmp_file = self.cache_file + '.{0:d}.tmp'.format(os.getpid())
+                with self.lock:
+                    with open(tmp_file, 'w') as f_out:
+                        json.dump(self.targets, f_out, indent=4)
+                    self.dirty = False
+                os.replace(tmp_file, self.cache_file)
+            except Exception:
+                logging.exception('Error saving the redirect cache')
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Versions of the browsers that are already installed.
+
+The versions are read straight from the install directories (Firefox application.ini,
+the version directories of Chromium-based browsers on Windows and the Info.plist of
+macOS app bundles) so the installed state can be rebuilt when the status file is lost.
+Everything is plain file parsing, so the scanner works on any OS against a copy of
+the directory layout.
+"""
+import logging
+import os
+import plistlib
+import re
+import time
+from browser_feeds import version_key
+
+# Chromium-based browsers on Windows keep each version in a directory named after it
+VERSION_DIR = re.compile(r'^\d+(\.\d+)+$')
+
+def ini_version(path):
+    """Version from a Firefox application.ini ([App] Version)"""
+    version = None
+    section = None
+    with open(path, 'rb') as f_in:
+        for line in f_in.read().decode('utf-8', 'replace').splitlines():
+            line = line.strip().lstrip(u'\ufeff')
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1].strip()
+            elif section == 'App' and '=' in line:
+                key, value = line.split('=', 1)
+                if key.strip() == 'Version' and value.strip():
+                    version = value.strip()
+    return version
+
+
+def plist_version(path):
+    """Version from the Info.plist of an app bundle (XML or binary)"""
+    version = None
+    with open(path, 'rb') as f_in:
+        if hasattr(plistlib, 'load'):
+            info = plistlib.load(f_in)
+        else:
+            info = plistlib.readPlist(f_in)
+    for key in ['CFBundleShortVersionString', 'CFBundleVersion']:
+        if isinstance(info.get(key), str) and info[key]:
+            version = info[key]
+            break
+    return version
+
+
+def directory_version(path):
+    """Newest version directory in a Chromium Application directory (an update can leave
+    the previous version next to the new one until the browser restarts)"""
+    version = None
+    for name in os.listdir(path):
+        if VERSION_DIR.match(name) and os.path.isdir(os.path.join(path, name)):
+            if version is None or version_key(name) > version_key(version):
+                version = name
+    return version
+
+
+def installed_version(path):
+    """Version of the browser installed at path (None if it isn't installed or there
+    is nothing to read the version from)"""
+    version = None
+    try:
+        if path.endswith('.app'):
+            info = os.path.join(path, 'Contents', 'Info.plist')
+            if os.path.isfile(info):
+                version = plist_version(info)
+        elif os.path.isfile(os.path.join(path, 'application.ini')):
+            version = ini_version(os.path.join(path, 'application.ini'))
+        elif os.path.isdir(path):
+            version = directory_version(path)
+    except Exception as err:
+        logging.warning('Error reading the installed version from %s: %s', path, err.__str__())
+    return version
+
+
+def find_version(roots, relative):
+    """Version of the first install of relative found under any of the roots"""
+    version = None
+    for root in roots:
+        if root:
+            version = installed_version(os.path.join(root, relative))
+            if version is not None:
+                logging.debug('Found %s in %s', version, os.path.join(root, relative))
+                break
+    return version
+
+
+def scanned_entry(version):
+    """Status entry for a channel that was found installed but has no download validators.
+
+    The version was read from the install itself, so it counts as checked for the release
+    feeds (which can then confirm the channel without downloading it). It does not count
+    as confirmed up to date for --fresh."""
+    return {'version': version, 'validator': None, 'scanned': True, 'probed': int(time.time())}
+
+##########################################################################
+#   Main Entry Point
+##########################################################################
+def main():
+    """Main entry point"""
+    import argparse
+    parser = argparse.ArgumentParser(description='Print the version of installed browsers.',
+                                     prog='browser_scan')
+    parser.add_argument('paths', nargs='+',
+                        help="Install directories, Chromium Application directories or app"\
+                        " bundles.")
+    options = parser.parse_args()
+    for path in options.paths:
+        print("{0}: {1}".format(path, installed_version(path)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+import threading
+import time
+from browser_download import Cancelled
+
+# Seconds an installer that is already running gets to finish after the deadline
+INSTALL_GRACE = 600
+# How each outcome is listed in the end-of-run report
+OUTCOMES = [('completed', 'Completed'), ('failed', 'Failed'), ('timed-out', 'Timed out'),
+            ('skipped', 'Skipped')]
+
+def channel_level(channel):
+    """Release level of a channel (stable, beta or dev), the same as the selection options"""
+    level = 'beta'
+    lower = channel.lower()
+    if lower in ['stable', 'mozilla firefox']:
+        level = 'stable'
+    elif lower in ['dev', 'canary'] or lower.endswith('nightly'):
+        level = 'dev'
+    return level
+
+
+class Scheduler(object):
+    """Works through the channels of a run in priority order within a deadline for the
+    whole run (seconds, 0 for none) and a time budget for each channel (0 for none).
+
+    Downloads check in through HttpSession and raise Cancelled once they run out of
+    time, which leaves a partial download that the next run resumes. Running installers
+    are never interrupted, they just aren't started once the run is out of time.
+
+    priority is a comma-separated list of release levels (stable, beta, dev), browsers
+    or channel names; channels are ordered by the first item they match."""
+    def __init__(self, deadline=3600, budget=0, priority=None):
+        self.deadline = deadline
+        self.budget = budget
+        self.priority = []
+        if priority:
+            self.priority = [item.strip().lower() for item in priority.split(',') if item.strip()]
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Start the clock for a new run"""
+        with self.lock:
+            self.start = time.time()
+            self.end = self.start + self.deadline if self.deadline > 0 else None
+            self.active = {}
+            self.outcomes = {}
+            self.order = []
+
+    def remaining(self):
+        """Seconds left in the run (None if it has no deadline)"""
+        remaining = None
+        if self.end is not None:
+            remaining = max(self.end - time.time(), 0)
+        return remaining
+
+    def expired(self):
+        """Check if the run is out of time"""
+        return self.end is not None and time.time() >= self.end
+
+    def rank(self, task):
+        """Sort key for a channel: the first priority item it matches"""
+        keys = [channel_level(task['channel']), task['browser'].lower(), task['name'].lower()]
+        for index, item in enumerate(self.priority):
+            if item in keys:
+                return index
+        return len(self.priority)
+
+    def sort(self, tasks):
+        """Order channels by priority (keeping the selection order otherwise)"""
+        return sorted(tasks, key=self.rank)
+
+    def begin(self, name):
+        """Start working on a channel in the current thread, False if there is no time left"""
+        if self.expired():
+            print("Skipping {0}, out of time".format(name))
+            self.record(name, 'skipped')
+            return False
+        end = self.end
+        if self.budget > 0:
+            end = min(end, time.time() + self.budget) if end is not None else \
+                time.time() + self.budget
+        with self.lock:
+            self.active[name] = {'end': end, 'cancelled': False}
+        self.local.name = name
+        return True
+
+    def current(self):
+        """Channel the current thread is working on (None if it isn't working on one)"""
+        return getattr(self.local, 'name', None)
+
+    def attach(self, name):
+        """Work on a channel from another thread (i.e. a download segment)"""
+        self.local.name = name
+
+    def check(self):
+        """Raise Cancelled if the run (or the channel the current thread is working on) is out
+        of time"""
+        now = time.time()
+        name = self.current()
+        with self.lock:
+            task = self.active.get(name) if name is not None else None
+            end = task['end'] if task is not None else self.end
+            if end is not None and now >= end:
+                if task is not None:
+                    task['cancelled'] = True
+                raise Cancelled('Out of time{0}'.format(' for ' + name if task is not None else ''))
+
+    def can_install(self, name):
+        """Check if there is time left to start the installer for a channel"""
+        allowed = True
+        if self.expired():
+            print("Not installing {0}, out of time".format(name))
+            with self.lock:
+                if name in self.active:
+                    self.active[name]['cancelled'] = True
+            allowed = False
+        return allowed
+
+    def finish(self, name, failed=False):
+        """Done working on a channel (failed if its download or install did not work out)"""
+        with self.lock:
+            task = self.active.pop(name, None)
+        if self.current() == name:
+            self.local.name = None
+        if task is not None:
+            outcome = 'completed'
+            if task['cancelled']:
+                outcome = 'timed-out'
+            elif failed:
+                outcome = 'failed'
+            self.record(name, outcome)
+
+    def record(self, name, outcome):
+        """Record the outcome of a channel (only the first one counts)"""
+        with self.lock:
+            if name not in self.outcomes:
+                self.outcomes[name] = outcome
+                self.order.append(name)
+        logging.debug('%s: %s', name, outcome)
+
+    def report(self):
+        """Print which channels were completed, failed, timed out or skipped"""
+        for outcome, label in OUTCOMES:
+            names = [name for name in self.order if self.outcomes[name] == outcome]
+            if names:
+                print("{0}: {1}".format(label, ', '.join(names)))
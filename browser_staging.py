@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from browser_archive import remove_path
+from browser_download import file_hash
+from browser_status import FileLock
+
+def tree_hash(path):
+    """SHA-256 over the layout and content of a directory (the names, permissions and
+    content of its files and the targets of its symlinks)"""
+    hasher = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            full_path = os.path.join(root, name)
+            relative = os.path.relpath(full_path, path).replace(os.sep, '/')
+            if os.path.islink(full_path):
+                hasher.update('l {0} {1}\n'.format(relative, os.readlink(full_path))
+                              .encode('utf-8'))
+            elif os.path.isdir(full_path):
+                hasher.update('d {0}\n'.format(relative).encode('utf-8'))
+            else:
+                mode = os.stat(full_path).st_mode & 0o777
+                hasher.update('f {0} {1:o} {2}\n'.format(relative, mode, file_hash(full_path))
+                              .encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class StagingArea(object):
+    """Installers that were downloaded ahead of time (--prefetch) and are ready to be
+    installed (--apply), with the validators of each one.
+
+    Prefetch and apply runs are separate processes so the index is re-read under a file
+    lock for every change. Installer files are moved into the staging directory,
+    extracted packages (Linux) are left where they were extracted so they can be renamed
+    into place. The layout and content of a directory are hashed when it is staged since
+    the package it came from is gone by then."""
+    def __init__(self, directory):
+        self.dir = directory
+        self.index_file = os.path.join(directory, 'index.json')
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file_lock = FileLock(self.index_file + '.lock')
+
+    def load_index(self):
+        """Load the staging index from disk"""
+        index = None
+        try:
+            if os.path.isfile(self.index_file):
+                with open(self.index_file, 'r') as f_in:
+                    index = json.load(f_in)
+        except Exception:
+            logging.exception('Error loading the staging index')
+        if not isinstance(index, dict):
+            index = {}
+        return index
+
+    def save_index(self, index):
+        """Write the index atomically"""
+        tmp_file = self.index_file + '.{0:d}.tmp'.format(os.getpid())
+        with open(tmp_file, 'w') as f_out:
+            json.dump(index, f_out, indent=4)
+        os.replace(tmp_file, self.index_file)
+
+    def staged_path(self, name, path):
+        """Where the installer for a channel is kept once it is staged"""
+        if os.path.isdir(path):
+            return path
+        return os.path.join(self.dir, re.sub(r'\W+', '_', name) + os.path.splitext(path)[1])
+
+    def add(self, name, path, validators):
+        """Stage the installer that was just downloaded for a channel (replacing the one
+        that was staged before)"""
+        dest = self.staged_path(name, path)
+        tree = tree_hash(path) if os.path.isdir(path) else None
+        with self.lock:
+            with self.file_lock:
+                if dest != path:
+                    try:
+                        os.replace(path, dest)
+                    except Exception:
+                        shutil.move(path, dest)
+                index = self.load_index()
+                previous = index.get(name)
+                if previous is not None and previous['path'] != dest:
+                    remove_path(previous['path'])
+                index[name] = {'path': dest,
+                               'staged': int(time.time()),
+                               'validators': dict(validators)}
+                if tree is not None:
+                    index[name]['tree'] = tree
+                self.save_index(index)
+        logging.debug('Staged %s for %s', dest, name)
+
+    def get(self, name):
+        """Get the staged installer for a channel (None if there isn't one)"""
+        with self.lock:
+            with self.file_lock:
+                entry = self.load_index().get(name)
+        if entry is not None and not os.path.exists(entry['path']):
+            entry = None
+        return entry
+
+    def take(self, name):
+        """Remove the staged installer for a channel from the index so it can be installed,
+        checking that the file (or directory) is still intact.
+
+        Returns the entry with the path and validators of the installer (None if there is
+        no usable installer staged)."""
+        with self.lock:
+            with self.file_lock:
+                index = self.load_index()
+                entry = index.pop(name, None)
+                if entry is not None:
+                    self.save_index(index)
+        if entry is not None and not os.path.exists(entry['path']):
+            entry = None
+        if entry is not None and os.path.isfile(entry['path']):
+            sha256 = entry['validators'].get('sha256')
+            if sha256 is not None and file_hash(entry['path']) != sha256:
+                logging.warning('The staged installer for %s is corrupt', name)
+                remove_path(entry['path'])
+                entry = None
+        elif entry is not None and os.path.isdir(entry['path']):
+            if tree_hash(entry['path']) != entry.get('tree'):
+                logging.warning('The staged package for %s was modified', name)
+                remove_path(entry['path'])
+                entry = None
+        return entry
+
+    def remove(self, name):
+        """Discard the staged installer for a channel"""
+        with self.lock:
+            with self.file_lock:
+                index = self.load_index()
+                entry = index.pop(name, None)
+                if entry is not None:
+                    remove_path(entry['path'])
+                    self.save_index(index)
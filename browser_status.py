@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+class FileLock(object):
+    """Advisory lock on a file that is held across processes"""
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def try_lock(self):
+        """Try to take the lock without waiting"""
+        locked = False
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            locked = True
+        except (IOError, OSError):
+            pass
+        return locked
+
+    def acquire(self, blocking=True, timeout=None):
+        """Take the lock, waiting for it if blocking (for up to timeout seconds)"""
+        if self.file is None:
+            self.file = open(self.path, 'a+')
+        end = None if timeout is None else time.time() + timeout
+        locked = self.try_lock()
+        while not locked and blocking and (end is None or time.time() < end):
+            time.sleep(0.5)
+            locked = self.try_lock()
+        if not locked:
+            self.file.close()
+            self.file = None
+        return locked
+
+    def release(self):
+        """Release the lock"""
+        if self.file is not None:
+            try:
+                if os.name == 'nt':
+                    import msvcrt
+                    self.file.seek(0)
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    import fcntl
+                    fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            except (IOError, OSError):
+                pass
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class StatusStore(object):
+    """JSON status file that is replaced atomically and can be updated one channel at a time"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file_lock = FileLock(path + '.lock')
+
+    def load(self):
+        """Read the status, treating a missing or corrupt file as empty"""
+        status = None
+        try:
+            if os.path.isfile(self.path):
+                with open(self.path, 'r') as f_in:
+                    status = json.load(f_in)
+        except Exception:
+            logging.exception('Error reading %s', self.path)
+        if not isinstance(status, dict):
+            status = {}
+        return status
+
+    def write(self, status):
+        """Replace the status file without ever leaving a partially written one behind"""
+        tmp_file = '{0}.{1:d}.tmp'.format(self.path, os.getpid())
+        with open(tmp_file, 'w') as f_out:
+            json.dump(status, f_out, indent=4)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        os.replace(tmp_file, self.path)
+
+    def update(self, name, entry):
+        """Record the state of a single channel, keeping what other processes recorded"""
+        self.merge({name: entry})
+
+    def merge(self, entries):
+        """Record the state of several channels at once, keeping what other processes recorded"""
+        with self.lock:
+            with self.file_lock:
+                status = self.load()
+                status.update(entries)
+                self.write(status)
+
+    def save(self, status):
+        """Write the whole status"""
+        with self.lock:
+            with self.file_lock:
+                self.write(status)
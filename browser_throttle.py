@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+from browser_status import FileLock
+
+class TokenBucket(object):
+    """Token bucket limiting a byte rate, shared by every thread that downloads through it"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst else max(rate, 65536))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """Take size bytes out of the bucket, sleeping for as long as it is overdrawn"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Throttle(object):
+    """Limits download bandwidth (overall and per host) and pauses downloads and installs
+    while a test is running.
+
+    Rates are in bytes per second (0 for unlimited). Everything is paused while
+    pause_file exists or while another process holds a lock on pause_lock (which
+    also covers an agent that crashes without cleaning up)."""
+    def __init__(self, max_rate=0, host_rate=0, pause_file=None, pause_lock=None):
+        self.host_rate = host_rate
+        self.pause_file = pause_file
+        self.pause_lock = pause_lock
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(max_rate) if max_rate > 0 else None
+        self.host_buckets = {}
+        self.paused_time = 0
+        self.checked = 0
+        self.is_paused = False
+
+    def paused(self):
+        """Check if the agent asked for everything to pause (at most twice a second)"""
+        now = time.time()
+        with self.lock:
+            if now - self.checked < 0.5:
+                return self.is_paused
+            self.checked = now
+        is_paused = False
+        if self.pause_file and os.path.exists(self.pause_file):
+            is_paused = True
+        elif self.pause_lock:
+            lock = FileLock(self.pause_lock)
+            if lock.acquire(blocking=False):
+                lock.release()
+            else:
+                is_paused = True
+        with self.lock:
+            self.is_paused = is_paused
+        return is_paused
+
+    def wait(self):
+        """Block for as long as the agent wants things paused"""
+        if (self.pause_file or self.pause_lock) and self.paused():
+            logging.info('Paused while a test is running...')
+            start = time.time()
+            while self.paused():
+                time.sleep(0.5)
+            elapsed = time.time() - start
+            with self.lock:
+                self.paused_time += elapsed
+            logging.info('Resumed after %0.1fs', elapsed)
+
+    def consume(self, url, size):
+        """Account for size bytes received from url, waiting as needed to stay within the limits"""
+        self.wait()
+        if self.bucket is not None:
+            self.bucket.consume(size)
+        if self.host_rate > 0:
+            host = urlparse(url).netloc
+            with self.lock:
+                if host not in self.host_buckets:
+                    self.host_buckets[host] = TokenBucket(self.host_rate)
+                bucket = self.host_buckets[host]
+            bucket.consume(size)
+
+    def log_stats(self):
+        """Log how long the run was paused for"""
+        if self.paused_time > 0:
+            logging.info('Paused for %0.1fs while tests were running', self.paused_time)
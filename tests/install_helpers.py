@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Shared setup for the tests that run downloads and installers offline, against the
+benchmark's stand-in for the vendor CDNs.
+"""
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_bench import FakeCdn, channel_names, fake_install
+
+def make_install(module, work_dir, args, cdn=None):
+    """Create an installer for a platform that keeps its state in work_dir. With a cdn,
+    every channel downloads from it and the installers are replaced by a fake runner
+    that counts them."""
+    return fake_install(module, cdn, work_dir, 0)(module.parse_options(args))
+
+
+def make_tar(files, links=None, mode='w:gz'):
+    """Build a compressed tarball from a dict of file names to contents (and one of
+    symlink names to targets)"""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name in sorted(files):
+            info = tarfile.TarInfo(name)
+            info.size = len(files[name])
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(files[name]))
+        for name in sorted(links or {}):
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = links[name]
+            tar.addfile(info)
+    return buf.getvalue()
+
+
+def make_deb(data_tar, data_name='data.tar.gz'):
+    """Build a Debian package around a data tarball"""
+    members = [('debian-binary', b'2.0\n'), ('control.tar.gz', make_tar({'./control': b'x'})),
+               (data_name, data_tar)]
+    deb = b'!<arch>\n'
+    for name, data in members:
+        deb += '{0:<16}{1:<12}{2:<6}{3:<6}{4:<8}{5:<10}`\n'.format(
+            name, 0, 0, 0, 100644, len(data)).encode('ascii') + data
+        if len(data) % 2:
+            deb += b'\n'
+    return deb
+
+
+class CdnTestCase(unittest.TestCase):
+    """Test with a fake CDN serving objects of size bytes and a work directory"""
+    size = 256 * 1024
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='browser_test')
+        self.cdn = FakeCdn(self.size)
+
+    def tearDown(self):
+        self.cdn.stop()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def publish(self, name, seed=1):
+        """Publish a version of an object and return its URL"""
+        self.cdn.publish(name, seed)
+        return '{0}/f/{1}'.format(self.cdn.base, name)
+
+    def publish_all(self, module, seed=1):
+        """Publish a version of the installer of every channel of a platform"""
+        for index, name in enumerate(channel_names(module)):
+            self.cdn.publish(name, seed * 1000 + index)
+
+    def data(self, name):
+        """Current content of an object"""
+        return self.cdn.objects[name]['data']
+
+    def read(self, path):
+        """Content of a downloaded file"""
+        with open(path, 'rb') as f_in:
+            return f_in.read()
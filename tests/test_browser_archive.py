@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for the archive of recent installers used to roll channels back.
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import browser_install
+from browser_archive import InstallerArchive
+from browser_download import file_hash
+from install_helpers import CdnTestCase, make_install
+
+class InstallerArchiveTest(unittest.TestCase):
+    """The last few installers of every channel are kept"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='browser_test')
+        self.archive_dir = os.path.join(self.dir, 'archive')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def installer(self, name, content):
+        """Write an installer and return its path and validators"""
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f_out:
+            f_out.write(content)
+        return path, {'sha256': file_hash(path), 'etag': '"{0}"'.format(name)}
+
+    def read(self, path):
+        """Content of an archived installer"""
+        with open(path, 'rb') as f_in:
+            return f_in.read()
+
+    def test_keep(self):
+        """Only the newest keep installers of a channel are kept"""
+        archive = InstallerArchive(self.archive_dir, 2, 1024 * 1024)
+        shas = []
+        for version in range(3):
+            path, validators = self.installer('chrome{0:d}.exe'.format(version),
+                                              'version {0:d}'.format(version).encode('ascii'))
+            archive.add('Chrome Stable', path, validators)
+            shas.append(validators['sha256'])
+        # Archiving the installed version again only updates when it was installed
+        path, validators = self.installer('chrome2.exe', b'version 2')
+        archive.add('Chrome Stable', path, validators)
+        entries = archive.index['Chrome Stable']
+        self.assertEqual([entry['sha256'] for entry in entries], [shas[2], shas[1]])
+        self.assertEqual(len(os.listdir(os.path.join(self.archive_dir, 'Chrome_Stable'))), 2)
+        entry = archive.previous('Chrome Stable', 1, shas[2])
+        self.assertEqual(self.read(entry['path']), b'version 1')
+        self.assertIsNone(archive.previous('Chrome Stable', 2, shas[2]))
+        # The index is shared with the next run
+        reloaded = InstallerArchive(self.archive_dir, 2, 1024 * 1024)
+        self.assertEqual(reloaded.previous('Chrome Stable', 1, shas[2])['sha256'], shas[1])
+
+    def test_max_size(self):
+        """Older versions are removed before the newest installer of any channel"""
+        archive = InstallerArchive(self.archive_dir, 3, 250)
+        for name, file_name in [('Chrome Stable', 'chrome1.exe'), ('Mozilla Firefox', 'ff.exe'),
+                                ('Chrome Stable', 'chrome2.exe')]:
+            path, validators = self.installer(file_name, file_name.encode('ascii') * 10)
+            archive.add(name, path, validators)
+        self.assertEqual([self.read(archive.previous(name)['path'])
+                          for name in ['Chrome Stable', 'Mozilla Firefox']],
+                         [b'chrome2.exe' * 10, b'ff.exe' * 10])
+        self.assertEqual(len(archive.index['Chrome Stable']), 1)
+
+    def test_corrupt(self):
+        """An archived installer that no longer matches its SHA-256 is not used"""
+        archive = InstallerArchive(self.archive_dir, 3, 1024 * 1024)
+        path, validators = self.installer('chrome.exe', b'version 1')
+        archive.add('Chrome Stable', path, validators)
+        entry = archive.previous('Chrome Stable')
+        # Written through the hard link the download left behind
+        with open(path, 'r+b') as f_out:
+            f_out.write(b'corrupt')
+        self.assertIsNone(archive.previous('Chrome Stable'))
+        self.assertFalse(os.path.exists(entry['path']))
+        self.assertEqual(archive.index['Chrome Stable'], [])
+
+
+class RollbackTest(CdnTestCase):
+    """Channels are rolled back to an archived installer and pinned to it"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.root = os.path.join(self.dir, 'Program Files')
+        self.commands = []
+
+    def run_elevated(self, command, args):
+        """Record the installers and uninstallers that would run"""
+        self.commands.append((os.path.basename(command), args))
+        return 0
+
+    def run_install(self, *args):
+        """Run the installer for Chrome Stable"""
+        install = make_install(browser_install, self.dir,
+                               ['--chrome', '--stable', '--scan-root', self.root] + list(args),
+                               self.cdn)
+        install.run_elevated = self.run_elevated
+        install.install()
+        return install
+
+    def installed(self, version, uninstaller=True):
+        """Lay out an installed Chrome Stable"""
+        path = os.path.join(self.root, 'Google', 'Chrome', 'Application', version, 'Installer')
+        os.makedirs(path)
+        if uninstaller:
+            with open(os.path.join(path, 'setup.exe'), 'wb'):
+                pass
+
+    def update_twice(self):
+        """Install two versions of Chrome Stable and return their SHA-256"""
+        shas = []
+        for seed in [1, 2]:
+            self.cdn.publish('chrome_Stable', seed)
+            shas.append(hashlib.sha256(self.data('chrome_Stable')).hexdigest())
+            self.run_install()
+        self.assertEqual(len(self.commands), 2)
+        self.commands = []
+        return shas
+
+    def test_rollback(self):
+        """The newer version is uninstalled and the channel pinned until it is unpinned"""
+        shas = self.update_twice()
+        self.installed('121.0.6167.85')
+        self.cdn.reset()
+        install = self.run_install('--rollback', 'chrome stable')
+        self.assertEqual(self.commands,
+                         [('setup.exe', '--uninstall --force-uninstall --system-level'),
+                          (self.commands[1][0], '/silent /install')])
+        self.assertEqual(self.cdn.requests, 0)
+        entry = install.status['Chrome Stable']
+        self.assertTrue(entry['pinned'])
+        self.assertEqual(entry['sha256'], shas[0])
+        # Pinned channels are not updated
+        self.commands = []
+        self.run_install()
+        self.assertEqual(self.cdn.requests, 0)
+        self.assertEqual(self.commands, [])
+        # Until they are unpinned
+        install = self.run_install('--unpin', 'Chrome Stable')
+        self.assertEqual(self.commands, [('browser_install_Chrome_Stable.exe', '/silent /install')])
+        self.assertNotIn('pinned', install.status['Chrome Stable'])
+        self.assertEqual(install.status['Chrome Stable']['sha256'], shas[1])
+
+    def test_refused(self):
+        """Without the uninstaller of the installed version nothing is run"""
+        self.update_twice()
+        self.installed('121.0.6167.85', uninstaller=False)
+        install = self.run_install('--rollback', 'Chrome Stable')
+        self.assertEqual(self.commands, [])
+        self.assertNotIn('pinned', install.status['Chrome Stable'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for skipping hosts that keep failing.
+"""
+import os
+import socket
+import sys
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_breaker import CircuitBreaker
+from browser_download import HostUnavailable, HttpSession
+from install_helpers import CdnTestCase
+
+class CircuitBreakerTest(CdnTestCase):
+    """Hosts are skipped after threshold failures in a row and tried again after a cooldown"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.state_file = os.path.join(self.dir, 'breaker.json')
+
+    def fail(self, breaker, host, count):
+        """Record count failed requests to a host"""
+        for _ in range(count):
+            self.assertTrue(breaker.allow(host))
+            breaker.record(host, False)
+
+    def test_threshold(self):
+        """The host is skipped once it failed threshold times in a row"""
+        breaker = CircuitBreaker(self.state_file, threshold=3)
+        self.fail(breaker, 'dl.google.com', 2)
+        breaker.record('dl.google.com', True)
+        self.fail(breaker, 'dl.google.com', 3)
+        self.assertFalse(breaker.allow('dl.google.com'))
+        self.assertTrue(breaker.allow('download.mozilla.org'))
+
+    def test_cooldown(self):
+        """A single trial request goes through after the cooldown"""
+        breaker = CircuitBreaker(self.state_file, threshold=2, cooldown=0.5)
+        self.fail(breaker, 'dl.google.com', 2)
+        self.assertFalse(breaker.allow('dl.google.com'))
+        time.sleep(0.6)
+        self.assertTrue(breaker.allow('dl.google.com'))
+        self.assertFalse(breaker.allow('dl.google.com'))
+        # A failed trial closes it for another cooldown, a successful one reopens it
+        breaker.record('dl.google.com', False)
+        self.assertFalse(breaker.allow('dl.google.com'))
+        time.sleep(0.6)
+        self.assertTrue(breaker.allow('dl.google.com'))
+        breaker.record('dl.google.com', True)
+        self.assertTrue(breaker.allow('dl.google.com'))
+        self.assertTrue(breaker.allow('dl.google.com'))
+
+    def test_persisted(self):
+        """The state carries over to the next run"""
+        breaker = CircuitBreaker(self.state_file, threshold=3)
+        self.fail(breaker, 'dl.google.com', 3)
+        breaker.save()
+        self.assertFalse(CircuitBreaker(self.state_file, threshold=3).allow('dl.google.com'))
+        self.assertEqual(os.listdir(self.dir), ['breaker.json'])
+
+    def test_session(self):
+        """Requests to a host that refuses connections stop being sent"""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        host = '127.0.0.1:{0:d}'.format(sock.getsockname()[1])
+        url = 'http://{0}/f/chrome'.format(host)
+        sock.close()
+        session = HttpSession(breaker=CircuitBreaker(self.state_file, threshold=2))
+        for _ in range(2):
+            with self.assertRaises(IOError) as context:
+                session.head(url, timeout=10)
+            self.assertNotIsInstance(context.exception, HostUnavailable)
+        self.assertRaises(HostUnavailable, session.head, url, timeout=10)
+        self.assertEqual(session.failures[host], {'failures': 2, 'retries': 0, 'skipped': 1})
+        # Other hosts are unaffected
+        self.assertEqual(session.head(self.publish('chrome'), timeout=10).status_code, 200)
+        self.assertEqual(list(session.failures.keys()), [host])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for the shared installer cache.
+"""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_cache import InstallerCache
+from browser_download import MIN_SEGMENT_SIZE, HttpSession, download_file, file_hash
+from install_helpers import CdnTestCase
+
+class CacheTestCase(CdnTestCase):
+    """Test downloading through an installer cache"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        self.session = HttpSession()
+
+    def download(self, cache, name, host, segments=1):
+        """Download an object into the work directory of a host"""
+        stats = {}
+        dest = os.path.join(self.dir, '{0}-{1}.exe'.format(host, name))
+        url = '{0}/f/{1}'.format(self.cdn.base, name)
+        path, validators = download_file(self.session, url, dest, {}, segments=segments,
+                                         cache=cache, stats=stats)
+        return path, validators, stats
+
+
+class InstallerCacheTest(CacheTestCase):
+    """Installers downloaded once are served from the cache while they are current"""
+    def test_hit(self):
+        """A host without the installer gets it from the cache after a 304"""
+        url = self.publish('chrome')
+        cache = InstallerCache(self.cache_dir, 1024 * 1024 * 1024)
+        _, _, stats = self.download(cache, 'chrome', 'a')
+        self.assertEqual(stats['outcome'], 'downloaded')
+        self.assertIsNotNone(cache.lookup(url))
+        self.cdn.reset()
+        path, _, stats = self.download(cache, 'chrome', 'b')
+        self.assertEqual(stats['outcome'], 'cache')
+        self.assertEqual(self.cdn.statuses, {'304': 1})
+        self.assertEqual(self.cdn.bytes, 0)
+        self.assertEqual(self.read(path), self.data('chrome'))
+        self.assertEqual(cache.hits, 1)
+
+    def test_changed(self):
+        """A new version on the server replaces the cached copy"""
+        self.publish('chrome')
+        cache = InstallerCache(self.cache_dir, 1024 * 1024 * 1024)
+        self.download(cache, 'chrome', 'a')
+        self.publish('chrome', seed=2)
+        path, _, stats = self.download(cache, 'chrome', 'b')
+        self.assertEqual(stats['outcome'], 'downloaded')
+        self.assertEqual(self.read(path), self.data('chrome'))
+
+    def test_shared(self):
+        """Another process sharing the directory sees the installers already cached"""
+        self.publish('chrome')
+        self.download(InstallerCache(self.cache_dir, 1024 * 1024 * 1024), 'chrome', 'a')
+        self.cdn.reset()
+        path, _, stats = self.download(InstallerCache(self.cache_dir, 1024 * 1024 * 1024),
+                                       'chrome', 'b')
+        self.assertEqual(stats['outcome'], 'cache')
+        self.assertEqual(self.read(path), self.data('chrome'))
+
+    def test_corrupt(self):
+        """A cached installer that no longer matches its SHA-256 is downloaded again"""
+        self.publish('chrome')
+        cache = InstallerCache(self.cache_dir, 1024 * 1024 * 1024)
+        _, validators, _ = self.download(cache, 'chrome', 'a')
+        with open(cache.object_path(validators['sha256']), 'r+b') as f_out:
+            f_out.write(b'corrupt')
+        path, _, stats = self.download(cache, 'chrome', 'b')
+        self.assertEqual(stats['outcome'], 'downloaded')
+        self.assertEqual(self.read(path), self.data('chrome'))
+        self.assertEqual(file_hash(cache.object_path(validators['sha256'])), validators['sha256'])
+        self.assertEqual(cache.hits, 0)
+
+    def test_evict(self):
+        """The least recently used installer is removed when the cache is full"""
+        self.publish('chrome')
+        self.publish('firefox', seed=2)
+        cache = InstallerCache(self.cache_dir, self.size * 3 // 2)
+        self.download(cache, 'chrome', 'a')
+        self.download(cache, 'firefox', 'a')
+        self.assertIsNone(cache.lookup('{0}/f/chrome'.format(self.cdn.base)))
+        self.assertIsNotNone(cache.lookup('{0}/f/firefox'.format(self.cdn.base)))
+        self.assertEqual(len(os.listdir(cache.objects_dir)), 1)
+
+
+class LinkedDestTest(CacheTestCase):
+    """Downloads into a dest that is a hard link to a cached installer leave the cache alone"""
+    size = 3 * MIN_SEGMENT_SIZE
+
+    def test_linked_dest(self):
+        """A new version downloaded over a dest left behind by a cache hit"""
+        self.publish('chrome')
+        cache = InstallerCache(self.cache_dir, 1024 * 1024 * 1024)
+        _, validators, _ = self.download(cache, 'chrome', 'a')
+        self.assertTrue(os.path.samefile(os.path.join(self.dir, 'a-chrome.exe'),
+                                         cache.object_path(validators['sha256'])))
+        self.publish('chrome', seed=2)
+        path, _, stats = self.download(cache, 'chrome', 'a', segments=3)
+        self.assertEqual(stats['outcome'], 'segmented')
+        self.assertEqual(self.read(path), self.data('chrome'))
+        self.assertEqual(file_hash(cache.object_path(validators['sha256'])), validators['sha256'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for rebuilding a new installer from the blocks of the previous one (--delta).
+"""
+import json
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_delta import BLOCK_SIZE, write_block_index
+from browser_download import HttpSession, download_file
+from install_helpers import CdnTestCase
+
+class DeltaTest(CdnTestCase):
+    """Only the blocks that changed since the previous version are fetched"""
+    size = 4 * 1024 * 1024
+
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.url = self.publish('chrome')
+        self.base = os.path.join(self.dir, 'chrome.base')
+        with open(self.base, 'wb') as f_out:
+            f_out.write(self.data('chrome'))
+        self.dest = os.path.join(self.dir, 'chrome.exe')
+        self.session = HttpSession()
+
+    def publish_version(self, data, index=True):
+        """Publish a new version of the installer and (optionally) its block index"""
+        self.cdn.publish_data('chrome', data, 2)
+        if index:
+            new_file = os.path.join(self.dir, 'chrome.new')
+            with open(new_file, 'wb') as f_out:
+                f_out.write(data)
+            blocks = json.dumps(write_block_index(new_file)).encode('ascii')
+            self.cdn.publish_data('chrome.blocks', blocks, 2, content_type='application/json')
+        self.cdn.reset()
+
+    def download(self):
+        """Download the new version with the previous one as the base"""
+        stats = {}
+        path, validators = download_file(self.session, self.url, self.dest, {}, stats=stats,
+                                         base=self.base)
+        self.assertEqual(path, self.dest)
+        self.assertEqual(self.read(path), self.data('chrome'))
+        self.assertEqual(validators['size'], len(self.data('chrome')))
+        return stats
+
+    def test_in_place(self):
+        """A change that doesn't move any bytes fetches the block it is in"""
+        data = self.data('chrome')
+        offset = 2 * 1024 * 1024 + 100
+        self.publish_version(data[:offset] + b'\0' * 1000 + data[offset + 1000:])
+        stats = self.download()
+        self.assertEqual(stats['outcome'], 'delta')
+        self.assertEqual(stats['bytes'], BLOCK_SIZE)
+        self.assertEqual(self.cdn.statuses, {'200': 2, '206': 1})
+
+    def test_inserted(self):
+        """Every block after an insertion counts as changed"""
+        data = self.data('chrome')
+        offset = self.size // 2
+        self.publish_version(data[:offset] + b'\0' * 1000 + data[offset:])
+        stats = self.download()
+        self.assertEqual(stats['outcome'], 'delta')
+        self.assertEqual(stats['bytes'], len(self.data('chrome')) - offset)
+
+    def test_shifted(self):
+        """When no block lines up any more it is a full download, and reported as one"""
+        self.publish_version(b'\0' * 1000 + self.data('chrome'))
+        stats = self.download()
+        self.assertEqual(stats['outcome'], 'downloaded')
+        self.assertEqual(stats['bytes'], len(self.data('chrome')))
+        self.assertNotIn('206', self.cdn.statuses)
+
+    def test_no_index(self):
+        """Without a block index the whole installer is downloaded"""
+        data = self.data('chrome')
+        self.publish_version(data[:100] + b'\0' + data[101:], index=False)
+        stats = self.download()
+        self.assertEqual(stats['outcome'], 'downloaded')
+        self.assertEqual(stats['bytes'], self.size)
+
+if __name__ == '__main__':
+    unittest.main()
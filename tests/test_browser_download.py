@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for downloading installers from a local stand-in for the vendor CDN.
+"""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import browser_install
+from browser_download import MIN_SEGMENT_SIZE, HttpSession, content_changed, download_file, \
+    load_partial, unreliable_validators
+from install_helpers import CdnTestCase, make_install
+
+class ResumeTest(CdnTestCase):
+    """Interrupted downloads pick up where they stopped"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.url = self.publish('chrome')
+        self.dest = os.path.join(self.dir, 'chrome.exe')
+        self.session = HttpSession()
+        # The first response for the installer is cut off halfway through
+        self.cdn.drop = True
+
+    def test_resume_attempt(self):
+        """The next attempt asks for the rest of the file with a Range request"""
+        stats = {}
+        path, validators = download_file(self.session, self.url, self.dest, {}, stats=stats)
+        self.assertEqual(path, self.dest)
+        self.assertEqual(stats['outcome'], 'resumed')
+        self.assertEqual(self.cdn.statuses, {'200': 1, '206': 1})
+        self.assertEqual(self.read(path), self.data('chrome'))
+        self.assertEqual(validators['size'], self.size)
+        self.assertFalse(os.path.exists(self.dest + '.partial'))
+
+    def test_resume_next_run(self):
+        """What was received is kept for the next run to resume"""
+        path, _ = download_file(self.session, self.url, self.dest, {}, attempts=1)
+        self.assertIsNone(path)
+        partial = load_partial(self.dest, self.url)
+        self.assertEqual(partial['bytes'], os.path.getsize(self.dest))
+        self.assertGreater(partial['bytes'], 0)
+        stats = {}
+        path, _ = download_file(self.session, self.url, self.dest, {}, stats=stats)
+        self.assertEqual(stats['outcome'], 'resumed')
+        self.assertEqual(self.read(path), self.data('chrome'))
+
+    def test_changed_since_partial(self):
+        """If-Range gets the whole new version when the installer changed in between"""
+        download_file(self.session, self.url, self.dest, {}, attempts=1)
+        self.assertIsNotNone(load_partial(self.dest, self.url))
+        self.cdn.drop = False
+        self.cdn.publish('chrome', 2)
+        self.cdn.reset()
+        stats = {}
+        path, _ = download_file(self.session, self.url, self.dest, {}, stats=stats)
+        self.assertEqual(stats['outcome'], 'downloaded')
+        self.assertEqual(self.cdn.statuses, {'200': 1})
+        self.assertEqual(self.read(path), self.data('chrome'))
+
+    def test_unchanged(self):
+        """A conditional request for the installed version transfers nothing"""
+        self.cdn.drop = False
+        path, validators = download_file(self.session, self.url, self.dest, {})
+        os.remove(path)
+        self.cdn.reset()
+        stats = {}
+        path, _ = download_file(self.session, self.url, self.dest, validators, stats=stats)
+        self.assertIsNone(path)
+        self.assertEqual(stats['outcome'], 'not-modified')
+        self.assertEqual(self.cdn.statuses, {'304': 1})
+
+
+class SegmentedTest(CdnTestCase):
+    """Large installers come down over parallel byte ranges"""
+    size = 3 * MIN_SEGMENT_SIZE
+
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.url = self.publish('chrome')
+        self.dest = os.path.join(self.dir, 'chrome.exe')
+        self.session = HttpSession()
+
+    def test_segments(self):
+        """Every segment is a range request into its place in the file"""
+        stats = {}
+        path, validators = download_file(self.session, self.url, self.dest, {}, segments=3,
+                                         stats=stats)
+        self.assertEqual(stats['outcome'], 'segmented')
+        self.assertEqual(self.cdn.statuses, {'200': 1, '206': 3})
+        self.assertEqual(self.read(path), self.data('chrome'))
+        self.assertEqual(validators['size'], self.size)
+
+    def test_probe(self):
+        """The response to an earlier HEAD is used instead of sending another one"""
+        probe = self.session.head(self.url, allow_redirects=True, timeout=10)
+        self.cdn.reset()
+        stats = {}
+        path, _ = download_file(self.session, self.url, self.dest, {}, segments=3, stats=stats,
+                                probe=probe)
+        self.assertEqual(stats['outcome'], 'segmented')
+        self.assertEqual(self.cdn.statuses, {'206': 3})
+        self.assertEqual(self.read(path), self.data('chrome'))
+
+    def test_linked_dest(self):
+        """A dest left behind as a hard link to another copy is replaced, not written into"""
+        other = os.path.join(self.dir, 'cached.exe')
+        with open(other, 'wb') as f_out:
+            f_out.write(b'cached installer')
+        os.link(other, self.dest)
+        path, _ = download_file(self.session, self.url, self.dest, {}, segments=3)
+        self.assertEqual(self.read(path), self.data('chrome'))
+        self.assertEqual(self.read(other), b'cached installer')
+
+    def test_too_small(self):
+        """Installers smaller than a segment per connection use a single stream"""
+        stats = {}
+        path, _ = download_file(self.session, self.url, self.dest, {}, segments=4, stats=stats)
+        self.assertEqual(stats['outcome'], 'downloaded')
+        self.assertEqual(self.read(path), self.data('chrome'))
+
+    def test_no_ranges(self):
+        """Servers without range support use a single stream"""
+        self.cdn.last_modified = False
+        stats = {}
+        path, _ = download_file(self.session, self.url, self.dest, {}, segments=3, stats=stats)
+        self.assertEqual(stats['outcome'], 'downloaded')
+        self.assertEqual(self.read(path), self.data('chrome'))
+
+
+class ContentChangeTest(CdnTestCase):
+    """Installers are only reinstalled when their content changed, not just their validators"""
+    def run_install(self):
+        """Update Chrome Stable and return how many installers ran"""
+        install = make_install(browser_install, self.dir, ['--chrome', '--stable'], self.cdn)
+        install.install()
+        return install
+
+    def test_content_changed(self):
+        """The same SHA-256 counts the identical downloads, a new one starts over"""
+        previous = {'sha256': 'a', 'etag': '"1"'}
+        current = {'sha256': 'a', 'etag': '"2"'}
+        self.assertFalse(content_changed(previous, current))
+        self.assertEqual(current['identical'], 1)
+        self.assertFalse(content_changed(current, {'sha256': 'a'}))
+        changed = {'sha256': 'b', 'identical': 3}
+        self.assertTrue(content_changed(current, changed))
+        self.assertNotIn('identical', changed)
+
+    def test_same_content_new_validators(self):
+        """Publishing the same bytes again downloads them but doesn't run the installer"""
+        self.cdn.publish('chrome_Stable', 1)
+        self.assertEqual(self.run_install().installs, 1)
+        self.cdn.publish('chrome_Stable', 1)
+        install = self.run_install()
+        self.assertEqual(install.installs, 0)
+        entry = install.status['Chrome Stable']
+        self.assertEqual(entry['identical'], 1)
+        # The new validators are kept so the next check is a 304 again
+        modified = self.cdn.objects['chrome_Stable']['modified']
+        self.assertEqual(entry['etag'], '"1-{0:x}"'.format(modified))
+        self.assertEqual(unreliable_validators(install.status), ['Chrome Stable'])
+
+    def test_new_content(self):
+        """New bytes are installed and the server is trusted again"""
+        self.cdn.publish('chrome_Stable', 1)
+        self.run_install()
+        self.cdn.publish('chrome_Stable', 1)
+        self.run_install()
+        self.cdn.publish('chrome_Stable', 2)
+        install = self.run_install()
+        self.assertEqual(install.installs, 1)
+        self.assertNotIn('identical', install.status['Chrome Stable'])
+        self.assertEqual(unreliable_validators(install.status), [])
+
+
+class SessionTest(CdnTestCase):
+    """Requests from every channel share the keep-alive connections"""
+    def test_reuse(self):
+        """Requests to the same host after the first go over the same connection"""
+        session = HttpSession()
+        self.assertEqual(session.stats(), {})
+        for name in ['chrome', 'firefox', 'edge']:
+            url = self.publish(name)
+            self.assertEqual(session.head(url).status_code, 200)
+        host = 'http://127.0.0.1:{0:d}'.format(self.cdn.server.server_address[1])
+        self.assertEqual(session.stats(), {host: {'requests': 3, 'connections': 1, 'reused': 2}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for extracting browser packages while they download.
+"""
+import hashlib
+import io
+import os
+import sys
+import tarfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_download import HttpSession
+from browser_extract import extract_deb, extract_tar, stream_install, tar_filter
+from install_helpers import CdnTestCase, make_deb, make_tar
+
+CHROME_FILES = {'opt/google/chrome/chrome': b'\x7fELF chrome',
+                'opt/google/chrome/resources.pak': b'resources' * 1000}
+
+def listing(path):
+    """Every file and symlink under path, relative to it"""
+    found = []
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            full_path = os.path.join(root, name)
+            if not os.path.isdir(full_path) or os.path.islink(full_path):
+                found.append(os.path.relpath(full_path, path).replace(os.sep, '/'))
+    return sorted(found)
+
+
+class ExtractTest(CdnTestCase):
+    """Packages are unpacked from a stream without leaving the destination"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.dest = os.path.join(self.dir, 'out')
+        os.makedirs(self.dest)
+
+    def test_tar(self):
+        """Tarballs in any compression keep their files and relative symlinks"""
+        for mode in ['w:gz', 'w:bz2', 'w:xz']:
+            dest = os.path.join(self.dest, mode[2:])
+            extract_tar(io.BytesIO(make_tar({'firefox/firefox': b'firefox'},
+                                            {'firefox/firefox-bin': 'firefox'}, mode)), dest)
+            self.assertEqual(listing(dest), ['firefox/firefox', 'firefox/firefox-bin'])
+            self.assertEqual(os.readlink(os.path.join(dest, 'firefox', 'firefox-bin')), 'firefox')
+
+    def test_escape(self):
+        """Members that would end up outside of the destination are skipped"""
+        files = dict(CHROME_FILES)
+        files['../escaped'] = b'escaped'
+        files['/tmp/absolute'] = b'absolute'
+        files['opt/../../up'] = b'up'
+        links = {'usr/bin/google-chrome': '/opt/google/chrome/chrome',
+                 'opt/google/chrome/passwd': '../../../../etc/passwd'}
+        extract_tar(io.BytesIO(make_tar(files, links)), self.dest)
+        found = listing(self.dir)
+        self.assertEqual([name for name in found if not name.startswith('out/')], [])
+        # Absolute names are either skipped or extracted relative to the destination
+        self.assertEqual([name for name in found if name != 'out/tmp/absolute'],
+                         ['out/' + name for name in sorted(CHROME_FILES)])
+
+    def test_filter(self):
+        """Members are checked one at a time against the destination"""
+        for name, linkname in [('../escaped', None), ('opt/../../up', None),
+                               ('usr/bin/google-chrome', '/opt/google/chrome/chrome'),
+                               ('opt/passwd', '../../etc/passwd')]:
+            member = tarfile.TarInfo(name)
+            if linkname is not None:
+                member.type = tarfile.SYMTYPE
+                member.linkname = linkname
+            self.assertIsNone(tar_filter(member, self.dest), name)
+        self.assertIsNotNone(tar_filter(tarfile.TarInfo('opt/google/chrome/chrome'), self.dest))
+
+    def test_deb(self):
+        """Only the data.tar member of a .deb is extracted, whatever its size alignment"""
+        for data_name, mode in [('data.tar.gz', 'w:gz'), ('data.tar.xz', 'w:xz')]:
+            dest = os.path.join(self.dest, data_name)
+            extract_deb(io.BytesIO(make_deb(make_tar(CHROME_FILES, mode=mode), data_name)), dest)
+            self.assertEqual(listing(dest), sorted(CHROME_FILES))
+
+    def test_not_deb(self):
+        """Anything that isn't a Debian package is refused"""
+        self.assertRaises(IOError, extract_deb, io.BytesIO(make_tar(CHROME_FILES)), self.dest)
+        self.assertRaises(IOError, extract_deb, io.BytesIO(b'!<arch>\n'), self.dest)
+
+
+class StreamInstallTest(CdnTestCase):
+    """Packages are extracted as they download"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.package = make_deb(make_tar(CHROME_FILES))
+        self.cdn.publish_data('chrome.deb', self.package, seed=1)
+        self.url = '{0}/f/chrome.deb'.format(self.cdn.base)
+        self.dest = os.path.join(self.dir, 'chrome-stable.staging')
+        self.session = HttpSession()
+
+    def test_stream(self):
+        """The package is hashed while it is extracted and not downloaded again"""
+        stats = {}
+        path, validators, status = stream_install(self.session, self.url, {}, self.dest, 'deb',
+                                                  stats=stats)
+        self.assertEqual(status, 200)
+        self.assertEqual(stats['outcome'], 'streamed')
+        self.assertEqual(listing(path), sorted(CHROME_FILES))
+        self.assertEqual(validators['sha256'], hashlib.sha256(self.package).hexdigest())
+        self.assertEqual(validators['size'], len(self.package))
+        stats = {}
+        path, _, status = stream_install(self.session, self.url, validators, self.dest, 'deb',
+                                         stats=stats)
+        self.assertIsNone(path)
+        self.assertEqual(status, 304)
+        self.assertEqual(stats['outcome'], 'not-modified')
+
+    def test_interrupted(self):
+        """A package cut off halfway leaves nothing behind"""
+        self.cdn.drop = True
+        stats = {}
+        path, _, _ = stream_install(self.session, self.url, {}, self.dest, 'deb', stats=stats)
+        self.assertIsNone(path)
+        self.assertEqual(stats['outcome'], 'error')
+        self.assertFalse(os.path.exists(self.dest))
+
+if __name__ == '__main__':
+    unittest.main()
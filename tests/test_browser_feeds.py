@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for parsing the vendor release feeds, using small copies of each feed format.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_feeds import ReleaseFeeds, feed_confirms, version_key
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'feeds')
+
+def load_fixture(name):
+    """Load one of the fixture feeds"""
+    with open(os.path.join(FIXTURES, name), 'r') as f_in:
+        return json.load(f_in)
+
+
+class ReleaseFeedsTest(unittest.TestCase):
+    """Versions found in each feed format, without any network requests"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='browser_feeds_test')
+        self.feeds = ReleaseFeeds(None, os.path.join(self.dir, 'feeds.json'))
+        self.feeds.feeds = {'firefox': load_fixture('firefox_versions.json'),
+                            'chrome': load_fixture('chrome_releases.json'),
+                            'edge': load_fixture('edge_products.json')}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_firefox(self):
+        """product-details keys map to the Firefox channels on every platform"""
+        expected = {'Mozilla Firefox': '121.0',
+                    'Mozilla Firefox ESR': '115.6.0esr',
+                    'Mozilla Firefox Beta': '122.0b4',
+                    'Mozilla Firefox Dev': '122.0b4',
+                    'Nightly': '123.0a1'}
+        self.assertEqual(self.feeds.versions('firefox', 'win64'), expected)
+        self.assertEqual(self.feeds.versions('firefox', 'linux'), expected)
+
+    def test_chrome(self):
+        """Chrome releases are split by platform and channel"""
+        self.assertEqual(self.feeds.versions('chrome', 'win64'),
+                         {'Stable': '120.0.6099.129', 'Beta': '121.0.6167.16',
+                          'Dev': '122.0.6182.0'})
+        self.assertEqual(self.feeds.versions('chrome', 'win'), {'Stable': '120.0.6099.110'})
+        self.assertEqual(self.feeds.versions('chrome', 'mac'),
+                         {'Stable': '120.0.6099.129', 'Canary': '122.0.6200.0'})
+
+    def test_chrome_rollout(self):
+        """A staged rollout uses the release serving the most users, then the newest"""
+        # 120.0.6099.130 is only serving 25% of win64 users
+        self.assertEqual(self.feeds.versions('chrome', 'win64')['Stable'], '120.0.6099.129')
+        # Both linux betas serve 50%, malformed releases are skipped
+        self.assertEqual(self.feeds.versions('chrome', 'linux'),
+                         {'Stable': '120.0.6099.129', 'Beta': '121.0.6167.16'})
+
+    def test_edge(self):
+        """Edge releases are matched on platform and architecture, newest first"""
+        self.assertEqual(self.feeds.versions('edge', 'win64'),
+                         {'Stable': '120.0.2210.91', 'Beta': '121.0.2277.4',
+                          'Dev': '122.0.2299.0', 'Canary': '122.0.2309.0'})
+        self.assertEqual(self.feeds.versions('edge', 'win'), {'Stable': '120.0.2210.91'})
+        self.assertEqual(self.feeds.versions('edge', 'mac'),
+                         {'Stable': '120.0.2210.91', 'Dev': '122.0.2299.0'})
+        self.assertEqual(self.feeds.versions('edge', 'linux'),
+                         {'Stable': '120.0.2210.89', 'Beta': '121.0.2277.4'})
+        self.assertEqual(self.feeds.versions('edge', 'android'), {})
+
+    def test_missing_feeds(self):
+        """Feeds that could not be fetched (or are not the expected shape) have no versions"""
+        self.feeds.feeds = {'firefox': None, 'chrome': [], 'edge': {'Product': 'Stable'}}
+        for browser in ['firefox', 'chrome', 'edge', 'brave']:
+            self.assertEqual(self.feeds.versions(browser, 'win64'), {})
+
+    def test_version_key(self):
+        """Versions sort numerically rather than as strings"""
+        self.assertGreater(version_key('120.0.6099.130'), version_key('120.0.6099.99'))
+        self.assertGreater(version_key('122.0b4'), version_key('121.0'))
+        self.assertEqual(sorted(['115.6.0esr', '115.10.0esr', '115.9.1esr'], key=version_key),
+                         ['115.6.0esr', '115.9.1esr', '115.10.0esr'])
+        # Debian package versions, with a revision and an epoch
+        self.assertGreater(version_key('1:120.0.6099.129-1'), version_key('120.0.6099.71-1'))
+        self.assertGreater(version_key('1.61.114-1'), version_key('1.61.109-2'))
+
+    def test_feed_confirms(self):
+        """The feed version only confirms an install that was recently probed"""
+        now = time.time()
+        self.assertTrue(feed_confirms('121.0', {'version': '121.0', 'probed': now}))
+        self.assertFalse(feed_confirms('121.0', {'version': '120.0.1', 'probed': now}))
+        self.assertFalse(feed_confirms('121.0', {'version': '121.0'}))
+        self.assertFalse(feed_confirms(None, {'version': '121.0', 'probed': now}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for downloading installers in the background while the installs run (--jobs), the
+polling schedule of --daemon and runs with nothing to do (--fresh).
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import browser_install
+from install_helpers import CdnTestCase, make_install
+
+# How long every fake installer runs
+INSTALL_TIME = 0.5
+
+class PipelinedTest(CdnTestCase):
+    """Downloads overlap the installs, which run one at a time in order"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.publish_all(browser_install)
+        # Every download takes about 0.2 seconds
+        self.cdn.bandwidth = self.size / 0.2
+        self.events = []
+        self.lock = threading.Lock()
+        self.failing = set()
+
+    def record(self, *event):
+        """Keep track of when a download or install finished"""
+        with self.lock:
+            self.events.append(event + (time.time(),))
+
+    def run_install(self):
+        """Update the three Chrome channels two downloads at a time"""
+        install = make_install(browser_install, self.dir,
+                               ['--chrome', '--stable', '--beta', '--dev', '--jobs', '2'], self.cdn)
+        timed_download = install.timed_download
+
+        def download(task):
+            """Note when every download finishes"""
+            result = timed_download(task)
+            self.record('downloaded', task['name'])
+            return result
+
+        def run_installer(task, exe):
+            """Stand-in for the installer that notes when it runs"""
+            self.record('installing', task['name'])
+            time.sleep(INSTALL_TIME)
+            self.record('installed', task['name'])
+            return 1 if task['name'] in self.failing else 0
+
+        install.timed_download = download
+        install.run_installer = run_installer
+        self.names = [task['name'] for task in install.scheduler.sort(install.get_tasks())]
+        install.install()
+        return install
+
+    def times(self, kind):
+        """When the events of a kind happened, by channel"""
+        return dict((name, when) for event, name, when in self.events if event == kind)
+
+    def test_pipelined(self):
+        """Later downloads finish while the first installer is running"""
+        install = self.run_install()
+        self.assertEqual(len(self.names), 3)
+        self.assertEqual([name for event, name, _ in self.events if event == 'installing'],
+                         self.names)
+        installing = self.times('installing')
+        installed = self.times('installed')
+        for previous, name in zip(self.names, self.names[1:]):
+            self.assertGreaterEqual(installing[name], installed[previous])
+        self.assertLess(max(self.times('downloaded').values()), installed[self.names[0]])
+        for name in self.names:
+            self.assertIn('sha256', install.status[name])
+
+    def test_failed_download(self):
+        """A channel that can't be downloaded doesn't hold up the others"""
+        del self.cdn.objects['chrome_Beta']
+        install = self.run_install()
+        self.assertNotIn('Chrome Beta', self.times('installing'))
+        self.assertNotIn('Chrome Beta', install.status)
+        self.assertEqual(install.scheduler.outcomes['Chrome Beta'], 'failed')
+        for name in self.names:
+            if name != 'Chrome Beta':
+                self.assertIn('sha256', install.status[name])
+                self.assertEqual(install.scheduler.outcomes[name], 'completed')
+
+    def test_failed_install(self):
+        """An installer that fails is not recorded and the next one still runs"""
+        self.failing.add('Chrome Stable')
+        install = self.run_install()
+        self.assertEqual(sorted(self.times('installed').keys()), sorted(self.names))
+        self.assertNotIn('Chrome Stable', install.status)
+        self.assertEqual(install.scheduler.outcomes['Chrome Stable'], 'failed')
+        for name in self.names:
+            if name != 'Chrome Stable':
+                self.assertIn('sha256', install.status[name])
+
+
+class FreshTest(CdnTestCase):
+    """Channels checked recently are skipped without any network access"""
+    def run_install(self):
+        """Update Chrome Stable unless it was checked in the last hour"""
+        install = make_install(browser_install, self.dir,
+                               ['--chrome', '--stable', '--fresh', '3600', '--timing'], self.cdn)
+        install.install()
+        return install
+
+    def test_fresh(self):
+        """A run where every channel is fresh makes no requests at all"""
+        self.publish('chrome_Stable')
+        self.assertEqual(self.run_install().installs, 1)
+        self.cdn.reset()
+        install = self.run_install()
+        self.assertEqual(self.cdn.requests, 0)
+        # The HTTP session (and requests) is never even set up
+        self.assertIsNone(install.session.session)
+        self.assertEqual([step for step, _ in install.timing.steps], ['lock', 'freshness'])
+        # Once the window is over the channel is checked again
+        entry = install.store.load()['Chrome Stable']
+        entry['checked'] -= 3600
+        install.store.update('Chrome Stable', entry)
+        self.run_install()
+        self.assertEqual(self.cdn.statuses, {'304': 1})
+
+
+class StopDaemon(Exception):
+    """Raised by the fake sleep to end the daemon loop"""
+    pass
+
+
+class DaemonTest(CdnTestCase):
+    """Channels are polled less often while they don't change, on a fake clock"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.publish('chrome_Stable')
+        self.install = make_install(browser_install, self.dir,
+                                    ['--chrome', '--stable', '--daemon', '--jitter', '0'],
+                                    self.cdn)
+        self.now = 1000.0
+        self.sleeps = []
+
+    def clock(self):
+        """Fake time"""
+        return self.now
+
+    def sleep(self, seconds):
+        """Move the fake time on instead of sleeping, the daemon stops after two cycles"""
+        self.sleeps.append(seconds)
+        if len(self.sleeps) == 2:
+            raise StopDaemon()
+        self.now += seconds
+
+    def test_reschedule(self):
+        """The interval grows by the backoff and is halved when the channel changes"""
+        entry = {}
+        self.install.reschedule(entry, False, self.now)
+        self.assertEqual(entry['interval'], 900 * 1.5)
+        self.assertEqual(entry['next'], self.now + 900 * 1.5)
+        self.install.reschedule(entry, True, self.now)
+        self.assertEqual(entry['interval'], 900)
+        self.assertEqual(entry['last_change'], self.now)
+        for _ in range(20):
+            self.install.reschedule(entry, False, self.now)
+        self.assertEqual(entry['interval'], 86400)
+        self.assertEqual(entry['checks'], 22)
+
+    def test_cycle(self):
+        """A cycle installs the channels that are due and schedules their next check"""
+        schedule = {}
+        self.install.daemon_cycle(self.install.get_tasks(), schedule, self.now)
+        self.assertEqual(self.install.installs, 1)
+        self.assertEqual(schedule['Chrome Stable']['interval'], 900)
+        self.assertEqual(schedule['Chrome Stable']['last_change'], self.now)
+        self.cdn.reset()
+        self.install.daemon_cycle(self.install.get_tasks(), schedule, self.now + 900)
+        self.assertEqual(self.cdn.statuses, {'304': 1})
+        self.assertEqual(schedule['Chrome Stable']['interval'], 900 * 1.5)
+        self.assertEqual(schedule['Chrome Stable']['next'], self.now + 900 + 900 * 1.5)
+
+    def test_daemon(self):
+        """The daemon sleeps until the next channel is due"""
+        with self.assertRaises(StopDaemon):
+            self.install.daemon(self.clock, self.sleep)
+        self.assertEqual(self.sleeps, [900, 900 * 1.5])
+        self.assertEqual(self.install.installs, 1)
+        schedule = self.install.load_schedule()
+        self.assertEqual(schedule['Chrome Stable']['checks'], 2)
+        self.assertEqual(schedule['Chrome Stable']['next'], 1900 + 900 * 1.5)
+
+if __name__ == '__main__':
+    unittest.main()
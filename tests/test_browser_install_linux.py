@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for installing Linux packages by swapping a symlink to the extracted version.
+"""
+import hashlib
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import browser_install_linux
+from install_helpers import CdnTestCase, make_deb, make_install, make_tar
+
+def chrome_package(version, extra=None):
+    """Build a Chrome package with the given version"""
+    files = {'opt/google/chrome/chrome': b'\x7fELF',
+             'opt/google/chrome/version': version.encode('ascii')}
+    if extra:
+        files.update(extra)
+    return make_deb(make_tar(files))
+
+
+class LinuxInstallTest(CdnTestCase):
+    """Packages are extracted next to the install and swapped into place"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.install_dir = os.path.join(self.dir, 'opt')
+        self.path = os.path.join(self.install_dir, 'chrome-stable')
+
+    def publish_version(self, version, seed, extra=None):
+        """Publish a Chrome Stable package and return its SHA-256"""
+        package = chrome_package(version, extra)
+        self.cdn.publish_data('chrome_Stable', package, seed)
+        return hashlib.sha256(package).hexdigest()
+
+    def run_install(self, *args):
+        """Run the installer for Chrome Stable"""
+        install = make_install(browser_install_linux, self.dir,
+                               ['--chrome', '--stable', '--install-dir', self.install_dir] +
+                               list(args), self.cdn)
+        install.install()
+        return install
+
+    def installed_version(self):
+        """Version of the Chrome that is live"""
+        with open(os.path.join(self.path, 'opt', 'google', 'chrome', 'version'), 'r') as f_in:
+            return f_in.read()
+
+    def test_update(self):
+        """Every version gets its own directory and the symlink is swapped to it"""
+        sha1 = self.publish_version('1', 1)
+        install = self.run_install()
+        self.assertTrue(os.path.islink(self.path))
+        self.assertEqual(os.readlink(self.path), 'chrome-stable.' + sha1[:12])
+        self.assertEqual(self.installed_version(), '1')
+        self.assertEqual(install.status['Chrome Stable']['sha256'], sha1)
+        sha2 = self.publish_version('2', 2)
+        self.run_install()
+        self.assertEqual(os.readlink(self.path), 'chrome-stable.' + sha2[:12])
+        self.assertEqual(self.installed_version(), '2')
+        # The replaced version is archived for --rollback and nothing is left behind
+        self.assertFalse(os.path.exists(self.path + '.' + sha1[:12]))
+        self.assertEqual(sorted(os.listdir(self.install_dir)),
+                         ['chrome-stable', 'chrome-stable.' + sha2[:12]])
+        self.cdn.reset()
+        self.run_install()
+        self.assertEqual(self.cdn.statuses, {'304': 1})
+
+    def test_rollback(self):
+        """The archived version is swapped back into place and pinned"""
+        sha1 = self.publish_version('1', 1)
+        self.run_install()
+        self.publish_version('2', 2)
+        self.run_install()
+        self.cdn.reset()
+        install = self.run_install('--rollback', 'Chrome Stable')
+        self.assertEqual(self.cdn.requests, 0)
+        self.assertEqual(os.readlink(self.path), 'chrome-stable.' + sha1[:12])
+        self.assertEqual(self.installed_version(), '1')
+        self.assertTrue(install.status['Chrome Stable']['pinned'])
+        self.assertEqual(install.status['Chrome Stable']['sha256'], sha1)
+        # Rolling forward again uses the archived copy of the version it replaced
+        self.run_install('--unpin', 'Chrome Stable', '--rollback', 'Chrome Stable')
+        self.assertEqual(self.installed_version(), '2')
+
+    def test_escape(self):
+        """Files a package would write outside of its install directory are skipped"""
+        self.publish_version('1', 1, {'../../escaped': b'escaped'})
+        self.run_install()
+        self.assertEqual(self.installed_version(), '1')
+        for root, _, files in os.walk(self.dir):
+            self.assertNotIn('escaped', files, root)
+
+    def test_prefetch_apply(self):
+        """A staged package is swapped into place by --apply without any requests"""
+        sha1 = self.publish_version('1', 1)
+        self.run_install('--prefetch')
+        self.assertFalse(os.path.lexists(self.path))
+        self.cdn.reset()
+        self.run_install('--apply')
+        self.assertEqual(self.cdn.requests, 0)
+        self.assertEqual(os.readlink(self.path), 'chrome-stable.' + sha1[:12])
+
+    def test_staged_modified(self):
+        """A staged package that was changed after it was staged is not installed"""
+        self.publish_version('1', 1)
+        self.run_install('--prefetch')
+        with open(os.path.join(self.path + '.staged', 'opt', 'google', 'chrome', 'chrome'),
+                  'ab') as f_out:
+            f_out.write(b'modified')
+        install = self.run_install('--apply')
+        self.assertFalse(os.path.lexists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.staged'))
+        self.assertNotIn('Chrome Stable', install.status)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for the per-channel timing and throughput metrics (--metrics-file and
+--prometheus-file).
+"""
+import json
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import browser_install
+from install_helpers import CdnTestCase, make_install
+
+class MetricsTest(CdnTestCase):
+    """Every probe, download and install of a run is exported"""
+    def run_install(self):
+        """Update Chrome Stable, writing both kinds of metrics"""
+        self.jsonl_file = os.path.join(self.dir, 'metrics.jsonl')
+        self.prometheus_file = os.path.join(self.dir, 'browser_install.prom')
+        install = make_install(browser_install, self.dir,
+                               ['--chrome', '--stable', '--metrics-file', self.jsonl_file,
+                                '--prometheus-file', self.prometheus_file], self.cdn)
+        install.install()
+        return install
+
+    def test_metrics(self):
+        """The JSON lines and the Prometheus textfile describe the same phases"""
+        self.publish('chrome_Stable')
+        self.run_install()
+        with open(self.jsonl_file, 'r') as f_in:
+            records = [json.loads(line) for line in f_in]
+        self.assertEqual([record['phase'] for record in records], ['probe', 'download', 'install'])
+        download = records[1]
+        self.assertEqual(download['channel'], 'Chrome Stable')
+        self.assertEqual(download['bytes'], self.size)
+        self.assertEqual(download['outcome'], 'downloaded')
+        self.assertEqual(download['status'], 200)
+        with open(self.prometheus_file, 'r') as f_in:
+            lines = f_in.read().splitlines()
+        labels = 'channel="Chrome Stable",phase="download",outcome="downloaded"'
+        self.assertIn('browser_install_download_bytes{{{0}}} {1:d}'.format(labels, self.size),
+                      lines)
+        self.assertIn('browser_install_http_status{{{0}}} 200'.format(labels), lines)
+        self.assertIn('# TYPE browser_install_phase_seconds gauge', lines)
+        self.assertEqual(len([line for line in lines
+                              if line.startswith('browser_install_phase_seconds{')]), 3)
+        # The next run replaces the textfile and appends to the JSON lines
+        self.run_install()
+        with open(self.prometheus_file, 'r') as f_in:
+            lines = f_in.read().splitlines()
+        self.assertIn('browser_install_http_status{channel="Chrome Stable",phase="probe",'
+                      'outcome="unchanged"} 304', lines)
+        self.assertFalse([line for line in lines if 'phase="download"' in line])
+        with open(self.jsonl_file, 'r') as f_in:
+            self.assertEqual(len(f_in.readlines()), 4)
+
+if __name__ == '__main__':
+    unittest.main()
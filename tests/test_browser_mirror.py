@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for the fleet mirror, served against a local stand-in for the vendor CDN.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_bench import FakeCdn
+from browser_download import HttpSession
+from browser_mirror import Mirror, MirrorRequestHandler, ThreadingHTTPServer, mirror_key
+
+UPSTREAM = 'https://dl.google.com/chrome/install/ChromeStandaloneSetup64.exe'
+
+class MirrorTest(unittest.TestCase):
+    """Serve one mirrored installer and check the responses clients rely on"""
+    def setUp(self):
+        self.cdn = FakeCdn(256 * 1024)
+        self.cdn.publish('chrome', 1)
+        self.dir = tempfile.mkdtemp(prefix='browser_mirror_test')
+        self.session = HttpSession()
+        self.mirror = Mirror([self.cdn.url(UPSTREAM, 'chrome')], self.dir, self.session)
+        self.mirror.refresh()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MirrorRequestHandler)
+        self.server.daemon_threads = True
+        self.server.mirror = self.mirror
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.key = mirror_key(self.cdn.url(UPSTREAM, 'chrome'))
+        self.url = 'http://127.0.0.1:{0:d}/{1}'.format(self.server.server_address[1], self.key)
+        self.data = self.cdn.objects['chrome']['data']
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cdn.stop()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_full_download(self):
+        """The mirrored installer is served whole with its validators"""
+        response = self.session.get(self.url, timeout=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.data)
+        self.assertEqual(response.headers['ETag'],
+                         '"{0}"'.format(self.mirror.lookup(self.key)['sha256']))
+        self.assertIn('Last-Modified', response.headers)
+
+    def test_conditional_request(self):
+        """Conditional requests with the current validators get a 304"""
+        response = self.session.get(self.url, timeout=10)
+        etag = response.headers['ETag']
+        modified = response.headers['Last-Modified']
+        response = self.session.get(self.url, headers={'If-None-Match': etag}, timeout=10)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        response = self.session.get(self.url, headers={'If-Modified-Since': modified}, timeout=10)
+        self.assertEqual(response.status_code, 304)
+        response = self.session.get(self.url, headers={'If-None-Match': '"stale"'}, timeout=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.data)
+
+    def test_if_range_resume(self):
+        """A resumed download gets the rest of the file, unless the file changed"""
+        response = self.session.head(self.url, timeout=10)
+        etag = response.headers['ETag']
+        response = self.session.get(self.url, headers={'Range': 'bytes=1000-', 'If-Range': etag},
+                                    timeout=10)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 1000-{0:d}/{1:d}'.format(len(self.data) - 1, len(self.data)))
+        self.assertEqual(response.content, self.data[1000:])
+        response = self.session.get(self.url, headers={'Range': 'bytes=1000-',
+                                                       'If-Range': '"stale"'}, timeout=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.data)
+
+    def test_index(self):
+        """index.json lists every mirrored installer with its upstream URL and hash"""
+        url = 'http://127.0.0.1:{0:d}/index.json'.format(self.server.server_address[1])
+        response = self.session.get(url, timeout=10)
+        self.assertEqual(response.status_code, 200)
+        index = json.loads(response.text)
+        self.assertEqual(list(index.keys()), [self.key])
+        self.assertEqual(index[self.key]['url'], self.cdn.url(UPSTREAM, 'chrome'))
+        self.assertEqual(index[self.key]['sha256'], self.mirror.lookup(self.key)['sha256'])
+
+    def test_refresh(self):
+        """A refresh only replaces installers that changed upstream"""
+        entry = self.mirror.lookup(self.key)
+        self.mirror.refresh()
+        self.assertEqual(self.mirror.lookup(self.key), entry)
+        self.cdn.publish('chrome', 2)
+        self.mirror.refresh()
+        self.assertNotEqual(self.mirror.lookup(self.key)['sha256'], entry['sha256'])
+        response = self.session.get(self.url, timeout=10)
+        self.assertEqual(response.content, self.cdn.objects['chrome']['data'])
+
+    def test_unknown(self):
+        """Anything that isn't mirrored is a 404"""
+        url = 'http://127.0.0.1:{0:d}/missing'.format(self.server.server_address[1])
+        self.assertEqual(self.session.get(url, timeout=10).status_code, 404)
+
+    def test_corrupt_index(self):
+        """A corrupt index is started over and the installers are fetched again"""
+        with open(self.mirror.index_file, 'w') as f_out:
+            f_out.write('{"chrome": {"sha')
+        self.cdn.reset()
+        mirror = Mirror([self.cdn.url(UPSTREAM, 'chrome')], self.dir, self.session)
+        self.assertEqual(mirror.index, {})
+        mirror.refresh()
+        self.assertEqual(self.cdn.statuses, {'200': 1})
+        self.assertEqual(mirror.lookup(self.key)['sha256'], self.mirror.lookup(self.key)['sha256'])
+
+if __name__ == '__main__':
+    unittest.main()
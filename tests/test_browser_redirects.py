@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for sending requests straight to the cached redirect target of a download URL.
+"""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_download import HttpSession, conditional_headers, response_validators
+from browser_redirects import RedirectCache
+from install_helpers import CdnTestCase
+
+class RedirectCacheTest(CdnTestCase):
+    """Redirect targets are reused until they are gone or report a change"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.target = self.publish('chrome')
+        self.url = '{0}/r/2/chrome'.format(self.cdn.base)
+        self.cache_file = os.path.join(self.dir, 'redirects.json')
+        self.redirects = RedirectCache(self.cache_file)
+
+    def session(self):
+        """New session (a new run) sharing the redirect cache"""
+        return HttpSession(redirects=self.redirects)
+
+    def head(self, session, validators=None):
+        """Probe the download URL"""
+        self.cdn.reset()
+        return session.head(self.url, headers=conditional_headers(validators or {}),
+                            allow_redirects=True)
+
+    def test_cached(self):
+        """Once resolved, requests go straight to the target, in later runs too"""
+        response = self.head(self.session())
+        self.assertEqual(response.url, self.target)
+        self.assertEqual(self.cdn.statuses, {'302': 2, '200': 1})
+        self.redirects.save()
+        self.redirects = RedirectCache(self.cache_file)
+        validators = response_validators(response)
+        response = self.head(self.session(), validators)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.cdn.statuses, {'304': 1})
+
+    def test_missing_target(self):
+        """A target that is gone is resolved again through the original URL"""
+        self.redirects.store(self.url, '{0}/f/chrome_old'.format(self.cdn.base))
+        response = self.head(self.session())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.url, self.target)
+        self.assertEqual(self.cdn.statuses, {'404': 1, '302': 2, '200': 1})
+        self.assertEqual(self.redirects.lookup(self.url), self.target)
+
+    def test_changed(self):
+        """A target that changed is checked against the original URL once per session"""
+        old_target = self.publish('chrome_old')
+        self.redirects.store(self.url, old_target)
+        validators = response_validators(self.head(self.session()))
+        self.cdn.publish('chrome_old', 2)
+        self.cdn.publish('chrome', 3)
+        session = self.session()
+        response = self.head(session, validators)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.url, self.target)
+        self.assertEqual(self.cdn.statuses, {'200': 2, '302': 2})
+        self.assertEqual(self.redirects.lookup(self.url), self.target)
+        # The download that follows goes straight to the new target
+        response = self.head(session, validators)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.cdn.statuses, {'200': 1})
+
+if __name__ == '__main__':
+    unittest.main()
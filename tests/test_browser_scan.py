@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for rebuilding the installed state from a copy of the install directories.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import browser_install
+import browser_install_linux
+import browser_install_macos
+from browser_scan import find_version, installed_version, scanned_entry
+from browser_status import StatusStore
+from install_helpers import make_install
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'scan')
+PROGRAM_FILES = os.path.join(FIXTURES, 'Program Files')
+APP_DATA = os.path.join(FIXTURES, 'AppData')
+APPLICATIONS = os.path.join(FIXTURES, 'Applications')
+OPT = os.path.join(FIXTURES, 'opt')
+
+class InstalledVersionTest(unittest.TestCase):
+    """Versions read straight from the install directories"""
+    def test_application_ini(self):
+        """Firefox installs carry their version in application.ini"""
+        self.assertEqual(installed_version(os.path.join(PROGRAM_FILES, 'Mozilla Firefox')), '121.0')
+        self.assertEqual(installed_version(os.path.join(OPT, 'mozilla-firefox', 'firefox')),
+                         '115.6.0esr')
+
+    def test_version_directories(self):
+        """The newest version directory of a Chromium install wins"""
+        path = os.path.join(PROGRAM_FILES, 'Google', 'Chrome', 'Application')
+        self.assertEqual(installed_version(path), '120.0.6099.130')
+
+    def test_info_plist(self):
+        """App bundles carry their version in Info.plist (XML or binary)"""
+        self.assertEqual(installed_version(os.path.join(APPLICATIONS, 'Google Chrome.app')),
+                         '120.0.6099.129')
+        self.assertEqual(installed_version(os.path.join(APPLICATIONS, 'Firefox.app')), '121.0')
+
+    def test_not_installed(self):
+        """Missing installs (or ones without a version) have no version"""
+        self.assertIsNone(installed_version(os.path.join(APPLICATIONS, 'Google Chrome Beta.app')))
+        self.assertIsNone(installed_version(os.path.join(OPT, 'chrome-stable')))
+
+    def test_find_version(self):
+        """The first root with the install is used, missing roots are skipped"""
+        relative = os.path.join('Google', 'Chrome', 'Application')
+        self.assertEqual(find_version([None, APP_DATA, PROGRAM_FILES], relative), '120.0.6099.130')
+        self.assertIsNone(find_version([APP_DATA], relative))
+
+    def test_scanned_entry(self):
+        """Scanned entries have a version but no validators"""
+        entry = scanned_entry('121.0')
+        self.assertEqual(entry['version'], '121.0')
+        self.assertIsNone(entry['validator'])
+        self.assertTrue(entry['scanned'])
+        self.assertNotIn('checked', entry)
+
+
+class ScanTest(unittest.TestCase):
+    """Status entries rebuilt by the installer for each platform"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='browser_scan_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def check_entries(self, install, expected):
+        """Check the scanned channels in memory and in the status file"""
+        saved = StatusStore(install.status_file).load()
+        for status in [install.status, saved]:
+            self.assertEqual(sorted(status.keys()), sorted(expected.keys()))
+            for name in expected:
+                self.assertEqual(status[name]['version'], expected[name])
+                self.assertTrue(status[name]['scanned'])
+
+    def test_windows(self):
+        """Channels are found under Program Files and the local application data"""
+        install = make_install(browser_install, self.dir,
+                               ['--all', '--scan-root', PROGRAM_FILES, '--scan-root', APP_DATA])
+        install.scan(install.get_tasks())
+        self.check_entries(install, {'Chrome Stable': '120.0.6099.130',
+                                     'Mozilla Firefox': '121.0',
+                                     'Brave Nightly': '122.1.63.62'})
+
+    def test_windows_keeps_status(self):
+        """Channels that are already in the status file are left alone"""
+        install = make_install(browser_install, self.dir, ['--all', '--scan-root', PROGRAM_FILES])
+        install.set_status('Chrome Stable', {'version': '121.0.6167.16', 'validator': 'etag'})
+        install.scan(install.get_tasks())
+        self.assertEqual(install.status['Chrome Stable']['version'], '121.0.6167.16')
+        self.assertNotIn('scanned', install.status['Chrome Stable'])
+        self.assertEqual(install.status['Mozilla Firefox']['version'], '121.0')
+
+    def test_windows_check(self):
+        """--check uses the scanned versions for the run without saving them"""
+        install = make_install(browser_install, self.dir,
+                               ['--all', '--check', '--scan-root', PROGRAM_FILES])
+        install.scan(install.get_tasks())
+        self.assertEqual(install.status['Chrome Stable']['version'], '120.0.6099.130')
+        self.assertEqual(StatusStore(install.status_file).load(), {})
+
+    def test_macos(self):
+        """App bundles are found in the scan roots"""
+        install = make_install(browser_install_macos, self.dir, ['--scan-root', APPLICATIONS])
+        install.scan(install.get_tasks())
+        self.check_entries(install, {'Chrome Stable': '120.0.6099.129',
+                                     'Firefox Mozilla Firefox': '121.0'})
+
+    def test_linux(self):
+        """Only the Firefox tarballs can be scanned, the .deb installs have no version"""
+        install = make_install(browser_install_linux, self.dir,
+                               ['--all', '--install-dir', OPT])
+        install.scan(install.get_tasks())
+        self.check_entries(install, {'Mozilla Firefox': '115.6.0esr'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for the run deadline, the per-channel time budget and the channel priority.
+"""
+import os
+import sys
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_download import Cancelled, HttpSession, download_file, load_partial
+from browser_scheduler import Scheduler
+from install_helpers import CdnTestCase
+
+def channel(browser, name):
+    """Minimal task for a channel"""
+    return {'browser': browser, 'channel': name, 'name': '{0} {1}'.format(browser, name)}
+
+
+class SchedulerTest(unittest.TestCase):
+    """Channels are worked on in priority order until the run is out of time"""
+    def test_deadline(self):
+        """Nothing new is started or installed once the deadline passes"""
+        scheduler = Scheduler(deadline=0.3)
+        self.assertTrue(scheduler.begin('Chrome'))
+        scheduler.check()
+        self.assertTrue(scheduler.can_install('Chrome'))
+        time.sleep(0.4)
+        self.assertRaises(Cancelled, scheduler.check)
+        self.assertFalse(scheduler.can_install('Chrome'))
+        scheduler.finish('Chrome')
+        self.assertFalse(scheduler.begin('Firefox'))
+        self.assertEqual(scheduler.outcomes, {'Chrome': 'timed-out', 'Firefox': 'skipped'})
+
+    def test_budget(self):
+        """A channel that runs over its budget is cancelled without affecting the next one"""
+        scheduler = Scheduler(deadline=0, budget=0.3)
+        self.assertTrue(scheduler.begin('Chrome'))
+        time.sleep(0.4)
+        self.assertRaises(Cancelled, scheduler.check)
+        scheduler.finish('Chrome', failed=True)
+        self.assertTrue(scheduler.begin('Firefox'))
+        scheduler.check()
+        scheduler.finish('Firefox')
+        self.assertEqual(scheduler.outcomes, {'Chrome': 'timed-out', 'Firefox': 'completed'})
+        self.assertIsNone(scheduler.remaining())
+
+    def test_priority(self):
+        """Channels are ordered by the first priority item they match"""
+        tasks = [channel('Chrome', 'Canary'), channel('Firefox', 'Nightly'),
+                 channel('Chrome', 'Beta'), channel('Firefox', 'Stable'),
+                 channel('Chrome', 'Stable')]
+        scheduler = Scheduler(priority='stable, firefox')
+        self.assertEqual([task['name'] for task in scheduler.sort(tasks)],
+                         ['Firefox Stable', 'Chrome Stable', 'Firefox Nightly', 'Chrome Canary',
+                          'Chrome Beta'])
+
+
+class CancelledDownloadTest(CdnTestCase):
+    """Downloads stop when their channel runs out of time and resume on the next run"""
+    size = 1024 * 1024
+
+    def test_cancelled(self):
+        """A download that runs over its budget leaves a partial download behind"""
+        # 1 MB at 1 MB/s with half a second to download it
+        self.cdn.bandwidth = 1024 * 1024
+        url = self.publish('chrome')
+        dest = os.path.join(self.dir, 'chrome.exe')
+        scheduler = Scheduler(deadline=0, budget=0.5)
+        scheduler.begin('Chrome')
+        stats = {}
+        path, _ = download_file(HttpSession(scheduler=scheduler), url, dest, {}, stats=stats)
+        scheduler.finish('Chrome', failed=path is None)
+        self.assertIsNone(path)
+        self.assertEqual(scheduler.outcomes, {'Chrome': 'timed-out'})
+        partial = load_partial(dest, url)
+        self.assertIsNotNone(partial)
+        self.assertGreater(partial['bytes'], 0)
+        self.assertLess(partial['bytes'], self.size)
+        # The next run picks up from there
+        self.cdn.bandwidth = 0
+        stats = {}
+        path, _ = download_file(HttpSession(scheduler=Scheduler()), url, dest, {}, stats=stats)
+        self.assertEqual(stats['outcome'], 'resumed')
+        self.assertEqual(self.read(path), self.data('chrome'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for downloading installers ahead of time (--prefetch) and installing them later
+(--apply).
+"""
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import browser_install
+from browser_staging import StagingArea
+from install_helpers import CdnTestCase, make_install
+
+class StagingTest(CdnTestCase):
+    """Installers are downloaded by --prefetch and only installed by --apply"""
+    def setUp(self):
+        CdnTestCase.setUp(self)
+        self.cdn.publish('chrome_Stable', 1)
+
+    def run_install(self, mode):
+        """Run a prefetch or apply for Chrome Stable"""
+        install = make_install(browser_install, self.dir, ['--chrome', '--stable', mode],
+                               self.cdn)
+        install.install()
+        return install
+
+    def staging(self):
+        """The staging area the runs share"""
+        return StagingArea(os.path.join(self.dir, 'staging'))
+
+    def test_prefetch_apply(self):
+        """Apply installs what prefetch staged without touching the network"""
+        install = self.run_install('--prefetch')
+        self.assertEqual(install.installs, 0)
+        entry = self.staging().get('Chrome Stable')
+        self.assertIsNotNone(entry)
+        self.assertEqual(self.read(entry['path']), self.data('chrome_Stable'))
+        self.cdn.reset()
+        install = self.run_install('--apply')
+        self.assertEqual(install.installs, 1)
+        self.assertEqual(self.cdn.requests, 0)
+        self.assertIsNone(self.staging().get('Chrome Stable'))
+        self.assertEqual(install.status['Chrome Stable']['sha256'],
+                         entry['validators']['sha256'])
+        # Nothing is left to apply and the next prefetch finds it up to date
+        self.assertEqual(self.run_install('--apply').installs, 0)
+        self.cdn.reset()
+        self.run_install('--prefetch')
+        self.assertEqual(self.cdn.statuses, {'304': 1})
+        self.assertIsNone(self.staging().get('Chrome Stable'))
+
+    def test_already_staged(self):
+        """A staged installer isn't downloaded again, a newer one replaces it"""
+        self.run_install('--prefetch')
+        self.cdn.reset()
+        self.run_install('--prefetch')
+        self.assertEqual(self.cdn.statuses, {'304': 1})
+        self.cdn.publish('chrome_Stable', 2)
+        self.run_install('--prefetch')
+        entry = self.staging().get('Chrome Stable')
+        self.assertEqual(self.read(entry['path']), self.data('chrome_Stable'))
+        self.assertEqual(len([name for name in os.listdir(os.path.join(self.dir, 'staging'))
+                              if name.endswith('.exe')]), 1)
+
+    def test_corrupt(self):
+        """A staged installer that was damaged is discarded instead of installed"""
+        self.run_install('--prefetch')
+        path = self.staging().get('Chrome Stable')['path']
+        with open(path, 'r+b') as f_out:
+            f_out.write(b'corrupt')
+        install = self.run_install('--apply')
+        self.assertEqual(install.installs, 0)
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(self.staging().take('Chrome Stable'))
+
+if __name__ == '__main__':
+    unittest.main()
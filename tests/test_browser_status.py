@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for the status file and the lock shared between installer processes.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import browser_install
+from browser_status import FileLock, StatusStore
+from install_helpers import make_install
+
+class StatusStoreTest(unittest.TestCase):
+    """Channels are recorded one at a time without losing what others wrote"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='browser_test')
+        self.path = os.path.join(self.dir, 'status.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_update(self):
+        """An update keeps the entries already in the file"""
+        StatusStore(self.path).save({'Chrome': {'version': '1'}})
+        StatusStore(self.path).update('Firefox', {'version': '2'})
+        self.assertEqual(StatusStore(self.path).load(),
+                         {'Chrome': {'version': '1'}, 'Firefox': {'version': '2'}})
+
+    def test_concurrent(self):
+        """Updates from several processes at once all end up in the file"""
+        names = ['channel{0:d}'.format(index) for index in range(8)]
+        threads = [threading.Thread(target=StatusStore(self.path).update, args=(name, {}))
+                   for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(StatusStore(self.path).load().keys()), names)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['status.json', 'status.json.lock'])
+
+    def test_corrupt(self):
+        """A corrupt status file reads as empty and is replaced by the next update"""
+        with open(self.path, 'w') as f_out:
+            f_out.write('{"Chrome": {"vers')
+        store = StatusStore(self.path)
+        self.assertEqual(store.load(), {})
+        store.update('Chrome', {'version': '1'})
+        self.assertEqual(store.load(), {'Chrome': {'version': '1'}})
+
+
+class FileLockTest(unittest.TestCase):
+    """Only one holder of the lock at a time"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='browser_test')
+        self.path = os.path.join(self.dir, 'install.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_exclusive(self):
+        """The lock can't be taken while it is held and can once it is released"""
+        first = FileLock(self.path)
+        second = FileLock(self.path)
+        self.assertTrue(first.acquire(blocking=False))
+        self.assertFalse(second.acquire(blocking=False))
+        first.release()
+        self.assertTrue(second.acquire(blocking=False))
+        second.release()
+
+    def test_timeout(self):
+        """Waiting for a held lock gives up after the timeout"""
+        with FileLock(self.path):
+            start = time.time()
+            self.assertFalse(FileLock(self.path).acquire(timeout=1))
+            self.assertGreaterEqual(time.time() - start, 1)
+
+    def test_wait(self):
+        """A waiting holder gets the lock when it is released"""
+        first = FileLock(self.path)
+        first.acquire()
+        timer = threading.Timer(0.5, first.release)
+        timer.start()
+        second = FileLock(self.path)
+        self.assertTrue(second.acquire(timeout=10))
+        second.release()
+        timer.join()
+
+
+class SaveStatusTest(unittest.TestCase):
+    """Runs going on at the same time don't overwrite each other's channels"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='browser_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_two_writers(self):
+        """A run only saves the channels it touched, on top of what the other one wrote"""
+        install = make_install(browser_install, self.dir, ['--all'])
+        install.set_status('Chrome Stable', {'sha256': '1'})
+        # A --prefetch run starts while the install run is going
+        prefetch = make_install(browser_install, self.dir, ['--all', '--prefetch'])
+        install.set_status('Firefox Stable', {'sha256': '2'})
+        prefetch.set_status('Chrome Beta', {'sha256': '3'})
+        prefetch.mark_checked('Chrome Stable')
+        install.mark_checked('Firefox Stable')
+        install.save_status()
+        prefetch.save_status()
+        status = StatusStore(install.status_file).load()
+        self.assertEqual(sorted(status.keys()), ['Chrome Beta', 'Chrome Stable', 'Firefox Stable'])
+        self.assertEqual(status['Firefox Stable']['sha256'], '2')
+        self.assertIn('checked', status['Chrome Stable'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Copyright 2016 Google Inc. All Rights Reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Tests for the bandwidth limits and for pausing while a test is running.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from browser_download import HttpSession, download_file
+from browser_status import FileLock
+from browser_throttle import Throttle, TokenBucket
+from install_helpers import CdnTestCase
+
+class ThrottleTest(CdnTestCase):
+    """Downloads stay within the configured bandwidth"""
+    size = 512 * 1024
+
+    def timed_download(self, throttle, name):
+        """Download an object through a throttled session and return how long it took"""
+        url = self.publish(name)
+        session = HttpSession(throttle=throttle)
+        start = time.time()
+        path, _ = download_file(session, url, os.path.join(self.dir, name), {})
+        elapsed = time.time() - start
+        self.assertEqual(self.read(path), self.data(name))
+        return elapsed
+
+    def test_bucket(self):
+        """A full bucket lets a burst through and then paces to the rate"""
+        bucket = TokenBucket(256 * 1024)
+        start = time.time()
+        bucket.consume(256 * 1024)
+        self.assertLess(time.time() - start, 0.1)
+        bucket.consume(128 * 1024)
+        self.assertGreaterEqual(time.time() - start, 0.4)
+
+    def test_max_rate(self):
+        """The overall limit applies to downloads"""
+        # 512 KB at 256 KB/s with the first 256 KB in the initial burst
+        elapsed = self.timed_download(Throttle(max_rate=256 * 1024), 'chrome')
+        self.assertGreaterEqual(elapsed, 0.9)
+
+    def test_host_rate(self):
+        """Each host gets its own share of the per-host limit"""
+        throttle = Throttle(host_rate=256 * 1024)
+        self.assertGreaterEqual(self.timed_download(throttle, 'chrome'), 0.9)
+        self.assertEqual(list(throttle.host_buckets.keys()), ['127.0.0.1:{0:d}'.format(self.cdn.server.server_address[1])])
+
+
+class PauseTest(unittest.TestCase):
+    """Everything waits while the agent says a test is running"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='browser_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_not_paused(self):
+        """Without the pause file or lock nothing waits"""
+        throttle = Throttle(pause_file=os.path.join(self.dir, 'pause'),
+                            pause_lock=os.path.join(self.dir, 'pause.lock'))
+        throttle.wait()
+        self.assertEqual(throttle.paused_time, 0)
+
+    def test_pause_file(self):
+        """Waiting continues until the pause file is removed"""
+        pause_file = os.path.join(self.dir, 'pause')
+        with open(pause_file, 'w'):
+            pass
+        timer = threading.Timer(1, os.remove, args=(pause_file,))
+        timer.start()
+        throttle = Throttle(pause_file=pause_file)
+        start = time.time()
+        throttle.wait()
+        timer.join()
+        self.assertGreaterEqual(time.time() - start, 1)
+        self.assertGreater(throttle.paused_time, 0)
+
+    def test_pause_lock(self):
+        """Waiting continues for as long as another process holds the pause lock"""
+        pause_lock = os.path.join(self.dir, 'pause.lock')
+        lock = FileLock(pause_lock)
+        self.assertTrue(lock.acquire(blocking=False))
+        timer = threading.Timer(1, lock.release)
+        timer.start()
+        throttle = Throttle(pause_lock=pause_lock)
+        start = time.time()
+        throttle.wait()
+        timer.join()
+        self.assertGreaterEqual(time.time() - start, 1)
+        self.assertGreater(throttle.paused_time, 0)
+
+if __name__ == '__main__':
+    unittest.main()